@@ -0,0 +1,207 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+# Credential handling for the server: salted PBKDF2 password hashes, a bounded
+# cache of recently verified logins with failed-attempt lockout, and signed
+# session tokens that let a reconnecting client skip the password exchange.
+
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 200_000
+AUTH_SECRET_ENV = "VM_AUTH_SECRET"
+AUTH_SECRET_PATH = ".auth_secret"   # Created on first use when the env var isn't set; keep it out of git
+
+
+# Salted hash in the form "pbkdf2_sha256$<iterations>$<salt>$<hash>" (base64 parts)
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "$".join([HASH_SCHEME, str(iterations),
+                     base64.b64encode(salt).decode("ascii"), base64.b64encode(digest).decode("ascii")])
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_SCHEME + "$")
+
+
+# Check a password against a stored value; returns (matches, needs_rehash).
+# Values that aren't hashes yet are legacy plaintext and should be upgraded once verified.
+# A malformed hash never matches.
+def verify_password(password, stored):
+    if stored is None:
+        return False, False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")), True
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        iterations = int(iterations)
+        salt, digest = base64.b64decode(salt, validate=True), base64.b64decode(digest, validate=True)
+    except ValueError:          # Also covers binascii.Error from bad base64
+        print("[!] Ignoring malformed password hash")
+        return False, False
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return hmac.compare_digest(candidate, digest), iterations < HASH_ITERATIONS
+
+
+# Secret used to sign session tokens: $VM_AUTH_SECRET, else a random key kept in AUTH_SECRET_PATH
+# so tokens stay valid across server restarts (and across worker processes sharing the file).
+# A new key is written to a temporary file and hard-linked into place, so the file only ever
+# appears complete, and when several processes race to create it they all end up with the winner's.
+def load_secret(path=AUTH_SECRET_PATH):
+    secret = os.environ.get(AUTH_SECRET_ENV)
+    if secret:
+        return secret.encode("utf-8")
+    if not os.path.exists(path):
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(base64.b64encode(os.urandom(32)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, 0o600)
+        try:
+            os.link(temp, path)
+        except FileExistsError:
+            pass                # Another process got there first; use its key
+        finally:
+            os.remove(temp)
+    with open(path, "rb") as f:
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f"Session token secret in {path} is empty; delete the file to generate a new one")
+    return secret
+
+
+# Failed logins per username, bounded; `max_failures` in a row lock the username out for
+# `lockout` seconds. Counts are per process (see SQLiteLoginFailures in backend.py for the
+# multi-worker version with the same interface).
+class LoginFailures:
+    def __init__(self, max_entries=1024, max_failures=5, lockout=60):
+        self.max_entries = max_entries
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.lock = threading.Lock()
+        self.failures = OrderedDict()   # username -> [failed attempts, locked_until]
+
+    def locked(self, username):
+        with self.lock:
+            entry = self.failures.get(username)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def record_failure(self, username):
+        with self.lock:
+            entry = self.failures.setdefault(username, [0, 0])
+            self.failures.move_to_end(username)
+            entry[0] += 1
+            if entry[0] >= self.max_failures:
+                entry[0] = 0
+                entry[1] = time.monotonic() + self.lockout
+                metrics.increment("auth.lockouts")
+            while len(self.failures) > self.max_entries:
+                self.failures.popitem(last=False)
+
+    def clear(self, username):
+        with self.lock:
+            self.failures.pop(username, None)
+
+
+# Recently verified logins (bounded) plus the failed-login lockout.
+# A verified password is remembered as a keyed digest (never the password itself), so a
+# repeat login for the same user skips the PBKDF2 work. It still reads the stored hash (one
+# indexed lookup), which is what lets a password change invalidate the cached login.
+class CredentialCache:
+    STRIPES = 64
+
+    def __init__(self, max_entries=1024, ttl=10 * 60, failures=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.failures = failures or LoginFailures(max_entries)   # Replaced when workers share lockouts
+        self.key = os.urandom(32)       # Per-process key for the cached digests
+        self.lock = threading.Lock()
+        self.verified = OrderedDict()   # username -> (digest, expires_at), least recently used first
+        self.verify_locks = [threading.Lock() for _ in range(self.STRIPES)]
+
+    # Held while a username's password is checked the slow way, so a burst of logins for
+    # one user (e.g. kiosks reconnecting after a restart) runs PBKDF2 once, not once each
+    def verify_lock(self, username):
+        return self.verify_locks[hash(username) % self.STRIPES]
+
+    # The stored hash is part of the digest, so a cached login stops matching as soon as the
+    # user's password changes in the database, whichever process or tool changed it
+    def digest(self, username, password, stored):
+        return hmac.new(self.key, f"{username}\0{stored}\0{password}".encode("utf-8"), hashlib.sha256).digest()
+
+    # True if this exact username/password pair was verified recently against `stored`
+    def check(self, username, password, stored):
+        if stored is None:
+            return False
+        with self.lock:
+            entry = self.verified.get(username)
+            if entry is None or entry[1] <= time.monotonic():
+                return False
+            self.verified.move_to_end(username)
+        return hmac.compare_digest(entry[0], self.digest(username, password, stored))
+
+    def locked(self, username):
+        return self.failures.locked(username)
+
+    def record_success(self, username, password, stored):
+        digest = self.digest(username, password, stored)
+        self.failures.clear(username)
+        with self.lock:
+            self.verified[username] = (digest, time.monotonic() + self.ttl)
+            self.verified.move_to_end(username)
+            while len(self.verified) > self.max_entries:
+                self.verified.popitem(last=False)
+
+    def record_failure(self, username):
+        with self.lock:
+            self.verified.pop(username, None)
+        self.failures.record_failure(username)
+
+
+# Stateless signed tokens "<username b64>.<expiry>.<signature>"; any server process
+# holding the same secret accepts them, so they survive restarts
+class SessionTokens:
+    def __init__(self, ttl=12 * 60 * 60, secret=None):
+        self.ttl = ttl
+        self.secret = secret
+        self.lock = threading.Lock()
+
+    def signing_key(self):
+        if self.secret is None:
+            with self.lock:
+                if self.secret is None:
+                    self.secret = load_secret()
+        return self.secret
+
+    def sign(self, body):
+        signature = hmac.new(self.signing_key(), body.encode("ascii"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(signature).decode("ascii").rstrip("=")
+
+    def issue(self, username):
+        user = base64.urlsafe_b64encode(username.encode("utf-8")).decode("ascii")
+        body = f"{user}.{int(time.time() + self.ttl)}"
+        return f"{body}.{self.sign(body)}"
+
+    # Username the token was issued to, or None if it is malformed, forged or expired
+    def verify(self, token):
+        try:
+            user, expires, signature = token.split(".")
+            if not hmac.compare_digest(signature, self.sign(f"{user}.{expires}")):
+                return None
+            if int(expires) < time.time():
+                return None
+            return base64.urlsafe_b64decode(user.encode("ascii")).decode("utf-8")
+        except (ValueError, TypeError, UnicodeError):
+            return None
+
+
+# Shared by every session in this process
+credential_cache = CredentialCache()
+session_tokens = SessionTokens()
@@ -1,10 +1,301 @@
+import base64
+import hashlib
+import itertools
+import os
+import queue
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
-import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-# Represents a product with id, name, price, and available stock
+import rates
+from auth import credential_cache, hash_password, verify_password
+from journal import TransactionJournal
+from metrics import metrics
+
+DB_PATH = "vending_machine.db"
+
+# Reuses a fixed number of SQLite connections across threads instead of opening
+# and closing one per command. Each connection keeps its own prepared-statement
+# cache, so repeated queries skip parsing.
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=8, timeout=10.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout          # Seconds to wait for a free connection / a busy database
+        self.idle = queue.LifoQueue()   # Most recently used first, so hot connections stay warm
+        self.created = 0
+        self.lock = threading.Lock()
+        self.schema_ready = False       # Analytics indexes/rollups checked on first connect
+
+    # Open a connection with WAL journaling and tuned pragmas
+    def open_connection(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")      # Readers don't block the writer
+        conn.execute("PRAGMA synchronous=NORMAL")    # Safe with WAL, avoids an fsync per commit
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")      # ~8 MB page cache per connection
+        conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        if not self.schema_ready:
+            prepare_analytics_schema(conn)
+            self.schema_ready = True
+        return conn
+
+    # Take an idle connection, opening a new one while under the size limit
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return self.open_connection()
+                except Exception:
+                    self.created -= 1
+                    raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+
+    # Hand a connection back, discarding any uncommitted work
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    # Borrow a connection for the duration of a with-block. Time spent waiting for it is
+    # recorded as "db.wait" and time holding it as "db.<label>".
+    @contextmanager
+    def connection(self, label="query"):
+        started = time.perf_counter()
+        conn = self.acquire()
+        acquired = time.perf_counter()
+        metrics.observe("db.wait", acquired - started)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+            metrics.observe(f"db.{label}", time.perf_counter() - acquired)
+
+    # Close every idle connection (used when reconfiguring or shutting down)
+    def close_all(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
+
+# Shared by every database path in this module; see configure_database
+db_pool = ConnectionPool()
+
+
+# Point the backend at a database file and/or resize the connection pool
+def configure_database(path=DB_PATH, pool_size=8):
+    global db_pool
+    db_pool.close_all()
+    db_pool = ConnectionPool(path, pool_size)
+
+
+INSERT_TRANSACTION = """
+    INSERT INTO CartTransactions (productID, quantity, totalPrice, username)
+    VALUES (?, ?, ?, ?)
+"""
+
+# Sales rollups maintained alongside CartTransactions so charts never scan the raw log:
+# lifetime totals per product, and per-product totals per (UTC) day
+ANALYTICS_SCHEMA = """
+    CREATE INDEX IF NOT EXISTS idx_transactions_product_date ON CartTransactions (productID, transactionDate);
+    CREATE INDEX IF NOT EXISTS idx_transactions_date ON CartTransactions (transactionDate, transactionID);
+    CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON CartTransactions (username, transactionDate, transactionID);
+    CREATE TABLE IF NOT EXISTS ProductSalesTotals (
+        productID INTEGER PRIMARY KEY,
+        unitsSold INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_sales_totals_units ON ProductSalesTotals (unitsSold DESC);
+    CREATE TABLE IF NOT EXISTS DailyProductSales (
+        productID INTEGER NOT NULL,
+        saleDate TEXT NOT NULL,
+        unitsSold INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (productID, saleDate)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_daily_sales_date ON DailyProductSales (saleDate);
+"""
+
+ROLLUP_TOTALS = """
+    INSERT INTO ProductSalesTotals (productID, unitsSold, revenue) VALUES (?, ?, ?)
+    ON CONFLICT (productID) DO UPDATE SET unitsSold = unitsSold + excluded.unitsSold,
+                                          revenue = revenue + excluded.revenue
+"""
+
+ROLLUP_DAILY = """
+    INSERT INTO DailyProductSales (productID, saleDate, unitsSold, revenue) VALUES (?, date('now'), ?, ?)
+    ON CONFLICT (productID, saleDate) DO UPDATE SET unitsSold = unitsSold + excluded.unitsSold,
+                                                    revenue = revenue + excluded.revenue
+"""
+
+
+# Create analytics indexes and rollup tables if missing, backfilling rollups from existing sales
+def prepare_analytics_schema(conn):
+    conn.executescript(ANALYTICS_SCHEMA)
+    has_sales = conn.execute("SELECT 1 FROM CartTransactions LIMIT 1").fetchone()
+    has_rollups = conn.execute("SELECT 1 FROM ProductSalesTotals LIMIT 1").fetchone()
+    if has_sales and not has_rollups:
+        rebuild_sales_rollups(conn)
+
+
+# Recompute both rollup tables from the full transaction log (one-off backfill / repair)
+def rebuild_sales_rollups(conn):
+    with conn:
+        conn.execute("DELETE FROM ProductSalesTotals")
+        conn.execute("DELETE FROM DailyProductSales")
+        conn.execute("""
+            INSERT INTO ProductSalesTotals (productID, unitsSold, revenue)
+            SELECT productID, SUM(quantity), SUM(totalPrice) FROM CartTransactions GROUP BY productID
+        """)
+        conn.execute("""
+            INSERT INTO DailyProductSales (productID, saleDate, unitsSold, revenue)
+            SELECT productID, date(transactionDate), SUM(quantity), SUM(totalPrice)
+            FROM CartTransactions GROUP BY productID, date(transactionDate)
+        """)
+
+
+# Insert transaction rows and fold them into the rollups using the caller's open transaction
+def record_sales(cur, records):
+    cur.executemany(INSERT_TRANSACTION, records)
+    cur.executemany(ROLLUP_TOTALS, [(pid, qty, total) for pid, qty, total, _ in records])
+    cur.executemany(ROLLUP_DAILY, [(pid, qty, total) for pid, qty, total, _ in records])
+
+
+INSERT_TRANSACTION_AT = """
+    INSERT INTO CartTransactions (productID, quantity, totalPrice, username, transactionDate)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+ROLLUP_DAILY_AT = """
+    INSERT INTO DailyProductSales (productID, saleDate, unitsSold, revenue) VALUES (?, date(?), ?, ?)
+    ON CONFLICT (productID, saleDate) DO UPDATE SET unitsSold = unitsSold + excluded.unitsSold,
+                                                    revenue = revenue + excluded.revenue
+"""
+
+
+# Bulk version of a checkout's writes for sales journaled earlier: rows are
+# (productID, quantity, total, username, sold at) and keep their original timestamps.
+# Stock decrements and rollups are summed per product (and day) first.
+def record_journaled_sales(cur, rows):
+    if not rows:
+        return
+    sold, totals, daily = {}, {}, {}
+    for pid, qty, total, _, sold_at in rows:
+        sold[pid] = sold.get(pid, 0) + qty
+        units, revenue = totals.get(pid, (0, 0.0))
+        totals[pid] = (units + qty, revenue + total)
+        units, revenue = daily.get((pid, sold_at[:10]), (0, 0.0))
+        daily[(pid, sold_at[:10])] = (units + qty, revenue + total)
+    cur.executemany("UPDATE Products SET stock = stock - ? WHERE productID = ?", [(qty, pid) for pid, qty in sold.items()])
+    cur.executemany(INSERT_TRANSACTION_AT, rows)
+    cur.executemany(ROLLUP_TOTALS, [(pid, units, revenue) for pid, (units, revenue) in totals.items()])
+    cur.executemany(ROLLUP_DAILY_AT, [(pid, day, units, revenue) for (pid, day), (units, revenue) in daily.items()])
+
+
+# Server-side sales analytics over the rollup tables. Results are cached by
+# (query, arguments, data version); every recorded sale bumps the version, so
+# repeated chart requests between sales never touch the database.
+class SalesAnalytics:
+    PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()   # (query, args, version) -> result, least recently used first
+        self.version = 0
+
+    # Mark every cached result as outdated (called after sales are committed)
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    # Return a cached result for this query at the current data version, computing it on a miss
+    def cached(self, query, args, compute):
+        key = (query, args, self.version)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                metrics.increment("analytics.cache_hit")
+                return self.cache[key]
+        metrics.increment("analytics.cache_miss")
+        result = compute()
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return result
+
+    # Best-selling products as [name, units sold] rows
+    def top_sellers(self, limit=5):
+        def compute():
+            with db_pool.connection("analytics_top") as conn:
+                return [list(row) for row in conn.execute("""
+                    SELECT p.productName, s.unitsSold
+                    FROM ProductSalesTotals s
+                             JOIN Products p ON p.productID = s.productID
+                    ORDER BY s.unitsSold DESC LIMIT ?
+                """, (limit,))]
+        return self.cached("top", (limit,), compute)
+
+    # Units sold per day for one product: (product name or None, [[date, units], ...])
+    def product_trend(self, pid):
+        def compute():
+            with db_pool.connection("analytics_trend") as conn:
+                row = conn.execute("SELECT productName FROM Products WHERE productID = ?", (pid,)).fetchone()
+                points = [list(point) for point in conn.execute("""
+                    SELECT saleDate, unitsSold FROM DailyProductSales
+                    WHERE productID = ? ORDER BY saleDate
+                """, (pid,))]
+            return (row[0] if row else None), points
+        return self.cached("trend", (pid,), compute)
+
+    # Revenue (USD) per day, month or year as [[period, revenue], ...]
+    def revenue(self, period="day"):
+        fmt = self.PERIOD_FORMATS[period]
+
+        def compute():
+            with db_pool.connection("analytics_revenue") as conn:
+                return [list(row) for row in conn.execute("""
+                    SELECT strftime(?, saleDate) AS period, SUM(revenue)
+                    FROM DailyProductSales GROUP BY period ORDER BY period
+                """, (fmt,))]
+        return self.cached("revenue", (period,), compute)
+
+
+# Shared by every session in this process
+sales_analytics = SalesAnalytics()
+
+
+# History cursors are opaque tokens wrapping the (transactionDate, transactionID) of the last row sent
+def encode_history_cursor(date, transaction_id):
+    return base64.urlsafe_b64encode(f"{date}|{transaction_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor):
+    date, transaction_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").rsplit("|", 1)
+    return date, int(transaction_id)
+
+
+# Represents a product with id, name, price, and available stock.
+# Slots instead of a per-instance __dict__: the shared store holds one per product for the process lifetime.
 class Product:
+    __slots__ = ("id", "name", "price", "stock")
+
     def __init__(self, id, name, price, stock):
         self.id = id
         self.name = name
@@ -14,27 +305,572 @@ class Product:
     def __str__(self):
         return f"Product: {self.name}, Price: ${self.price:.2f}, Stock: {self.stock}"
 
+
+# One cart line: the product's name and unit price when it was added, and the quantity held.
+# `cents` is the unit price in whole cents so cart totals can be kept as an exact running sum.
+class CartLine:
+    __slots__ = ("id", "name", "price", "cents", "qty")
+
+    def __init__(self, id, name, price, qty):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.cents = round(price * 100)
+        self.qty = qty
+
+# Publish/subscribe channel for stock changes. Writers publish the product IDs whose
+# available stock changed; a dispatcher thread coalesces whatever has queued up, reads
+# the current available stock once and hands {productID: available} to every subscriber.
+# Subscriber callbacks run on the dispatcher thread and must not block for long.
+class StockEvents:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}            # token -> callback(changes, version)
+        self.tokens = itertools.count(1)
+        self.pending = queue.Queue()     # Batches of product IDs waiting to be dispatched
+        self.version = 0                 # Number of events dispatched so far
+        self.dispatcher = None
+
+    def subscribe(self, callback):
+        self.start_dispatcher()
+        with self.lock:
+            token = next(self.tokens)
+            self.subscribers[token] = callback
+        return token
+
+    def unsubscribe(self, token):
+        with self.lock:
+            self.subscribers.pop(token, None)
+
+    # Note that these products' available stock changed; cheap enough to call under other locks
+    def publish(self, product_ids):
+        if self.subscribers and product_ids:
+            self.pending.put(tuple(product_ids))
+
+    def start_dispatcher(self):
+        if self.dispatcher is not None:
+            return
+        with self.lock:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch_forever, name="stock-events", daemon=True)
+                self.dispatcher.start()
+
+    def dispatch_forever(self):
+        while True:
+            changed = set(self.pending.get())
+            while True:
+                try:
+                    changed.update(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            self.dispatch(changed)
+
+    # Send the current available stock of `changed` products to every subscriber
+    def dispatch(self, changed):
+        products = inventory_store.load()
+        reserved = reservation_book.reserved_totals()
+        changes = {pid: max(products[pid].stock - reserved.get(pid, 0), 0)
+                   for pid in sorted(changed) if pid in products}
+        if not changes:
+            return
+        with self.lock:
+            self.version += 1
+            version = self.version
+            subscribers = list(self.subscribers.items())
+        for token, callback in subscribers:
+            try:
+                callback(changes, version)
+            except Exception as e:
+                print(f"[!] Dropping stock subscriber {token}: {e}")
+                self.unsubscribe(token)
+
+
+# Shared by every session in this process
+stock_events = StockEvents()
+
+
+# Central record of stock held in carts across all sessions. Each hold expires `ttl`
+# seconds after it was last changed; a background reaper releases expired holds.
+# Per-product totals are kept alongside, so available stock is one lookup.
+class ReservationBook:
+    def __init__(self, ttl=15 * 60, reap_interval=30):
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.lock = threading.Lock()
+        self.holds = {}        # (holder, productID) -> [quantity, expires_at]
+        self.reserved = {}     # productID -> total quantity held
+        self.version = 0       # Bumped whenever reserved totals change
+        self.reaper = None
+
+    # Total quantity of a product held across all carts
+    def reserved_qty(self, pid):
+        return self.reserved.get(pid, 0)
+
+    # {productID: quantity held} for every product with holds, in one call
+    def reserved_totals(self):
+        return dict(self.reserved)
+
+    # Stock that can still be promised to a new cart
+    def available(self, pid, stock):
+        return max(stock - self.reserved.get(pid, 0), 0)
+
+    # Quantity of a product held by one holder (0 if none or expired)
+    def held(self, holder, pid):
+        hold = self.holds.get((holder, pid))
+        return hold[0] if hold and hold[1] > time.monotonic() else 0
+
+    # Hold `qty` more units if that many are still available; returns True on success.
+    # A hold of this holder's that expired but hasn't been reaped yet is dropped first,
+    # so renewing it asks for the full quantity again instead of adding to the stale one.
+    def reserve(self, holder, pid, qty, stock):
+        if qty <= 0:
+            return False
+        self.start_reaper()
+        now = time.monotonic()
+        with self.lock:
+            hold = self.holds.get((holder, pid))
+            if hold and hold[1] <= now:
+                self.drop_reserved(pid, hold[0])
+                del self.holds[(holder, pid)]
+            if stock - self.reserved.get(pid, 0) < qty:
+                return False
+            hold = self.holds.setdefault((holder, pid), [0, 0])
+            hold[0] += qty
+            hold[1] = now + self.ttl
+            self.reserved[pid] = self.reserved.get(pid, 0) + qty
+            self.version += 1
+        stock_events.publish((pid,))
+        return True
+
+    # Give back up to `qty` units (all of them if qty is None); returns the quantity released.
+    # What is still held counts as fresh cart activity and gets a new TTL.
+    def release(self, holder, pid, qty=None):
+        if qty is not None and qty <= 0:
+            return 0
+        with self.lock:
+            hold = self.holds.get((holder, pid))
+            if not hold:
+                return 0
+            released = hold[0] if qty is None else min(qty, hold[0])
+            hold[0] -= released
+            if hold[0] == 0:
+                del self.holds[(holder, pid)]
+            else:
+                hold[1] = time.monotonic() + self.ttl
+            self.drop_reserved(pid, released)
+        stock_events.publish((pid,))
+        return released
+
+    # Release every hold belonging to one holder (checkout done or session closed)
+    def release_all(self, holder):
+        with self.lock:
+            keys = [key for key in self.holds if key[0] == holder]
+            for key in keys:
+                self.drop_reserved(key[1], self.holds.pop(key)[0])
+        stock_events.publish([pid for _, pid in keys])
+
+    # Lower a product's reserved total; caller holds the lock
+    def drop_reserved(self, pid, qty):
+        remaining = self.reserved.get(pid, 0) - qty
+        if remaining > 0:
+            self.reserved[pid] = remaining
+        else:
+            self.reserved.pop(pid, None)
+        self.version += 1
+
+    # Release holds whose TTL has passed
+    def reap(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, hold in self.holds.items() if hold[1] <= now]
+            for key in expired:
+                self.drop_reserved(key[1], self.holds.pop(key)[0])
+        stock_events.publish([pid for _, pid in expired])
+
+    # Start the background reaper the first time anything is reserved
+    def start_reaper(self):
+        if self.reaper is not None:
+            return
+        with self.lock:
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap_forever, name="reservation-reaper", daemon=True)
+                self.reaper.start()
+
+    def reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            self.reap()
+
+
+# Shared by every cart in this process (replaced by a SQLiteReservationBook in multi-worker mode)
+reservation_book = ReservationBook()
+cart_ids = itertools.count(1)
+
+
+SHARED_STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS Reservations (
+        holder TEXT NOT NULL,
+        productID INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        expiresAt REAL NOT NULL,
+        PRIMARY KEY (holder, productID)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_reservations_product ON Reservations (productID, expiresAt);
+    CREATE TABLE IF NOT EXISTS SharedVersions (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+    INSERT OR IGNORE INTO SharedVersions (name, version) VALUES ('stock', 0), ('holds', 0);
+    CREATE TABLE IF NOT EXISTS LoginFailures (
+        username TEXT PRIMARY KEY,
+        failures INTEGER NOT NULL,
+        lockedUntil REAL NOT NULL,
+        lastFailure REAL NOT NULL
+    ) WITHOUT ROWID;
+"""
+
+
+# Keeps worker processes' in-memory state in step through SQLite. Every stock write bumps
+# the 'stock' version and every hold change bumps 'holds', inside the writing transaction.
+# A sync thread in each worker polls the versions; when another process changed stock it
+# reloads the inventory store (and drops cached analytics), and on any change it
+# republishes stock to push subscribers.
+class SharedState:
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.known = {}         # name -> version this process's caches reflect
+        self.syncer = None
+
+    # Increment a version inside the caller's transaction and return the new value
+    def bump(self, conn, name):
+        return conn.execute("UPDATE SharedVersions SET version = version + 1 WHERE name = ? RETURNING version",
+                            (name,)).fetchone()[0]
+
+    # After committing `version` of our own change: if nothing else happened in between,
+    # the local caches (already updated by write-through) are current and no reload is needed
+    def note_local(self, name, version):
+        with self.lock:
+            if self.known.get(name) == version - 1:
+                self.known[name] = version
+
+    # Apply our own committed change `version` to the local cache by calling apply(), unless the
+    # sync thread already installed a reload at or past that version (which includes the change;
+    # applying a sale again would count it twice). Serialized with sync's install.
+    def write_through(self, name, version, apply):
+        with inventory_store.lock:
+            with self.lock:
+                reloaded = self.known.get(name, 0) >= version
+            if not reloaded:
+                apply()
+            self.note_local(name, version)
+
+    def read_versions(self):
+        with db_pool.connection("shared_sync") as conn:
+            return dict(conn.execute("SELECT name, version FROM SharedVersions").fetchall())
+
+    # Start the sync thread in this process (after fork; see InventoryStore.load)
+    def start(self):
+        if self.syncer is not None:
+            return
+        with self.lock:
+            if self.syncer is None:
+                self.known = self.read_versions()
+                self.syncer = threading.Thread(target=self.sync_forever, name="shared-state-sync", daemon=True)
+                self.syncer.start()
+
+    def sync_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except sqlite3.Error as e:
+                print(f"[!] Shared state sync failed: {e}")
+
+    # Catch up with other processes' changes; subscribers hear only about products whose
+    # stock or held quantity actually changed. The products are read in the same snapshot as
+    # the versions, so the reload is exactly as of versions["stock"]; it is installed under the
+    # inventory lock only if it isn't older than the cache (see write_through).
+    def sync(self):
+        versions = self.read_versions()
+        with self.lock:
+            stale = {name for name, version in versions.items() if self.known.get(name) != version}
+        if not stale:
+            return
+        products = None
+        if "stock" in stale:
+            with db_pool.connection("shared_sync") as conn:
+                conn.execute("BEGIN")
+                versions = dict(conn.execute("SELECT name, version FROM SharedVersions").fetchall())
+                products = inventory_store.fetch(conn)
+                conn.rollback()
+            sales_analytics.invalidate()   # Another worker may have recorded sales
+        with inventory_store.lock:
+            # Held totals as last read, not re-read: the database may already include the new holds
+            before = self.snapshot(reservation_book.totals[1])
+            with self.lock:
+                if products is not None and versions["stock"] >= self.known.get("stock", 0):
+                    inventory_store.install(products)
+                for name, version in versions.items():
+                    self.known[name] = max(version, self.known.get(name, 0))
+        after = self.snapshot(reservation_book.reserved_totals())
+        stock_events.publish([pid for pid in before.keys() | after.keys() if before.get(pid) != after.get(pid)])
+
+    # {productID: (stock, units held)} given the held totals
+    def snapshot(self, reserved):
+        return {pid: (product.stock, reserved.get(pid, 0)) for pid, product in inventory_store.load().items()}
+
+
+# Cart holds kept in SQLite so every worker process sees the same reserved totals.
+# Same interface as ReservationBook; holders are prefixed with the process ID.
+class SQLiteReservationBook:
+    def __init__(self, ttl=15 * 60, reap_interval=30):
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.totals = (None, {})    # (holds version, {productID: quantity held}) as last read
+
+    def key(self, holder):
+        return f"{os.getpid()}:{holder}"
+
+    # Holds version this process has caught up with (advanced by SharedState)
+    @property
+    def version(self):
+        return shared_state.known.get("holds", 0)
+
+    # Held totals, re-read only when the holds version moves (every listing render asks).
+    # Expired holds keep counting until the reaper deletes them, which bumps the version.
+    def reserved_totals(self):
+        version = self.version      # Read first: the totals below are at least this new
+        cached_version, totals = self.totals
+        if cached_version != version:
+            with db_pool.connection("holds") as conn:
+                totals = dict(conn.execute("SELECT productID, SUM(quantity) FROM Reservations WHERE expiresAt > ? "
+                                           "GROUP BY productID", (time.time(),)).fetchall())
+            self.totals = (version, totals)
+        return dict(totals)
+
+    def reserved_qty(self, pid):
+        with db_pool.connection("holds") as conn:
+            return conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM Reservations "
+                                "WHERE productID = ? AND expiresAt > ?", (pid, time.time())).fetchone()[0]
+
+    def available(self, pid, stock):
+        return max(stock - self.reserved_qty(pid), 0)
+
+    def held(self, holder, pid):
+        with db_pool.connection("holds") as conn:
+            row = conn.execute("SELECT quantity FROM Reservations WHERE holder = ? AND productID = ? AND expiresAt > ?",
+                               (self.key(holder), pid, time.time())).fetchone()
+        return row[0] if row else 0
+
+    # Hold `qty` more units if the database stock minus every process's holds allows it.
+    # `stock` (this process's cached value) is ignored in favour of the committed stock.
+    def reserve(self, holder, pid, qty, stock):
+        if qty <= 0:
+            return False
+        self.start_reaper()
+        now = time.time()
+        with db_pool.connection("reserve") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT stock FROM Products WHERE productID = ?", (pid,)).fetchone()
+            reserved = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM Reservations "
+                                    "WHERE productID = ? AND expiresAt > ?", (pid, now)).fetchone()[0]
+            if row is None or row[0] - reserved < qty:
+                conn.rollback()
+                return False
+            conn.execute("""
+                INSERT INTO Reservations (holder, productID, quantity, expiresAt) VALUES (?, ?, ?, ?)
+                ON CONFLICT (holder, productID) DO UPDATE SET
+                    quantity = (CASE WHEN expiresAt > ? THEN quantity ELSE 0 END) + excluded.quantity,
+                    expiresAt = excluded.expiresAt
+            """, (self.key(holder), pid, qty, now + self.ttl, now))
+            version = shared_state.bump(conn, "holds")
+            conn.commit()
+        shared_state.note_local("holds", version)
+        stock_events.publish((pid,))
+        return True
+
+    def release(self, holder, pid, qty=None):
+        if qty is not None and qty <= 0:
+            return 0
+        key = self.key(holder)
+        with db_pool.connection("release") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT quantity FROM Reservations WHERE holder = ? AND productID = ? AND expiresAt > ?",
+                               (key, pid, time.time())).fetchone()
+            if row is None:
+                conn.rollback()
+                return 0
+            released = row[0] if qty is None else min(qty, row[0])
+            if released == row[0]:
+                conn.execute("DELETE FROM Reservations WHERE holder = ? AND productID = ?", (key, pid))
+            else:
+                conn.execute("UPDATE Reservations SET quantity = quantity - ?, expiresAt = ? "
+                             "WHERE holder = ? AND productID = ?", (released, time.time() + self.ttl, key, pid))
+            version = shared_state.bump(conn, "holds")
+            conn.commit()
+        shared_state.note_local("holds", version)
+        stock_events.publish((pid,))
+        return released
+
+    def release_all(self, holder):
+        self.delete_holds("holder = ?", (self.key(holder),))
+
+    def reap(self):
+        self.delete_holds("expiresAt <= ?", (time.time(),))
+
+    # Delete matching holds in one transaction, bumping the version only if any existed
+    def delete_holds(self, where, args):
+        with db_pool.connection("release") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            pids = [row[0] for row in conn.execute(f"DELETE FROM Reservations WHERE {where} RETURNING productID",
+                                                   args).fetchall()]
+            if not pids:
+                conn.rollback()
+                return
+            version = shared_state.bump(conn, "holds")
+            conn.commit()
+        shared_state.note_local("holds", version)
+        stock_events.publish(pids)
+
+    start_reaper = ReservationBook.start_reaper
+    reap_forever = ReservationBook.reap_forever
+
+
+# Failed-login counts kept in SQLite, so a lockout applies across every worker process
+# instead of each worker allowing its own max_failures guesses. Same interface as
+# auth.LoginFailures; wall-clock times because the rows are shared between processes.
+class SQLiteLoginFailures:
+    def __init__(self, max_failures=5, lockout=60, window=60 * 60):
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.window = window        # Failures older than this are forgotten
+
+    def locked(self, username):
+        with db_pool.connection("login_failures") as conn:
+            row = conn.execute("SELECT lockedUntil FROM LoginFailures WHERE username = ?", (username,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def record_failure(self, username):
+        now = time.time()
+        with db_pool.connection("login_failures") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM LoginFailures WHERE lastFailure < ? AND lockedUntil < ?",
+                         (now - self.window, now))
+            failures = conn.execute("""
+                INSERT INTO LoginFailures (username, failures, lockedUntil, lastFailure) VALUES (?, 1, 0, ?)
+                ON CONFLICT (username) DO UPDATE SET failures = failures + 1, lastFailure = excluded.lastFailure
+                RETURNING failures
+            """, (username, now)).fetchone()[0]
+            if failures >= self.max_failures:
+                conn.execute("UPDATE LoginFailures SET failures = 0, lockedUntil = ? WHERE username = ?",
+                             (now + self.lockout, username))
+                metrics.increment("auth.lockouts")
+            conn.commit()
+
+    def clear(self, username):
+        with db_pool.connection("login_failures") as conn:
+            conn.execute("DELETE FROM LoginFailures WHERE username = ?", (username,))
+            conn.commit()
+
+
+# Set when the server runs several worker processes; see configure_shared_state
+shared_state = None
+
+
+# Switch this process (before forking workers) to SQLite-coordinated inventory, holds and
+# login lockouts. Holds and failure counts left over from a previous run are dropped.
+def configure_shared_state(sync_interval=0.25):
+    global shared_state, reservation_book
+    with sqlite3.connect(db_pool.path, timeout=db_pool.timeout) as conn:
+        conn.executescript(SHARED_STATE_SCHEMA)
+        conn.execute("DELETE FROM Reservations")
+        conn.execute("DELETE FROM LoginFailures")
+    conn.close()
+    shared_state = SharedState(sync_interval)
+    reservation_book = SQLiteReservationBook()
+    failures = credential_cache.failures
+    credential_cache.failures = SQLiteLoginFailures(failures.max_failures, failures.lockout)
+
+
+# Drop every hold owned by a worker process that has exited (called by the supervisor)
+def release_worker_holds(pid):
+    with sqlite3.connect(db_pool.path, timeout=db_pool.timeout) as conn:
+        if conn.execute("DELETE FROM Reservations WHERE holder LIKE ?", (f"{pid}:%",)).rowcount:
+            conn.execute("UPDATE SharedVersions SET version = version + 1 WHERE name = 'holds'")
+    conn.close()
+
+
+JOURNAL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS JournalCheckpoint (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL);
+    INSERT OR IGNORE INTO JournalCheckpoint (id, seq) VALUES (0, 0);
+"""
+
+# Set when checkouts and stock edits go through a write-behind journal; see configure_journal
+transaction_journal = None
+
+
+# Write a batch of journal entries to the database in one transaction, in journal order,
+# together with the checkpoint that keeps them from being replayed. Entries are either
+# a sale {"at", "user", "sales": [[productID, qty, total], ...]} or a stock level
+# {"stock": [[productID, qty]]}; consecutive sales are written in bulk.
+def apply_journal_entries(entries):
+    with db_pool.connection("journal_flush") as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        sales = []
+        for entry in entries:
+            if "stock" in entry:
+                record_journaled_sales(cur, sales)   # Earlier sales first; the new level replaces their result
+                sales = []
+                cur.executemany("UPDATE Products SET stock = ? WHERE productID = ?",
+                                [(qty, pid) for pid, qty in entry["stock"]])
+            else:
+                sales.extend((pid, qty, total, entry["user"], entry["at"]) for pid, qty, total in entry["sales"])
+        record_journaled_sales(cur, sales)
+        cur.execute("UPDATE JournalCheckpoint SET seq = ? WHERE id = 0", (entries[-1]["seq"],))
+        conn.commit()
+    sales_analytics.invalidate()
+
+
+# Send checkouts and stock edits through a write-behind journal at `path`. Only valid in a
+# single server process: the in-memory stock becomes the authority that checkouts are
+# checked against. Entries a previous run journaled but never applied are replayed first.
+def configure_journal(path, flush_interval=0.05):
+    global transaction_journal
+    with db_pool.connection("journal_open") as conn:
+        conn.executescript(JOURNAL_SCHEMA)
+        applied_seq = conn.execute("SELECT seq FROM JournalCheckpoint WHERE id = 0").fetchone()[0]
+    transaction_journal = TransactionJournal(path, apply_journal_entries, flush_interval)
+    transaction_journal.open(applied_seq)
+    return transaction_journal
+
+
 # Handles operations related to the shopping cart
 class Cart:
-    def __init__(self):
-        # Cart items: key = productID, value = Product object holding quantity and unit price
+    def __init__(self, reservations=None):
+        # Cart items: key = productID, value = CartLine holding quantity and unit price
         self.cart = {}
+        self.total_cents = 0           # Running cart total, updated on every add/remove
+        self.reservations = reservations or reservation_book
+        self.holder = next(cart_ids)   # Identifies this cart's holds in the reservation book
 
     # Add a product to the cart if stock is sufficient
     def add_item(self, product_id, quantity, inventory):
+        if quantity <= 0:
+            return "Quantity must be at least 1."
         if product_id in inventory:
             product = inventory[product_id]
 
-            if product.stock >= quantity:
-                product.stock -= quantity  # Decrement from inventory stock
-
-                if product_id not in self.cart:
+            # Reserve centrally so other sessions see the stock as taken
+            if self.reservations.reserve(self.holder, product_id, quantity, product.stock):
+                line = self.cart.get(product_id)
+                if line is None:
                     # Store new item in cart with unit price
-                    self.cart[product_id] = Product(product_id, product.name, product.price, quantity)
+                    line = self.cart[product_id] = CartLine(product_id, product.name, product.price, quantity)
                 else:
                     # Update existing item in cart
-                    existing = self.cart[product_id]
-                    existing.stock += quantity  # stock = quantity in cart
+                    line.qty += quantity
+                self.total_cents += line.cents * quantity
 
                 return f"{quantity} units of '{product.name}' added to cart."
             else:
@@ -42,180 +878,400 @@ class Cart:
         else:
             return f"Product ID '{product_id}' does not exist."
 
-    # Remove a quantity of item from cart, and restore it to inventory
+    # Remove a quantity of item from cart, making it available again
     def remove_item(self, product_id, quantity, inventory):
+        if quantity <= 0:
+            return "Quantity must be at least 1."
         if product_id not in self.cart:
             return f"Product ID '{product_id}' is not in the cart."
 
         cart_item = self.cart[product_id]
 
-        if quantity >= cart_item.stock:
-            removed_quantity = cart_item.stock
+        if quantity >= cart_item.qty:
+            removed_quantity = cart_item.qty
             del self.cart[product_id]
+            self.reservations.release(self.holder, product_id)
         else:
-            cart_item.stock -= quantity
+            cart_item.qty -= quantity
             removed_quantity = quantity
+            self.reservations.release(self.holder, product_id, quantity)
+        self.total_cents -= cart_item.cents * removed_quantity
 
-        inventory[product_id].stock += removed_quantity  # Restore to inventory
-        return f"{removed_quantity} units of '{inventory[product_id].name}' removed from cart."
+        return f"{removed_quantity} units of '{cart_item.name}' removed from cart."
+
+    # Cart lines as (productID, name, line total, quantity) rows in the given currency
+    def cart_rows(self, rate=1.0):
+        return [(pid, line.name, round(line.price * line.qty * rate, 2), line.qty)
+                for pid, line in self.cart.items()]
 
     # Display the contents of the cart
     def view_items(self, rate=1.0, currency="USD"):
         if not self.cart:
             return "Cart is empty."
-        output = f"Cart (Prices in {currency.upper()}):\n"
-        output += f"{'ProductID':<10} {'Name':<30} {'Total':<10} {'Qty':<6}\n"
-        output += "-" * 50 + "\n"
-        for pid, product in self.cart.items():
-            converted = product.price * product.stock * rate  # Total = unit price × quantity × exchange rate
-            output += f"{pid:<10} {product.name:<30} {currency.upper()}{converted:<9.2f} {product.stock:<6}\n"
-        return output
-
-    # Calculate total price of items in cart (without currency conversion)
+        currency = currency.upper()
+        lines = [f"Cart (Prices in {currency}):",
+                 f"{'ProductID':<10} {'Name':<30} {'Total':<10} {'Qty':<6}",
+                 "-" * 50]
+        # Total = unit price × quantity × exchange rate
+        lines.extend(f"{pid:<10} {line.name:<30} {currency}{line.price * line.qty * rate:<9.2f} {line.qty:<6}"
+                     for pid, line in self.cart.items())
+        lines.append("")
+        return "\n".join(lines)
+
+    # Total price of items in cart (without currency conversion), from the running total
     def calculate_total(self):
-        return sum(product.price * product.stock for product in self.cart.values())
+        return self.total_cents / 100
+
+    # Re-reserve lines whose holds expired; returns the lines that could no longer be held
+    def renew_reservations(self, inventory):
+        missing = []
+        for pid, item in self.cart.items():
+            shortfall = item.qty - self.reservations.held(self.holder, pid)
+            if shortfall > 0:
+                stock = inventory[pid].stock if pid in inventory else 0
+                if not self.reservations.reserve(self.holder, pid, shortfall, stock):
+                    missing.append(item)
+        return missing
+
+    # Give every held unit back to the shared pool (e.g. when the session ends)
+    def release_reservations(self):
+        self.reservations.release_all(self.holder)
 
     # Empty the cart
     def clear_cart(self):
+        self.release_reservations()
         if self.cart:
             self.cart.clear()
+            self.total_cents = 0
             print("The cart was cleared.")
         else:
             print("The cart is already empty.")
 
+# Process-wide product cache shared by every session. Reads are plain dictionary
+# lookups; writes go to SQLite first and are then applied here, bumping `version`.
+class InventoryStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.products = None
+        self.version = 0
+
+    # Load products from the database on first use
+    def load(self):
+        with self.lock:
+            if self.products is None:
+                self.reload()
+        if shared_state is not None:
+            shared_state.start()
+        return self.products
+
+    # Replace the cache with a fresh copy of the Products table
+    def reload(self):
+        with db_pool.connection("load_products") as conn:
+            self.install(self.fetch(conn))
+
+    # {productID: Product} read through `conn`
+    def fetch(self, conn):
+        inventory = {}
+        for pid, name, price, stock in conn.execute("SELECT * FROM Products").fetchall():
+            inventory[pid] = Product(pid, name, float(price), int(stock))
+        return inventory
+
+    def install(self, inventory):
+        with self.lock:
+            self.products = inventory
+            self.version += 1
+
+    # Apply committed stock decrements ({productID: quantity sold})
+    def apply_sale(self, quantities):
+        with self.lock:
+            for pid, qty in quantities.items():
+                if pid in self.products:
+                    self.products[pid].stock -= qty
+            self.version += 1
+        stock_events.publish(list(quantities))
+
+    # Apply a committed absolute stock level
+    def set_stock(self, pid, qty):
+        with self.lock:
+            if pid in self.products:
+                self.products[pid].stock = qty
+                self.version += 1
+        stock_events.publish((pid,))
+
+
+# Shared by all VendingMachine instances in this process
+inventory_store = InventoryStore()
+
+
+# Rendered product listings shared by every session, keyed by (format, currency, rate) and
+# valid while the inventory and cart-hold versions they were rendered at are current. Each
+# listing carries an ETag (a hash of its text), so the ETag only changes when the listing
+# does and stays meaningful across worker processes and restarts.
+class ListingCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # key -> (data version, etag, listing), least recently used first
+
+    # Return (etag, listing) for `key`, calling render() only if the data changed since last time
+    def get(self, key, render):
+        version = (inventory_store.version, reservation_book.version)   # Read first: a render is never older
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                metrics.increment("listing.cache_hit")
+                return entry[1], entry[2]
+        metrics.increment("listing.cache_miss")
+        listing = render()
+        etag = hashlib.blake2b(listing.encode("utf-8"), digest_size=8).hexdigest()
+        with self.lock:
+            self.entries[key] = (version, etag, listing)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag, listing
+
+
+# Shared by every session in this process
+listing_cache = ListingCache()
+
+
 # Manages inventory, transactions, and currency conversions
 class VendingMachine:
     def __init__(self, currency="usd"):
         self.default_currency = "usd"
         self.target_currency = currency
         self.rate = self.get_currency_exchange()
-        self.inventory = self.load_inventory()
-
-    # Get exchange rate from USD to target currency
-    def get_currency_exchange(self):
-        if self.target_currency != "usd":
-            url = f"https://exchangerate.guru/{self.default_currency}/{self.target_currency}"
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            article = soup.find("article", class_="conversion-essense")
-            rate_paragraph = article.find("p").text.strip()
-            match = re.search(r"=\s*([\d.]+)", rate_paragraph)
-            if match:
-                return float(match.group(1))
-            print("Rate not found")
-            return 1
-        return 1
-
-    # Load inventory from database into a dictionary of Product objects
+        self.store = inventory_store
+        self.store.load()
+
+    # Products keyed by productID, shared with every other session
+    @property
+    def inventory(self):
+        return self.store.load()
+
+    # Get exchange rate from USD to the target currency (or `currency` if given) from the shared rate cache
+    def get_currency_exchange(self, currency=None):
+        return rates.rate_cache.get_rate(currency or self.target_currency, self.default_currency)
+
+    # Return the shared inventory; the store is kept current by write-through, so no query is needed
     def load_inventory(self):
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM Products")
-        products = cur.fetchall()
-        conn.close()
-        inventory = {}
-        for product in products:
-            pid, name, price, stock = product
-            inventory[pid] = Product(pid, name, float(price), int(stock))
-        return inventory
+        return self.store.load()
 
-    # Reload the latest inventory from database
+    # Kept for callers that expect to refresh before reading; the shared store is already current
     def refresh_inventory(self):
-        self.inventory = self.load_inventory()
-
-    # Display all available products with currency conversion applied
-    def display_products(self, cart=None):
-        message = f"{'ProductID':<10} {'Name':<30} {'Price':<15} {'Stock':<6}\n"
-        message += "-" * 70 + "\n"
+        return self.store.load()
 
-        for pid, product in self.inventory.items():
-            # Subtract reserved quantity if item exists in cart
-            reserved_qty = 0
-            if cart and pid in cart.cart:
-                reserved_qty = cart.cart[pid].stock  # quantity reserved in cart
-            effective_stock = product.stock - reserved_qty
+    # Products as (productID, name, converted price, available stock) rows
+    def product_rows(self):
+        reserved = reservation_book.reserved_totals()
+        return [(pid, product.name, round(product.price * self.rate, 2), max(product.stock - reserved.get(pid, 0), 0))
+                for pid, product in self.inventory.items()]
 
-            converted_price = product.price * self.rate
-            message += f"{pid:<10} {product.name:<30} ({self.target_currency.upper()}) {converted_price:<9.2f} {max(effective_stock, 0):<6}\n"
-        return message
+    # Display all available products with currency conversion applied
+    def display_products(self):
+        currency = self.target_currency.upper()
+        rate = self.rate
+        reserved = reservation_book.reserved_totals()
+        lines = [f"{'ProductID':<10} {'Name':<30} {'Price':<15} {'Stock':<6}", "-" * 70]
+        lines.extend(f"{pid:<10} {product.name:<30} ({currency}) {product.price * rate:<9.2f} "
+                     f"{max(product.stock - reserved.get(pid, 0), 0):<6}"
+                     for pid, product in self.inventory.items())
+        lines.append("")
+        return "\n".join(lines)
 
     # Create a receipt string from the cart contents
     def generate_receipt(self, cart):
-        receipt = "\n" + "=" * 80 + "\n"
-        receipt += " " * 12 + "PURCHASE RECEIPT\n"
-        receipt += "=" * 40 + "\n"
-        receipt += f"{'ProductID':<10} {'Name':<15} {'Qty':<5} {'Total':<8}\n"
-        receipt += "-" * 40 + "\n"
-        for pid, product in cart.cart.items():
-            converted_price = product.price * self.rate
-            receipt += f"{pid:<10} {product.name:<15} {product.stock:<5} {self.target_currency.upper()}{converted_price:<7.2f}\n"
-        receipt += "-" * 40 + "\n"
-        total = cart.calculate_total() * self.rate
-        receipt += f"{'TOTAL':>32} : {self.target_currency.upper()}{total:.2f}\n"
-        receipt += "=" * 40 + "\n"
-        receipt += "Thank you for your purchase!\n"
-        receipt += "=" * 40 + "\n"
-        return receipt
-
-    # Finalize checkout: update inventory, save transaction, clear cart
+        currency = self.target_currency.upper()
+        rate = self.rate
+        lines = ["", "=" * 80, " " * 12 + "PURCHASE RECEIPT", "=" * 40,
+                 f"{'ProductID':<10} {'Name':<15} {'Qty':<5} {'Total':<8}", "-" * 40]
+        lines.extend(f"{pid:<10} {line.name:<15} {line.qty:<5} {currency}{line.price * rate:<7.2f}"
+                     for pid, line in cart.cart.items())
+        total = cart.calculate_total() * rate
+        lines += ["-" * 40, f"{'TOTAL':>32} : {currency}{total:.2f}", "=" * 40,
+                  "Thank you for your purchase!", "=" * 40, ""]
+        return "\n".join(lines)
+
+    # Finalize checkout in a single transaction: every stock decrement and transaction row
+    # commits together or not at all. A decrement only applies while enough stock remains,
+    # so concurrent checkouts can't oversell; on a shortfall the cart is left untouched.
     def checkout(self, cart, username):
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
-        for pid, item in cart.cart.items():
-            cur.execute("UPDATE Products SET stock = stock - ? WHERE productID = ?", (item.stock, pid))
-        conn.commit()
-        conn.close()
-        self.inventory = self.load_inventory()
-        self.save_transactions(cart, username)
+        expired = cart.renew_reservations(self.inventory)
+        if expired:
+            names = ", ".join(f"'{item.name}'" for item in expired)
+            return f"Checkout failed: reservation expired and stock is no longer available for {names}."
+        if transaction_journal is not None:
+            return self.checkout_journaled(cart, username)
+
+        lines = [(pid, item.qty) for pid, item in cart.cart.items()]
+        with db_pool.connection("checkout") as conn:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.executemany("UPDATE Products SET stock = stock - ? WHERE productID = ? AND stock >= ?",
+                            [(qty, pid, qty) for pid, qty in lines])
+            if cur.rowcount != len(lines):
+                conn.rollback()
+                return self.describe_shortfall(conn, cart)
+            record_sales(cur, self.transaction_records(cart, username))
+            version = shared_state.bump(conn, "stock") if shared_state else None
+            conn.commit()
+        sales_analytics.invalidate()
+        if shared_state:
+            shared_state.write_through("stock", version, lambda: self.store.apply_sale(dict(lines)))
+        else:
+            self.store.apply_sale(dict(lines))
+        cart.clear_cart()
+        return "\nPurchase completed and saved!"
+
+    # Write-behind checkout: the cart is checked against the in-memory stock and the sale is
+    # appended to the journal under the store lock, so the two can't interleave with another
+    # checkout. The reply waits only for the journal fsync (shared with concurrent checkouts);
+    # the flusher writes the sale to SQLite shortly after.
+    def checkout_journaled(self, cart, username):
+        lines = {pid: item.qty for pid, item in cart.cart.items()}
+        sale = {"at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()), "user": username,
+                "sales": [[pid, qty, total] for pid, qty, total, _ in self.transaction_records(cart, username)]}
+        seq = None
+        try:
+            with self.store.lock:
+                inventory = self.store.load()
+                stock = {pid: inventory[pid].stock if pid in inventory else 0 for pid in lines}
+                if any(stock[pid] < qty for pid, qty in lines.items()):
+                    return self.shortfall_message(cart, stock)
+                seq = transaction_journal.append(sale)
+                self.store.apply_sale(lines)
+            transaction_journal.wait_durable(seq)
+        except OSError as e:
+            if seq is not None:     # Already taken off the in-memory stock; put it back
+                self.store.apply_sale({pid: -qty for pid, qty in lines.items()})
+            print(f"[!] Checkout by {username} could not be journaled: {e}")
+            return "Checkout failed: the sale could not be recorded, please try again later."
         cart.clear_cart()
         return "\nPurchase completed and saved!"
 
+    # Explain which cart lines couldn't be filled after a failed checkout
+    def describe_shortfall(self, conn, cart):
+        placeholders = ",".join("?" * len(cart.cart))
+        stock = dict(conn.execute(f"SELECT productID, stock FROM Products WHERE productID IN ({placeholders})",
+                                  list(cart.cart)).fetchall())
+        return self.shortfall_message(cart, stock)
+
+    # Shortfall explanation given the stock ({productID: units}) the cart was checked against
+    def shortfall_message(self, cart, stock):
+        failed = [f"'{item.name}' (requested {item.qty}, available {stock.get(pid, 0)})"
+                  for pid, item in cart.cart.items() if stock.get(pid, 0) < item.qty]
+        if not failed:
+            return "Checkout failed: stock changed during checkout, please try again."
+        return "Checkout failed: not enough stock for " + ", ".join(failed) + "."
+
     # Manually update product stock
     def update_stock(self, pid, qty):
-        con = sqlite3.connect("vending_machine.db")
-        cur = con.cursor()
-        cur.execute("UPDATE Products SET stock = ? WHERE productID = ?", (qty, pid))
-        con.commit()
-        con.close()
-        self.inventory = self.load_inventory()
+        if transaction_journal is not None:
+            seq = None
+            try:
+                with self.store.lock:   # Ordered with checkouts, which are journaled under the same lock
+                    product = self.store.load().get(pid)
+                    previous = product.stock if product else None
+                    seq = transaction_journal.append({"stock": [[pid, qty]]})
+                    self.store.set_stock(pid, qty)
+                transaction_journal.wait_durable(seq)
+            except OSError as e:
+                if seq is not None and previous is not None:    # Undo the in-memory change
+                    self.store.set_stock(pid, previous)
+                print(f"[!] Stock change for product {pid} could not be journaled: {e}")
+                raise OSError("the change could not be recorded, please try again later") from e
+            return "Stock updated successfully."
+
+        with db_pool.connection("update_stock") as con:
+            con.execute("UPDATE Products SET stock = ? WHERE productID = ?", (qty, pid))
+            version = shared_state.bump(con, "stock") if shared_state else None
+            con.commit()
+        if shared_state:
+            shared_state.write_through("stock", version, lambda: self.store.set_stock(pid, qty))
+        else:
+            self.store.set_stock(pid, qty)
         return "Stock updated successfully."
 
+    # CartTransactions rows for each cart line; totalPrice is the line total (unit price × quantity)
+    def transaction_records(self, cart, username):
+        return [(item.id, item.qty, item.price * item.qty, username) for item in cart.cart.values()]
+
     # Save a record of the current cart transaction to the database
     def save_transactions(self, cart, username):
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
-        for item in cart.cart.values():
-            cur.execute("""
-                INSERT INTO CartTransactions (productID, quantity, totalPrice, username)
-                VALUES (?, ?, ?, ?)
-            """, (item.id, item.stock, item.price, username))
-        conn.commit()
-        conn.close()
+        with db_pool.connection("save_transactions") as conn:
+            record_sales(conn.cursor(), self.transaction_records(cart, username))
+            conn.commit()
+        sales_analytics.invalidate()
         return "Transaction recorded."
 
+    # Fetch the most recent transactions as (productID, name, qty, converted total, date, username) rows
+    def transaction_rows(self, limit=20):
+        with db_pool.connection("history") as conn:
+            transactions = conn.execute("""
+                        SELECT t.productID, p.productName, t.quantity, t.totalPrice, t.transactionDate, t.username
+                        FROM CartTransactions t
+                                 JOIN Products p ON t.productID = p.productID
+                        ORDER BY t.transactionDate DESC LIMIT ?
+                        """, (limit,)).fetchall()
+        return [(pid, name, qty, round(total * self.rate, 2), date, username)
+                for pid, name, qty, total, date, username in transactions]
+
+    # One page of transaction history, newest first, using keyset pagination on
+    # (transactionDate, transactionID) so each page costs the same however deep it is.
+    # Returns (rows like transaction_rows, cursor for the next page or None at the end).
+    def transaction_page(self, after=None, limit=100, username=None, product_id=None, date_from=None, date_to=None):
+        conditions, params = [], []
+        if after:
+            conditions.append("(t.transactionDate, t.transactionID) < (?, ?)")
+            params.extend(decode_history_cursor(after))
+        if username:
+            conditions.append("t.username = ?")
+            params.append(username)
+        if product_id is not None:
+            conditions.append("t.productID = ?")
+            params.append(product_id)
+        if date_from:
+            conditions.append("t.transactionDate >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("t.transactionDate < date(?, '+1 day')")  # Inclusive of the whole end day
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with db_pool.connection("history_page") as conn:
+            cur = conn.execute(f"""
+                SELECT t.transactionID, t.productID, p.productName, t.quantity, t.totalPrice, t.transactionDate, t.username
+                FROM CartTransactions t
+                         JOIN Products p ON t.productID = p.productID
+                {where}
+                ORDER BY t.transactionDate DESC, t.transactionID DESC LIMIT ?
+            """, (*params, limit + 1))
+            transactions = cur.fetchmany(limit + 1)   # One extra row tells us whether another page exists
+
+        next_cursor = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            last = transactions[-1]
+            next_cursor = encode_history_cursor(last[5], last[0])
+        rows = [(pid, name, qty, round(total * self.rate, 2), date, user)
+                for _, pid, name, qty, total, date, user in transactions]
+        return rows, next_cursor
+
     # Retrieve and display recent transaction history
     def get_transaction_history(self):
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
-        cur.execute("""
-                    SELECT t.productID, p.productName, t.quantity, t.totalPrice, t.transactionDate, t.username
-                    FROM CartTransactions t
-                             JOIN Products p ON t.productID = p.productID
-                    ORDER BY t.transactionDate DESC LIMIT 20
-                    """)
-        transactions = cur.fetchall()
-        conn.close()
+        transactions = self.transaction_rows()
         if not transactions:
             return "No previous transactions found."
 
-        output = "\nRecent Transactions:\n"
-        output += f"{'ProductID':<10} {'Name':<25} {'Qty':<5} {'Total':<10} {'Date':<20} {'User'}\n"
-        output += "-" * 80 + "\n"
-        for row in transactions:
-            pid, name, qty, total, date, username = row
-            converted = total * self.rate
-            output += f"{pid:<10} {name:<25} {qty:<5} {self.target_currency.upper()}{converted:<9.2f} {date:<20} {username}\n"
-        return output
+        currency = self.target_currency.upper()
+        lines = ["", "Recent Transactions:",
+                 f"{'ProductID':<10} {'Name':<25} {'Qty':<5} {'Total':<10} {'Date':<20} {'User'}", "-" * 80]
+        lines.extend(f"{pid:<10} {name:<25} {qty:<5} {currency}{converted:<9.2f} {date:<20} {username}"
+                     for pid, name, qty, converted, date, username in transactions)
+        lines.append("")
+        return "\n".join(lines)
 
 
 # Handles user login authentication
@@ -225,9 +1281,44 @@ class UserAuth:
         self.password = password
         self.user = (username, password)
 
-    # Check user credentials against Users table
+    # Check user credentials. Logins verified recently against the current stored hash are
+    # answered from the credential cache (so a password change takes effect immediately);
+    # otherwise the stored salted hash is checked, and legacy plaintext passwords are
+    # replaced by a hash the first time they verify. Locked-out usernames always fail.
     def authentication(self):
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM Users WHERE username=? AND password=?", (self.username, self.password))
-        return cur.fetchone() is not None
+        if credential_cache.locked(self.username):
+            metrics.increment("auth.locked")
+            return False
+        if credential_cache.check(self.username, self.password, self.stored_password()):
+            metrics.increment("auth.cache_hit")
+            return True
+
+        with credential_cache.verify_lock(self.username):
+            stored = self.stored_password()     # Re-read: it may have been upgraded while we waited
+            if credential_cache.check(self.username, self.password, stored):   # Verified while we waited
+                metrics.increment("auth.cache_hit")
+                return True
+            metrics.increment("auth.cache_miss")
+            matches, needs_rehash = verify_password(self.password, stored)
+            if not matches:
+                credential_cache.record_failure(self.username)
+                return False
+            if needs_rehash:
+                stored = self.store_hash(stored)
+            credential_cache.record_success(self.username, self.password, stored)
+            return True
+
+    def stored_password(self):
+        with db_pool.connection("auth") as conn:
+            row = conn.execute("SELECT password FROM Users WHERE username=?", (self.username,)).fetchone()
+        return row[0] if row else None
+
+    # Replace the stored password with a salted hash, unless it changed since it was read.
+    # Returns the value now stored.
+    def store_hash(self, previous):
+        hashed = hash_password(self.password)
+        with db_pool.connection("auth_upgrade") as conn:
+            cursor = conn.execute("UPDATE Users SET password=? WHERE username=? AND password=?",
+                                  (hashed, self.username, previous))
+            conn.commit()
+        return hashed if cursor.rowcount == 1 else previous
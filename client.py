@@ -1,4 +1,11 @@
-from socket import AF_INET, SOCK_STREAM, socket
+import json
+import select
+from collections import OrderedDict, deque
+from socket import AF_INET, IPPROTO_TCP, SOCK_STREAM, TCP_NODELAY, socket
+
+from protocol import (PROTOCOL_ACK, BUSY_REPLY, FLAG_PUSH, SUBSCRIBE_COMMAND, RESUME_COMMAND, VIEW_COMMAND,
+                      IF_NONE_MATCH, NOT_MODIFIED, ETAG, encode_frame, recv_frame, encode_batch, decode_table,
+                      decode_etag_reply, encode_hello, decode_ack)
 
 class Client:
     # Handles connection and communication with the server
@@ -8,18 +15,93 @@ class Client:
         self.ADDRESS = (self.HOST, self.PORT)
         self.BUFSIZE = 1024             # Max size for each message chunk
         self.client = None              # Socket connection object
+        self.framed = False             # True once the framed protocol is negotiated
+        self.compression = ("zlib",)    # Codecs to offer, preferred first; () turns compression off
+        self.codec = None               # Codec the server accepted for this connection
+        self.events = deque()           # Pushed event payloads received while waiting for replies
+        self.token = None               # Session token from the last successful login, for resume()
+        self.listings = OrderedDict()   # ETag -> product listing, for conditional VIEWs (newest last)
 
     def connect(self):
         # Establish connection to the server
         self.client = socket(AF_INET, SOCK_STREAM)
+        self.client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)  # Username and password go out back to back; don't let Nagle hold the second
         self.client.connect(self.ADDRESS)
 
-    def send_command(self, command):
-        # Sends a command to the server and receives the full response
+    def negotiate(self):
+        # Ask the server for the length-prefixed protocol (and compression) before logging in
+        self.client.sendall(encode_hello(self.compression).encode("utf-8"))
+        reply = self.client.recv(self.BUFSIZE).decode("utf-8").strip()
+        if reply.startswith(BUSY_REPLY):
+            self.client.close()
+            raise ConnectionRefusedError(reply[len(BUSY_REPLY):].strip() or "Server busy")
+        self.framed = reply.split()[:2] == PROTOCOL_ACK.split()
+        self.codec = decode_ack(reply) if self.framed else None
+        return self.framed
+
+    def login(self, username, password):
+        # Negotiate framing, send credentials and return True if accepted
+        if not self.client:
+            raise ConnectionError("Client not connected")
+
+        if not self.framed:
+            self.negotiate()
+        self.send(username)
+        self.send(password)
+        return self.accept_login(self.receive())
+
+    def resume(self, token=None):
+        # Log in again with a session token instead of the password; returns True if accepted
         if not self.client:
             raise ConnectionError("Client not connected")
 
-        self.client.send(command.encode("utf-8"))
+        if not self.framed:
+            self.negotiate()
+        self.send(f"{RESUME_COMMAND} {token or self.token}")
+        return self.accept_login(self.receive())
+
+    def accept_login(self, reply):
+        # Framed servers answer "True <token>"; keep the token for the next resume()
+        accepted, _, token = reply.partition(" ")
+        if accepted == "True":
+            self.token = token or self.token
+            return True
+        return False
+
+    def reconnect(self):
+        # Open a fresh connection and resume the session with the stored token
+        if self.token is None:
+            return False
+        try:
+            self.client.close()
+        except Exception:
+            pass
+        self.framed = False
+        self.codec = None
+        self.events.clear()
+        self.connect()
+        if self.resume():
+            return True
+        self.send("EXIT")
+        self.client.close()
+        return False
+
+    def send(self, message):
+        # Send one message without waiting for a reply
+        data = message.encode("utf-8")
+        if self.framed:
+            self.client.sendall(encode_frame(data, codec=self.codec))
+        else:
+            self.client.sendall(data)
+
+    def receive(self):
+        # Read one complete reply from the server
+        if self.framed:
+            while True:
+                flags, payload = recv_frame(self.client, self.codec)
+                if not flags & FLAG_PUSH:
+                    return payload.decode("utf-8")
+                self.events.append(payload.decode("utf-8"))
 
         data = b""
         while True:
@@ -29,3 +111,79 @@ class Client:
                 break
 
         return data.decode("utf-8")
+
+    def send_command(self, command):
+        # Sends a command to the server and receives the full response
+        if not self.client:
+            raise ConnectionError("Client not connected")
+
+        self.send(command)
+        return self.receive()
+
+    def send_batch(self, commands):
+        # Sends several commands in one round trip and returns their replies in order
+        reply = self.send_command(encode_batch(commands))
+        if reply.startswith(BUSY_REPLY):
+            return [reply] * len(commands)  # Turned away whole by a server that answers a batch with one BUSY
+        return json.loads(reply)
+
+    def view_command(self):
+        # VIEW made conditional on the newest listing received, so an unchanged listing costs a few bytes
+        if self.listings:
+            return f"{VIEW_COMMAND} {IF_NONE_MATCH} {next(reversed(self.listings))}"
+        return f"{VIEW_COMMAND} {IF_NONE_MATCH}"
+
+    def accept_view(self, reply):
+        # Turn a reply to view_command() into the listing text (None if a cached one went missing
+        # or the request was turned away as over the rate limit)
+        if reply.startswith(BUSY_REPLY):
+            return None
+        if reply.startswith(NOT_MODIFIED):
+            return self.listings.get(reply[len(NOT_MODIFIED) + 1:])
+        if not reply.startswith(ETAG + " "):
+            return reply    # Server without conditional VIEW support: the reply is the listing
+        etag, listing = decode_etag_reply(reply)
+        self.listings.pop(etag, None)
+        self.listings[etag] = listing
+        while len(self.listings) > 4:
+            self.listings.popitem(last=False)
+        return listing
+
+    def view(self):
+        # Current product listing, transferred only if it changed since the last call
+        return self.accept_view(self.send_command(self.view_command()))
+
+    def subscribe(self):
+        # Ask the server to push stock changes; collect them with poll_events()
+        return self.send_command(SUBSCRIBE_COMMAND)
+
+    def poll_events(self, timeout=0.0):
+        # Return pushed events received so far, waiting up to `timeout` seconds for new ones.
+        # Must not run concurrently with send_command on the same connection.
+        if self.framed and not self.events:
+            readable, _, _ = select.select([self.client], [], [], timeout)
+            while readable:
+                flags, payload = recv_frame(self.client, self.codec)
+                if flags & FLAG_PUSH:
+                    self.events.append(payload.decode("utf-8"))
+                readable, _, _ = select.select([self.client], [], [], 0)
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def history_page(self, after=None, limit=100, **filters):
+        # Fetches one page of history; filters: user, product, from, to (YYYY-MM-DD).
+        # Returns (table metadata, rows as dicts); table["next"] is the cursor for the next page.
+        options = {"after": after, "limit": limit, **filters}
+        args = " ".join(f"{key}={value}" for key, value in options.items() if value is not None)
+        return decode_table(self.send_command(f"HISTORY PAGE {args}"))
+
+    def iter_history(self, page_size=100, **filters):
+        # Yields history rows newest first, one page in memory at a time
+        cursor = None
+        while True:
+            table, rows = self.history_page(after=cursor, limit=page_size, **filters)
+            yield from rows
+            cursor = table.get("next")
+            if not cursor:
+                break
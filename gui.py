@@ -1,17 +1,22 @@
 import os
-import time
+import queue
+import re
+import threading
+from collections import OrderedDict
 import tkinter as tk
 from tkinter import simpledialog, messagebox, ttk
 from PIL import Image, ImageTk
-import sqlite3
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 
 from client import Client
+from protocol import decode_table
 
 # CORE APPLICATION LOGIC
 
+HISTORY_PAGE_SIZE = 50   # Transactions fetched per "Load Older" click
+
 # Handles login dialog and authentication with the server
 def login_prompt():
     global client, username
@@ -40,12 +45,17 @@ def login_prompt():
         login_root.destroy()
         return False
 
-    temp_client.client.send(username.encode("utf-8"))
-    temp_client.client.send(password.encode("utf-8"))
-    auth = temp_client.client.recv(temp_client.BUFSIZE).decode().strip()
+    try:
+        authenticated = temp_client.login(username, password)
+    except Exception as e:
+        messagebox.showerror("Connection Error", f"Login failed: {e}", parent=login_root)
+        temp_client.client.close()
+        login_root.destroy()
+        return False
 
     # Check if authentication was successful
-    if auth == "True":
+    if authenticated:
+        temp_client.send_batch(["FORMAT JSON", "SUBSCRIBE"])  # Structured rows, and push stock changes to us
         messagebox.showinfo("Login", "Login successful!", parent=login_root)
         login_root.destroy()
         client = temp_client
@@ -54,163 +64,513 @@ def login_prompt():
         messagebox.showerror("Login Failed", f"Invalid credentials.",
                              parent=login_root)
 
-    temp_client.client.send("EXIT".encode())
+    temp_client.send("EXIT")
     temp_client.client.close()
     login_root.destroy()
     return False
 
-# Sends a command to the server, retries if response seems incomplete or corrupted
-def send_command_safe(command):
-    try:
-        if client is None:
-            return "Error: Not connected to server"
-
-        response = client.send_command(command)
-
-        # Retry logic for suspicious responses
-        if command.strip().upper() in ["CHART", "HISTORY"] and (
-                "PNG" in response or "IDAT" in response or response.count("\n") < 2):
-            print("[WARN] Suspected corrupted response, retrying...")
-            response = client.send_command(command)
-
-        return response
+# Runs every server request on one background thread so the Tk main loop never blocks.
+# Replies are handed back to the Tk thread through root.after polling. A coalescable
+# request identical to the one submitted just before it (e.g. two quick VIEW clicks)
+# shares that request's reply instead of being sent again. While idle the worker also
+# collects stock events pushed by the server and hands them to `on_event`. If the
+# connection drops, the worker reconnects and resumes the session with its token.
+class NetworkWorker:
+    def __init__(self, tk_root, on_event=None, poll_ms=30, idle_poll=0.2):
+        self.root = tk_root
+        self.on_event = on_event
+        self.poll_ms = poll_ms
+        self.idle_poll = idle_poll      # Seconds between checks for pushed events when no request is queued
+        self.requests = queue.Queue()   # (key, callbacks) for the worker thread; None stops it
+        self.results = queue.Queue()    # (key, callbacks, reply, error, reconnected) for the Tk thread
+        self.pending = {}               # key -> callbacks of a coalescable request not yet answered
+        self.last_key = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="network-worker", daemon=True)
+        self.thread.start()
+        self.root.after(self.poll_ms, self.poll)
+
+    # Queue a request; `callback(reply)` runs on the Tk thread when it completes
+    def submit(self, kind, payload, callback, coalesce=False):
+        key = (kind, payload)
+        with self.lock:
+            if coalesce and key in self.pending and self.last_key == key:
+                self.pending[key].append(callback)
+                return
+            callbacks = [callback]
+            if coalesce:
+                self.pending[key] = callbacks
+            self.last_key = key
+        self.requests.put((key, callbacks))
+
+    # Worker thread: talk to the server one request at a time
+    def run(self):
+        while True:
+            try:
+                item = self.requests.get(timeout=self.idle_poll)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            try:
+                if client is None:
+                    raise ConnectionError("Not connected to server")
+                if item:
+                    key, callbacks = item
+                    kind, payload = key
+                    reply = client.send_batch(list(payload)) if kind == "batch" else client.send_command(payload)
+                    self.results.put((key, callbacks, reply, None, False))
+                if self.on_event is not None:
+                    for event in client.poll_events():
+                        self.results.put((None, [self.on_event], event, None, False))
+            except Exception as e:
+                reconnected = isinstance(e, OSError) and self.reconnect()
+                self.results.put((item[0] if item else None, item[1] if item else [], None, e, reconnected))
+                if not reconnected:
+                    break  # The connection is gone; connection_lost takes it from here
+
+    # Open a new connection and resume the session without asking for the password again
+    def reconnect(self):
+        try:
+            if client.reconnect():
+                client.send_batch(["FORMAT JSON", "SUBSCRIBE"])
+                return True
+        except Exception as e:
+            print(f"[WARN] Reconnect failed: {e}")
+        return False
 
-    except Exception as e:
-        messagebox.showerror("Connection Error", f"Lost connection to the server: {e}")
-        on_closing()
-        return f"Error sending command: {e}"
+    # Tk thread: deliver finished replies, then check again shortly
+    def poll(self):
+        while True:
+            try:
+                key, callbacks, reply, error, reconnected = self.results.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                if self.pending.get(key) is callbacks:
+                    del self.pending[key]
+                if self.last_key == key:
+                    self.last_key = None
+            if reconnected:
+                connection_restored()
+                continue
+            if error is not None:
+                connection_lost(error)
+                continue
+            for callback in callbacks:
+                try:
+                    callback(reply)
+                except tk.TclError as e:
+                    print(f"[WARN] Reply arrived after its window closed: {e}")
+        self.root.after(self.poll_ms, self.poll)
+
+    # Stop the worker after anything already queued, waiting at most `timeout` seconds
+    def shutdown(self, timeout=2.0):
+        self.requests.put(None)
+        self.thread.join(timeout)
+
+# Applies a pushed stock event ({"event": "stock", "rows": [[id, available], ...]}) to the product list
+def on_stock_event(event):
+    changes = decode_reply(event)
+    if changes:
+        product_list.apply_stock({row["id"]: row["stock"] for row in changes})
+
+# Sends a command in the background; `callback(reply)` runs on the Tk thread.
+# Set `coalesce` for read-only commands whose duplicate clicks can share one reply.
+def request_command(command, callback, coalesce=False):
+    network.submit("command", command, callback, coalesce)
+
+# Sends several commands in one round trip; `callback(replies)` gets their replies in order
+def request_batch(commands, callback):
+    network.submit("batch", tuple(commands), callback)
+
+# The request in flight was lost, but the session was resumed on a new connection
+def connection_restored():
+    messagebox.showwarning("Reconnected", "The connection to the server was interrupted and has been restored.\n"
+                                          "Items held in your cart were released; please repeat your last action.")
+    view_products()
+
+# Reports a dropped connection and offers to close the app
+def connection_lost(error):
+    messagebox.showerror("Connection Error", f"Lost connection to the server: {error}")
+    on_closing()
+
+# Decodes a reply holding structured rows into dicts.
+# Returns None if the reply isn't a table; `table` (if given) receives the reply metadata.
+def decode_reply(response, table=None):
+    try:
+        meta, records = decode_table(response)
+    except (ValueError, KeyError, TypeError):
+        return None
+    if table is not None:
+        table.update(meta)
+    return records
+
+# Header and rows for the fixed-width history table shown in the history window
+HISTORY_HEADER = "\n".join(["Recent Transactions:",
+                            f"{'ProductID':<10} {'Name':<25} {'Qty':<5} {'Total':<10} {'Date':<20} {'User'}",
+                            "-" * 80]) + "\n"
+
+def format_history_rows(records, currency):
+    return "".join(f"{row['id']:<10} {row['name']:<25} {row['qty']:<5} "
+                   f"{currency}{row['total']:<9.2f} {row['date']:<20} {row['user']}\n" for row in records)
+
+# Product thumbnails without per-refresh decoding:
+#  * images/ is scanned once into a productID -> file index
+#  * resized copies are saved under .thumbnails/, named by the source file's mtime,
+#    so a cold start only decodes small PNGs and edited images are picked up
+#  * PhotoImage objects are kept in an in-memory LRU, so re-rendering the grid decodes nothing
+class ThumbnailCache:
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".avif")  # Preference order when several exist
+    FILE_PATTERN = re.compile(r"^product_(\d+)(\.[a-z]+)$", re.IGNORECASE)
+
+    def __init__(self, image_dir="images", cache_dir=".thumbnails", size=(100, 100), max_photos=512):
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_photos = max_photos
+        self.sources = None          # productID -> source image path
+        self.photos = OrderedDict()  # productID -> (source mtime, PhotoImage or None if it can't be decoded)
+        self.lock = threading.Lock()
+
+    # Build the productID -> image path index with a single directory scan
+    def index(self):
+        if self.sources is not None:
+            return self.sources
+        found = {}
+        try:
+            entries = list(os.scandir(self.image_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            match = self.FILE_PATTERN.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            pid, ext = int(match.group(1)), match.group(2).lower()
+            if ext not in self.IMAGE_EXTENSIONS:
+                continue
+            current = found.get(pid)
+            if current is None or self.IMAGE_EXTENSIONS.index(ext) < self.IMAGE_EXTENSIONS.index(current[1]):
+                found[pid] = (entry.path, ext)
+        self.sources = {pid: path for pid, (path, _) in found.items()}
+        return self.sources
+
+    # Source image for a product, or None
+    def source(self, product_id):
+        return self.index().get(product_id)
+
+    # Path of the on-disk thumbnail for a product, creating it from the source if needed
+    def thumbnail_file(self, product_id):
+        src = self.source(product_id)
+        if src is None:
+            return None
+        mtime = os.stat(src).st_mtime_ns
+        thumb = os.path.join(self.cache_dir, f"product_{product_id}_{mtime}.png")
+        if os.path.isfile(thumb):
+            return thumb
+
+        with self.lock:
+            if os.path.isfile(thumb):
+                return thumb
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with Image.open(src) as image:
+                image.thumbnail(self.size)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                tmp = thumb + ".tmp"
+                image.save(tmp, format="PNG")
+                os.replace(tmp, thumb)
+            # Drop thumbnails made from older versions of this image
+            prefix = f"product_{product_id}_"
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix) and name.endswith(".png") and os.path.join(self.cache_dir, name) != thumb:
+                    os.remove(os.path.join(self.cache_dir, name))
+        return thumb
+
+    # PhotoImage for a product (must be called on the Tk thread); None if it can't be loaded.
+    # A cached photo is reused only while its source image is unchanged.
+    def photo(self, product_id):
+        src = self.source(product_id)
+        try:
+            mtime = os.stat(src).st_mtime_ns if src else None
+        except OSError:
+            mtime = None
+        cached = self.photos.get(product_id)
+        if cached is not None and cached[0] == mtime:
+            self.photos.move_to_end(product_id)
+            return cached[1]
+        try:
+            thumb = self.thumbnail_file(product_id)
+            photo = ImageTk.PhotoImage(Image.open(thumb)) if thumb else None
+        except Exception:
+            photo = None
+        self.photos[product_id] = (mtime, photo)
+        self.photos.move_to_end(product_id)
+        while len(self.photos) > self.max_photos:
+            self.photos.popitem(last=False)
+        return photo
+
+    # Generate missing on-disk thumbnails in the background so the first grid render is fast
+    def preload(self):
+        def run():
+            for product_id in list(self.index()):
+                try:
+                    self.thumbnail_file(product_id)
+                except Exception:
+                    pass  # Undecodable images show "No Img" when rendered
+        threading.Thread(target=run, name="thumbnail-preload", daemon=True).start()
+
+thumbnails = ThumbnailCache()
 
 # Attempts to locate an image file for the given product ID
 def find_image_file(product_id):
-    base_path = "images"
-    for ext in [".png", ".jpg", ".jpeg", ".webp"]:
-        img_path = os.path.join(base_path, f"product_{product_id}{ext}")
-        if os.path.isfile(img_path):
-            return img_path
-    return None
-
-# GUI FUNCTIONS
+    return thumbnails.source(product_id)
 
-# Displays all available products in the GUI with "Add to Cart" option
-def view_products():
-    show_products_view()
-    product_canvas_container.pack_forget()
-    product_canvas_container.pack(fill="both", expand=True)
-    clear_product_frame()
-
-    response = send_command_safe("VIEW")
-
-    # Validate proper format before trying to parse
-    if not response or "ProductID" not in response or "Price" not in response:
-        ttk.Label(product_frame, text="⚠️ Failed to load product list.",
-                  font=("Segoe UI", 14), style="Header.TLabel").pack(pady=20)
+# Shows a product's cached thumbnail on a label ("No Img" if the file can't be decoded)
+def set_product_image(img_label, product_id):
+    if find_image_file(product_id) is None:
         return
+    photo = thumbnails.photo(product_id)
+    if photo is None:
+        img_label.configure(text="No Img", font=("Segoe UI", 9))
+        return
+    img_label.image = photo
+    img_label.configure(image=photo)
+
+CURRENCY_SYMBOLS = {"USD": "$", "MUR": "Rs", "INR": "₹", "GBP": "£"}
+
+# Scrolling product list that only builds widgets for the rows on screen.
+# Rows have a fixed height, so the visible slice is computed from the scroll offset;
+# a small pool of row widgets is re-bound to whichever products are visible, and a
+# refresh only reconfigures rows whose name/price/stock actually changed.
+class VirtualProductList:
+    ROW_HEIGHT = 136   # Card (100px thumbnail + padding) plus the gap between cards
+    ROW_GAP = 12
+
+    def __init__(self, parent, on_add, on_add_all):
+        self.on_add = on_add            # on_add(product_id, quantity)
+        self.on_add_all = on_add_all    # on_add_all({product_id: quantity, ...})
+        self.products = []
+        self.symbol = ""
+        self.quantities = {}            # product_id -> text typed in its Qty box, kept across recycling
+        self.rows = []                  # pooled row widgets, bound to product indexes on demand
+
+        self.container = ttk.Frame(parent)
+        toolbar = ttk.Frame(self.container, style="Header.TFrame")
+        toolbar.pack(fill="x")
+        self.message = ttk.Label(toolbar, font=("Segoe UI", 14), style="Header.TLabel")
+        self.message.pack(side="left", padx=10)
+        ttk.Button(toolbar, text="🛒 Add All Entered to Cart", command=self.add_all)\
+            .pack(side="right", padx=10, pady=(6, 6))
+
+        self.canvas = tk.Canvas(self.container, bg="#f7f7fc", highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(self.container, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.layout())
+        self.bind_wheel(self.canvas)
+        self.canvas.configure(yscrollincrement=self.ROW_HEIGHT // 4)
+
+    # Replace the product list; rows already on screen are only touched if their data changed
+    def set_products(self, products, currency):
+        previous_ids = [product["id"] for product in self.products]
+        self.products = products
+        self.symbol = CURRENCY_SYMBOLS.get(currency, "")
+        self.message.configure(text="")
+        self.canvas.configure(scrollregion=(0, 0, 0, len(products) * self.ROW_HEIGHT))
+        if previous_ids != [product["id"] for product in products]:
+            self.canvas.yview_moveto(0)   # Different catalog: start from the top
+        self.layout()
+
+    # Update stock from a pushed event; only rows showing a changed product are reconfigured
+    def apply_stock(self, changes):
+        for product in self.products:
+            if product["id"] in changes:
+                product["stock"] = changes[product["id"]]
+        self.layout()
+
+    def show_error(self, text):
+        self.set_products([], "")
+        self.message.configure(text=text)
+
+    def clear_quantities(self, product_ids):
+        for pid in product_ids:
+            self.quantities.pop(pid, None)
+        for row in self.rows:
+            if row["pid"] in product_ids:
+                row["qty"].set("")
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.layout()
+
+    # Scroll with the mouse wheel while the pointer is over the list or one of its rows
+    def bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda e: self.canvas.yview_scroll(-1 if e.delta > 0 else 1, "units"))
+        widget.bind("<Button-4>", lambda e: self.canvas.yview_scroll(-1, "units"))
+        widget.bind("<Button-5>", lambda e: self.canvas.yview_scroll(1, "units"))
+
+    # Bind pooled rows to the products currently inside the viewport
+    def layout(self):
+        height = self.canvas.winfo_height()
+        width = max(self.canvas.winfo_width() - 20, 200)
+        top = int(self.canvas.canvasy(0))
+        first = max(top // self.ROW_HEIGHT, 0)
+        visible = height // self.ROW_HEIGHT + 2
+        last = min(first + visible, len(self.products))
+
+        while len(self.rows) < visible:
+            self.rows.append(self.create_row())
+
+        for slot, row in enumerate(self.rows):
+            index = first + slot
+            if index >= last:
+                self.canvas.itemconfigure(row["window"], state="hidden")
+                row["index"] = None
+                continue
+            self.canvas.coords(row["window"], 10, index * self.ROW_HEIGHT + self.ROW_GAP // 2)
+            self.canvas.itemconfigure(row["window"], width=width, state="normal")
+            self.bind_row(row, index)
+
+    def create_row(self):
+        frame = ttk.Frame(self.canvas, padding=10, relief="solid", borderwidth=1, style="Card.TFrame")
+        frame.columnconfigure(1, weight=1)
+        image = ttk.Label(frame, style="Card.TLabel")
+        image.grid(row=0, column=0, rowspan=2, padx=(0, 15), sticky="w")
+        details = ttk.Label(frame, font=("Segoe UI", 11), style="Card.TLabel", justify="left")
+        details.grid(row=0, column=1, rowspan=2, sticky="w")
+        for widget in (frame, image, details):
+            self.bind_wheel(widget)
+
+        action_frame = ttk.Frame(frame, style="Card.TFrame")
+        action_frame.grid(row=0, column=2, rowspan=2, sticky="e")
+        ttk.Label(action_frame, text="Qty:", style="Card.TLabel").pack(side="left", padx=(0, 5))
+        qty = tk.StringVar()
+        ttk.Entry(action_frame, width=5, font=("Segoe UI", 10), textvariable=qty).pack(side="left", padx=5)
+
+        row = {"index": None, "pid": None, "shown": None, "image": image, "details": details, "qty": qty}
+        qty.trace_add("write", lambda *_: self.remember_quantity(row))
+        ttk.Button(action_frame, text="Add to Cart", command=lambda: self.add(row)).pack(side="left", padx=5)
+        row["window"] = self.canvas.create_window(10, 0, window=frame, anchor="nw",
+                                                  height=self.ROW_HEIGHT - self.ROW_GAP, state="hidden")
+        return row
+
+    # Point a pooled row at products[index], reconfiguring only what changed
+    def bind_row(self, row, index):
+        product = self.products[index]
+        pid = product["id"]
+        shown = (pid, product["name"], product["price"], product["stock"], self.symbol)
+        row["index"] = index
+        if row["shown"] == shown:
+            return
+
+        if row["pid"] != pid:
+            row["pid"] = pid
+            row["image"].configure(image="", text="")
+            row["image"].image = None
+            set_product_image(row["image"], pid)
+            row["qty"].set(self.quantities.get(pid, ""))
+        row["details"].configure(
+            text=f"{product['name']}\nPrice: {self.symbol}{product['price']:.2f} | Stock: {product['stock']}")
+        row["shown"] = shown
+
+    def remember_quantity(self, row):
+        if row["pid"] is None:
+            return
+        text = row["qty"].get().strip()
+        if text:
+            self.quantities[row["pid"]] = text
+        else:
+            self.quantities.pop(row["pid"], None)
+
+    def add(self, row):
+        quantity = row["qty"].get().strip()
+        if not quantity.isdigit() or int(quantity) <= 0:
+            messagebox.showerror("Error", "Please enter a valid, positive quantity.")
+            return
+        self.on_add(row["pid"], int(quantity))
+
+    def add_all(self):
+        for quantity in self.quantities.values():
+            if not quantity.isdigit() or int(quantity) <= 0:
+                messagebox.showerror("Error", "Please enter a valid, positive quantity.")
+                return
+        if not self.quantities:
+            messagebox.showinfo("Info", "Enter a quantity for at least one product.")
+            return
+        self.on_add_all({pid: int(quantity) for pid, quantity in self.quantities.items()})
 
-    lines = response.strip().split("\n")[2:]  # Skip the headers
-
-    for line in lines:
-        if not line.strip():
-            continue
-        try:
-            parts = line.strip().split()
-            pid = int(parts[0])
-            stock = parts[-1]
-            price = parts[-2]
-            name = " ".join(parts[1:-2])
-        except (ValueError, IndexError):
-            continue  # skip malformed lines
+# GUI FUNCTIONS
 
-        item_frame = ttk.Frame(product_frame, padding=10, relief="solid", borderwidth=1, style="Card.TFrame")
-        item_frame.pack(padx=10, pady=6, fill="x")
-        item_frame.columnconfigure(1, weight=1)
+# Displays all available products in the GUI with "Add to Cart" option.
+# Called without a reply it requests VIEW and renders once the reply arrives.
+def view_products(view_response=None):
+    if view_response is None:
+        request_command(client.view_command(), view_products, coalesce=True)
+        return
 
-        # Load product image if available
-        img_path = find_image_file(pid)
-        img_label = ttk.Label(item_frame, style="Card.TLabel")
-        if img_path:
-            try:
-                image = Image.open(img_path)
-                image.thumbnail((100, 100))
-                photo = ImageTk.PhotoImage(image)
-                img_label.image = photo
-                img_label.configure(image=photo)
-            except Exception:
-                img_label.configure(text="No Img", font=("Segoe UI", 9))
-        img_label.grid(row=0, column=0, rowspan=2, padx=(0, 15), sticky="w")
+    show_product_list()
+    products = decode_reply(client.accept_view(view_response))
 
-        # Inside view_products(), before setting details_text:
-        selected_currency = currency_var.get()
-        currency_symbols = {
-            "USD": "$",
-            "MUR": "Rs",
-            "INR": "₹",
-            "GBP": "£"
-        }
-        symbol = currency_symbols.get(selected_currency, "")
-        # Product Details
-        details_text = f"{name}\nPrice: {symbol}{price} | Stock: {stock}"
-        ttk.Label(item_frame, text=details_text, font=("Segoe UI", 11), style="Card.TLabel", justify="left")\
-            .grid(row=0, column=1, rowspan=2, sticky="w")
+    # Validate proper format before trying to render
+    if products is None:
+        product_list.show_error("⚠️ Failed to load product list.")
+        return
 
-        # Add entry field and button for selecting quantity
-        action_frame = ttk.Frame(item_frame, style="Card.TFrame")
-        action_frame.grid(row=0, column=2, rowspan=2, sticky="e")
+    product_list.set_products(products, currency_var.get())
 
-        ttk.Label(action_frame, text="Qty:", style="Card.TLabel").pack(side="left", padx=(0, 5))
-        qty_entry = ttk.Entry(action_frame, width=5, font=("Segoe UI", 10))
-        qty_entry.pack(side="left", padx=5)
+# Adds one product to the cart and refreshes the list in the same round trip
+def add_to_cart(pid, quantity):
+    def on_added(replies):
+        result = replies[0]
+        messagebox.showinfo("Info", result)
 
-        def add_func(p=pid, entry=qty_entry):
-            quantity = entry.get().strip()
-            if not quantity.isdigit() or int(quantity) <= 0:
-                messagebox.showerror("Error", "Please enter a valid, positive quantity.")
-                return
-            result = send_command_safe(f"ADD {p} {quantity}")
-            messagebox.showinfo("Info", result)
+        if "added to cart" in result.lower():
+            product_list.clear_quantities([pid])
+            view_products(replies[1])
 
-            if "added to cart" in result.lower():
-                view_products()
+    request_batch([f"ADD {pid} {quantity}", client.view_command()], on_added)
 
-        add_btn = ttk.Button(action_frame, text="Add to Cart", command=add_func)
-        add_btn.pack(side="left", padx=5)
+# Adds every product with a quantity entered, plus the refreshed list, in one round trip
+def add_all_to_cart(quantities):
+    def on_added(replies):
+        messagebox.showinfo("Info", "\n".join(replies[:-1]))
+        product_list.clear_quantities(list(quantities))
+        view_products(replies[-1])
 
-    product_frame.update_idletasks()
-    canvas.configure(scrollregion=canvas.bbox("all"))
-    canvas.yview_moveto(0)
+    request_batch([f"ADD {pid} {quantity}" for pid, quantity in quantities.items()] + [client.view_command()],
+                  on_added)
 
 # Displays current items in the user's cart with remove option
-def view_cart():
+def view_cart(cart_response=None):
+    if cart_response is None:
+        request_command("CART", view_cart, coalesce=True)
+        return
+
     show_products_view()
     product_canvas_container.pack_forget()
     product_canvas_container.pack(fill="both", expand=True)
     clear_product_frame()
 
-    response = send_command_safe("CART")
+    table = {}
+    items = decode_reply(cart_response, table)
 
     # Handle case where cart has no items
-    if "Cart is empty." in response:
+    if not items:
         ttk.Label(product_frame, text="Your cart is empty. 🛒",
                   font=("Segoe UI", 14), style="Header.TLabel").pack(pady=20)
         return
 
-    lines = response.strip().split("\n")
-    header = lines[0]
-    items = lines[2:]
-
+    header = f"Cart (Prices in {table.get('currency', 'USD')}):"
     ttk.Label(product_frame, text=header, font=("Segoe UI", 14, "bold"),
               style="Header.TLabel").pack(pady=(5, 15), fill="x")
 
-    for line in items:
-        if not line.strip():
-            continue
-        try:
-            parts = line.strip().split()
-            pid = int(parts[0])
-            name = " ".join(parts[1:-2])
-            total_price = parts[-2]
-            qty = parts[-1]
-        except (ValueError, IndexError):
-            continue  # Don’t crash on garbage data
+    for item in items:
+        pid = item["id"]
+        name = item["name"]
+        total_price = f"{table.get('currency', 'USD')}{item['total']:.2f}"
+        qty = item["qty"]
 
         item_frame = ttk.Frame(product_frame, padding=10, relief="solid", borderwidth=1, style="Card.TFrame")
         item_frame.pack(padx=10, pady=6, fill="x")
@@ -221,9 +581,11 @@ def view_cart():
 
         # Removes specified quantity of item from cart
         def remove_func(p=pid, q=qty):
-            result = send_command_safe(f"REMOVE {p} {q}")
-            messagebox.showinfo("Removed", result)
-            view_cart()
+            def on_removed(replies):
+                messagebox.showinfo("Removed", replies[0])
+                view_cart(replies[1])
+
+            request_batch([f"REMOVE {p} {q}", "CART"], on_removed)
 
         remove_btn = ttk.Button(item_frame, text="🗑️ Remove", command=remove_func, style="Danger.TButton")
         remove_btn.grid(row=0, column=1, sticky="e", padx=10)
@@ -254,70 +616,68 @@ def render_matplotlib_chart(fig, holder):
 
     holder.update_idletasks()
 
-# Creates a chart based on selected type and product ID
+# Requests the analytics series for the selected chart type; the chart is drawn when it arrives
 def generate_chart(chart_type, product_id, holder):
+    if chart_type == "Top 5 Selling Products":
+        command = "ANALYTICS TOP 5"
+    elif chart_type == "Stock Trend":
+        product_id = product_id.strip()
+        if not product_id or not product_id.isdigit():
+            messagebox.showerror("Input Error", "Enter a valid Product ID.")
+            return
+        command = f"ANALYTICS TREND {product_id}"
+    elif chart_type in ("Revenue by Day", "Revenue by Month"):
+        command = "ANALYTICS REVENUE " + ("DAY" if chart_type == "Revenue by Day" else "MONTH")
+    else:
+        return
+
+    request_command(command, lambda response: draw_chart(chart_type, product_id, holder, response),
+                    coalesce=True)
+
+# Creates a chart from a server-side analytics reply
+def draw_chart(chart_type, product_id, holder, response):
+    fig = None
     try:
-        conn = sqlite3.connect("vending_machine.db")
-        cur = conn.cursor()
+        table = {}
+        data = decode_reply(response, table)
+        if data is None:
+            messagebox.showerror("Server Error", "Could not load sales data.")
+            return
+        if not data:
+            if chart_type == "Stock Trend":
+                messagebox.showinfo("No Data", f"No transaction data for Product ID {product_id}.")
+            else:
+                messagebox.showinfo("No Data", "No sales data found.")
+            return
+
         fig, ax = plt.subplots(figsize=(8, 5))
 
         # Generate a bar chart of best-selling products
         if chart_type == "Top 5 Selling Products":
-            cur.execute("""
-                        SELECT p.productName, SUM(t.quantity)
-                        FROM CartTransactions t
-                                 JOIN Products p ON p.productID = t.productID
-                        GROUP BY p.productID
-                        ORDER BY SUM(t.quantity) DESC LIMIT 5
-                        """)
-            data = cur.fetchall()
-            if not data:
-                messagebox.showinfo("No Data", "No sales data found.")
-                plt.close(fig)
-                return
-            names, values = zip(*data)
-            ax.bar(names, values, color='#007bff')
+            ax.bar([row["name"] for row in data], [row["units"] for row in data], color='#007bff')
             ax.set_title("Top 5 Selling Products", fontsize=14)
             ax.set_ylabel("Units Sold")
-            plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
 
         # Generate a line chart showing sales over time for a product
         elif chart_type == "Stock Trend":
-            product_id = product_id.strip()
-            if not product_id or not product_id.isdigit():
-                messagebox.showerror("Input Error", "Enter a valid Product ID.")
-                plt.close(fig)
-                return
-            cur.execute("SELECT productName FROM Products WHERE productID=?", (product_id,))
-            result = cur.fetchone()
-            product_name = result[0] if result else f"ID {product_id}"
-
-            cur.execute("""
-                        SELECT transactionDate, quantity
-                        FROM CartTransactions
-                        WHERE productID = ?
-                        ORDER BY transactionDate ASC
-                        """, (product_id,))
-            data = cur.fetchall()
-            if not data:
-                messagebox.showinfo("No Data", f"No transaction data for Product ID {product_id}.")
-                plt.close(fig)
-                return
-            dates, qty = zip(*data)
-            ax.plot(dates, qty, marker='o', linestyle='-', color='#28a745')
-            ax.set_title(f"Sales Trend for: {product_name}", fontsize=14)
+            ax.plot([row["date"] for row in data], [row["units"] for row in data],
+                    marker='o', linestyle='-', color='#28a745')
+            ax.set_title(f"Sales Trend for: {table.get('product')}", fontsize=14)
             ax.set_ylabel("Quantity Sold")
-            plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
 
+        # Generate a bar chart of revenue per day or month
+        else:
+            ax.bar([row["period"] for row in data], [row["revenue"] for row in data], color='#6f42c1')
+            ax.set_title(chart_type, fontsize=14)
+            ax.set_ylabel(f"Revenue ({table.get('currency', 'USD')})")
+
+        plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
         render_matplotlib_chart(fig, holder)
 
-    except sqlite3.Error as e:
-        messagebox.showerror("Database Error", f"Could not generate chart: {e}")
     except Exception as e:
+        if fig is not None:
+            plt.close(fig)
         messagebox.showerror("Chart Error", str(e))
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # Opens a window showing transaction history and analytics chart options
 def view_history():
@@ -335,8 +695,6 @@ def view_history():
               font=("Segoe UI", 16, "bold"), style="Header.TLabel").pack(pady=10, fill="x")
 
     # Local history display widget, not text_display
-    response = send_command_safe("HISTORY")
-
     text_frame = ttk.Frame(container, padding=5, style="Card.TFrame")
     text_frame.pack(fill="both", expand=False, padx=10, pady=5)
 
@@ -348,14 +706,45 @@ def view_history():
         bg="#ffffff",
         fg="#444"
     )
-    local_history_display.insert("1.0", response)
-    local_history_display.config(state="disabled")
     local_history_display.pack(side="left", fill="both", expand=True)
 
     sc = ttk.Scrollbar(text_frame, orient="vertical", command=local_history_display.yview)
     sc.pack(side="right", fill="y")
     local_history_display.configure(yscrollcommand=sc.set)
 
+    # History is fetched a page at a time; "Load Older" follows the server's cursor
+    history_cursor = {"next": None}
+
+    def load_history_page():
+        args = f"limit={HISTORY_PAGE_SIZE}"
+        if history_cursor["next"]:
+            args += f" after={history_cursor['next']}"
+        load_more_btn.config(state="disabled")
+        request_command(f"HISTORY PAGE {args}", show_history_page, coalesce=True)
+
+    def show_history_page(response):
+        table = {}
+        records = decode_reply(response, table)
+
+        local_history_display.config(state="normal")
+        if records is None:
+            local_history_display.insert(tk.END, "⚠️ Failed to load transaction history.\n")
+        elif not records and history_cursor["next"] is None:
+            local_history_display.insert(tk.END, "No previous transactions found.")
+        else:
+            if history_cursor["next"] is None:
+                local_history_display.insert(tk.END, HISTORY_HEADER)
+            local_history_display.insert(tk.END, format_history_rows(records, table.get("currency", "USD")))
+        local_history_display.config(state="disabled")
+
+        history_cursor["next"] = table.get("next")
+        if history_cursor["next"]:
+            load_more_btn.config(state="normal")
+
+    load_more_btn = ttk.Button(container, text="⏬ Load Older", command=load_history_page)
+    load_more_btn.pack(padx=10, anchor="e")
+    load_history_page()
+
     # Chart UI
     chart_ui = ttk.Frame(container, padding=10, style="Card.TFrame")
     chart_ui.pack(fill="x", padx=10, pady=10)
@@ -363,7 +752,7 @@ def view_history():
 
     ttk.Label(chart_ui, text="Select Chart:", style="Header.TLabel").pack(side="left", padx=(0, 5))
     chart_selector = ttk.Combobox(chart_ui, textvariable=chart_type_var,
-                                  values=["Top 5 Selling Products", "Stock Trend"],
+                                  values=["Top 5 Selling Products", "Stock Trend", "Revenue by Day", "Revenue by Month"],
                                   width=25, state="readonly")
     chart_selector.pack(side="left", padx=5)
 
@@ -379,50 +768,63 @@ def view_history():
                generate_chart(chart_type_var.get(), product_id_entry.get(), local_chart_holder))\
         .pack(side="left", padx=10)
 
-# Allows admin to modify product stock quantities from GUI
-def edit_stock():
+# Allows admin to modify product stock quantities from GUI.
+# Called without a reply it requests VIEW and renders once the reply arrives.
+def edit_stock(view_response=None):
+    if view_response is None:
+        request_command(client.view_command(), edit_stock, coalesce=True)
+        return
+
     show_products_view()
     product_canvas_container.pack_forget()
     product_canvas_container.pack(fill="both", expand=True)
     clear_product_frame()
 
-    response = send_command_safe("VIEW")
+    products = decode_reply(client.accept_view(view_response))
 
     # ️ Validate expected format
-    if not response or "ProductID" not in response or "Price" not in response:
+    if products is None:
         ttk.Label(product_frame, text="⚠️ Failed to load product list.",
                   font=("Segoe UI", 14), style="Header.TLabel").pack(pady=20)
         return
 
-    lines = response.strip().split("\n")[2:]  # Skip header
+    # Sends every entered stock level plus the refreshed list in one round trip
+    stock_entries = []
 
-    for line in lines:
-        if not line.strip():
-            continue
-        try:
-            parts = line.split()
-            pid = int(parts[0])
-            name = " ".join(parts[1:-2])
-            price = parts[-2]
-            stock = parts[-1]
-        except (ValueError, IndexError):
-            continue
+    def update_all_func():
+        commands = []
+        for p, entry in stock_entries:
+            quantity = entry.get().strip()
+            if not quantity:
+                continue
+            if not quantity.isdigit():
+                messagebox.showerror("Error", "Invalid quantity. Please enter a number.")
+                return
+            commands.append(f"CHANGE_STOCK {p} {quantity}")
+        if not commands:
+            messagebox.showinfo("Info", "Enter a new stock level for at least one product.")
+            return
+        def on_updated(replies):
+            messagebox.showinfo("Stock Updated", "\n".join(replies[:-1]))
+            edit_stock(replies[-1])
+
+        request_batch(commands + [client.view_command()], on_updated)
+
+    ttk.Button(product_frame, text="💾 Update All Entered", command=update_all_func)\
+        .pack(padx=10, pady=(6, 0), anchor="e")
+
+    for product in products:
+        pid = product["id"]
+        name = product["name"]
+        price = f"{product['price']:.2f}"
+        stock = product["stock"]
 
         item_frame = ttk.Frame(product_frame, padding=10, relief="solid", borderwidth=1, style="Card.TFrame")
         item_frame.pack(padx=10, pady=6, fill="x")
         item_frame.columnconfigure(1, weight=1)
 
-        img_path = find_image_file(pid)
         img_label = ttk.Label(item_frame, style="Card.TLabel")
-        if img_path:
-            try:
-                image = Image.open(img_path)
-                image.thumbnail((100, 100))
-                photo = ImageTk.PhotoImage(image)
-                img_label.image = photo
-                img_label.configure(image=photo)
-            except Exception:
-                img_label.configure(text="No Img", font=("Segoe UI", 9))
+        set_product_image(img_label, pid)
         img_label.grid(row=0, column=0, rowspan=2, padx=(0, 15), sticky="w")
 
         details_text = f"{name}\nPrice: {price} | Current Stock: {stock}"
@@ -435,15 +837,18 @@ def edit_stock():
         ttk.Label(action_frame, text="Set New Stock:", style="Card.TLabel").pack(side="left", padx=(0, 5))
         qty_entry = ttk.Entry(action_frame, width=8, font=("Segoe UI", 10))
         qty_entry.pack(side="left", padx=5)
+        stock_entries.append((pid, qty_entry))
 
         def update_stock_func(p=pid, entry=qty_entry):
             quantity = entry.get().strip()
             if not quantity.isdigit():
                 messagebox.showerror("Error", "Invalid quantity. Please enter a number.")
                 return
-            result = send_command_safe(f"CHANGE_STOCK {p} {quantity}")
-            messagebox.showinfo("Stock Updated", result)
-            edit_stock()  # Refresh view
+            def on_updated(replies):
+                messagebox.showinfo("Stock Updated", replies[0])
+                edit_stock(replies[1])  # Refresh view
+
+            request_batch([f"CHANGE_STOCK {p} {quantity}", client.view_command()], on_updated)  # Update and refresh together
 
         ttk.Button(action_frame, text="Update Stock", command=update_stock_func).pack(side="left", padx=5)
 
@@ -452,8 +857,10 @@ def edit_stock():
     canvas.yview_moveto(0)
 
 # Opens confirmation window and handles final purchase
-def checkout():
-    receipt = send_command_safe("RECEIPT")
+def checkout(receipt=None):
+    if receipt is None:
+        request_command("RECEIPT", checkout, coalesce=True)
+        return
 
     # Check if cart is empty or receipt is malformed
     if not receipt or "ProductID" not in receipt or "Cart is empty" in receipt or "Your cart is empty" in receipt:
@@ -484,7 +891,16 @@ def checkout():
 
     # Handles checkout confirmation, updates inventory, clears cart
     def confirm_action():
-        response = send_command_safe("CHECKOUT")
+        for widget in button_frame.winfo_children():
+            widget.config(state="disabled")  # No double submits while the purchase is in flight
+        request_command("CHECKOUT", show_checkout_result)
+
+    def show_checkout_result(response):
+        if "Purchase completed" not in response:
+            messagebox.showerror("Checkout Failed", response.strip(), parent=checkout_window)
+            checkout_window.destroy()
+            return
+
         for widget in main_frame.winfo_children():
             widget.destroy()  # Clear window
 
@@ -528,11 +944,11 @@ def checkout():
 # Changes the display currency and refreshes product prices
 def send_currency():
     selected_currency = currency_var.get()
-    response = send_command_safe(f"CURRENCY {selected_currency}")
+    request_command(f"CURRENCY {selected_currency}", show_currency_result)
 
+def show_currency_result(response):
     if "Currency changed" in response:
         messagebox.showinfo("Currency Changed", response)
-        time.sleep(0.1)
         view_products()
     elif "Failed" in response:
         messagebox.showerror("Currency Error", response)
@@ -561,19 +977,29 @@ def update_display(text):
 # Switches GUI to product browsing layout
 def show_products_view():
     text_display_container.pack_forget()
+    product_list.container.pack_forget()
     product_canvas_container.pack(fill="both", expand=True)
 
+# Switches GUI to the virtualized product list
+def show_product_list():
+    text_display_container.pack_forget()
+    product_canvas_container.pack_forget()
+    product_list.container.pack(fill="both", expand=True)
+
 # Switches GUI to text display panel
 def show_text_display():
     product_canvas_container.pack_forget()
+    product_list.container.pack_forget()
     text_display_container.pack(fill="both", expand=True, padx=20, pady=20)
 
 # Gracefully disconnects from server and closes the application
 def on_closing():
     if messagebox.askokcancel("Quit", "Do you want to exit?"):
+        network.shutdown(timeout=2.0)  # Let in-flight requests finish before the socket goes away
         try:
             if client:
-                client.send_command("EXIT")
+                if not network.thread.is_alive():  # A stuck request would garble the EXIT reply
+                    client.send_command("EXIT")
                 client.client.close()
         except Exception as e:
             print(f"Error on closing: {e}")  # Log error, but close anyway
@@ -593,12 +1019,15 @@ if __name__ == "__main__":
     if not login_prompt():
         exit()
 
+    thumbnails.preload()  # Resize product images while the main window is built
+
     # Initialize main application window
     root = tk.Tk()
     root.title("Smart Vending Machine Client")
     root.geometry("1100x800")
     root.configure(bg="#e9ecef")
     root.minsize(900, 700)
+    network = NetworkWorker(root, on_event=on_stock_event)  # All server requests run off the Tk thread
 
     # Configure custom UI styles
     style = ttk.Style()
@@ -638,6 +1067,9 @@ if __name__ == "__main__":
     canvas.pack(side="left", fill="both", expand=True)
     scrollbar.pack(side="right", fill="y")
 
+    # 3. Product catalogue (virtualized, rows are recycled while scrolling)
+    product_list = VirtualProductList(content_area, on_add=add_to_cart, on_add_all=add_all_to_cart)
+
     # BOTTOM BUTTON BAR
     # Dropdown to select target currency
     currency_var = tk.StringVar(root)
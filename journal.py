@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+
+# Write-behind journal for the server's database writes. Each write is appended
+# to a local log as one JSON line and is durable as soon as that line is
+# fsynced; a background flusher later applies batches of durable entries to
+# SQLite. Sessions that append at the same time share a single fsync (group
+# commit), so a burst of checkouts costs a few fsyncs instead of one commit each.
+#
+# The apply callback must record the last sequence number it applied in the same
+# database transaction; open() replays every entry after that number, so nothing
+# is lost or applied twice after a crash.
+
+ROTATE_BYTES = 4 * 1024 * 1024   # Empty the log once it is this large and fully applied
+
+
+class TransactionJournal:
+    def __init__(self, path, apply, flush_interval=0.05, max_batch=500):
+        self.path = path
+        self.apply = apply                  # apply(entries) writes a batch to the database
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)    # Notified after each group fsync
+        self.flush_lock = threading.Lock()  # One batch applied at a time
+        self.fd = None
+        self.size = 0
+        self.next_seq = 1
+        self.buffer = []            # Encoded lines waiting for the next group fsync
+        self.syncing = False        # A session is writing and fsyncing on everyone's behalf
+        self.durable_seq = 0        # Highest sequence number safely on disk
+        self.applied_seq = 0        # Highest sequence number applied to the database
+        self.pending = deque()      # Entries appended but not yet applied, in order
+        self.failed = None          # Set if a write/fsync failed; no further appends are accepted
+        self.flusher = None
+
+    # Replay entries left over from the last run (those after `applied_seq`), then start
+    # appending and the background flusher. Returns the number of entries replayed.
+    def open(self, applied_seq=0):
+        entries = list(self.read_entries(applied_seq))
+        if entries:
+            for start in range(0, len(entries), self.max_batch):
+                self.apply(entries[start:start + self.max_batch])
+            print(f"[*] Replayed {len(entries)} journal entries from {self.path}")
+        last_seq = entries[-1]["seq"] if entries else applied_seq
+        self.durable_seq = self.applied_seq = max(last_seq, applied_seq)
+        self.next_seq = self.applied_seq + 1
+
+        # Everything in the file is now in the database; start it afresh (also drops a torn last line)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.flusher = threading.Thread(target=self.flush_forever, name="journal-flusher", daemon=True)
+        self.flusher.start()
+        return len(entries)
+
+    # Entries in the log file after `applied_seq`, stopping at a torn (partly written) last line
+    def read_entries(self, applied_seq):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"[!] Ignoring incomplete journal record in {self.path}")
+                    break
+                if entry["seq"] > applied_seq:
+                    yield entry
+
+    # Give `entry` the next sequence number and queue it for the next group fsync. Callers
+    # that need to order the entry with other state (e.g. the in-memory stock check) hold
+    # their own lock around this; wait_durable() should then be called outside it.
+    def append(self, entry):
+        with self.lock:
+            if self.failed:
+                raise OSError(f"Journal unavailable after an earlier failure: {self.failed}")
+            entry["seq"] = seq = self.next_seq
+            self.next_seq += 1
+            self.buffer.append(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+            self.pending.append(entry)
+        metrics.increment("journal.records")
+        metrics.adjust("journal.backlog", 1)
+        return seq
+
+    # Block until entry `seq` is on disk. Whoever finds no fsync in progress writes the whole
+    # buffer (its own entry and everyone else's) and fsyncs once; the others just wait for it.
+    def wait_durable(self, seq):
+        with self.lock:
+            while self.durable_seq < seq:
+                if self.failed:
+                    raise OSError(f"Journal write failed: {self.failed}")
+                if self.syncing:
+                    self.synced.wait()
+                    continue
+                self.syncing = True
+                data = b"".join(self.buffer)
+                last = self.next_seq - 1
+                self.buffer.clear()
+                self.lock.release()
+                try:
+                    self.write_and_sync(data)
+                except OSError as e:
+                    self.failed = e
+                    print(f"[!] Journal write failed, refusing further writes: {e}")
+                    self.discard_unsynced()
+                finally:
+                    self.lock.acquire()
+                    self.syncing = False
+                    if not self.failed:
+                        self.durable_seq = last
+                        self.size += len(data)
+                    self.synced.notify_all()
+
+    # Cut the file back to the last durable record. The callers of a failed write are told their
+    # change was not recorded, so records that did reach the file must not be replayed on restart.
+    def discard_unsynced(self):
+        try:
+            os.ftruncate(self.fd, self.size)
+            os.fsync(self.fd)
+        except OSError as e:
+            print(f"[!] Could not remove unsynced records from {self.path}; they will be replayed: {e}")
+
+    def write_and_sync(self, data):
+        metrics.increment("journal.fsyncs")    # journal.records / journal.fsyncs = average group size
+        with metrics.timed("journal.fsync"):
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            (os.fdatasync if hasattr(os, "fdatasync") else os.fsync)(self.fd)
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)   # Let entries pile up so each flush is one bulk transaction
+            try:
+                while self.flush():
+                    pass
+            except Exception as e:
+                print(f"[!] Journal flush failed, will retry: {e}")
+
+    # Apply the next batch of durable entries to the database; returns how many were applied
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch = []
+                for entry in self.pending:
+                    if entry["seq"] > self.durable_seq or len(batch) >= self.max_batch:
+                        break
+                    batch.append(entry)
+            if not batch:
+                return 0
+            self.apply(batch)
+            with self.lock:
+                for _ in batch:
+                    self.pending.popleft()
+                self.applied_seq = batch[-1]["seq"]
+                # Caught up and large: everything in the file is in the database, start it afresh
+                if self.size >= ROTATE_BYTES and not self.pending and not self.syncing:
+                    os.ftruncate(self.fd, 0)
+                    self.size = 0
+            metrics.adjust("journal.backlog", -len(batch))
+            return len(batch)
+
+    # Apply everything durable so far (e.g. before shutting down); True if nothing is left
+    def drain(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self.flush():
+            if time.monotonic() > deadline:
+                return False
+        with self.lock:
+            return not self.pending
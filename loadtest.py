@@ -0,0 +1,282 @@
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client import Client
+
+# Load generator for server.py. Starts the server on a temporary copy of the
+# database, drives it with N simulated clients speaking the real protocol and
+# reports throughput, per-command latency percentiles, errors and whether any
+# product was oversold.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MIX = "view=40,add=30,cart=10,checkout=10,history=10"
+
+
+# Parse "view=40,add=30,..." into ([command names], [weights])
+def parse_mix(text):
+    names, weights = [], []
+    for part in text.split(","):
+        name, weight = part.split("=")
+        if name not in ("view", "add", "cart", "checkout", "history"):
+            raise ValueError(f"Unknown command in mix: {name}")
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[max(math.ceil(pct / 100 * len(values)) - 1, 0)]
+
+
+# Pick a free TCP port on localhost for the server under test
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# Latencies and outcomes shared by every simulated client
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}     # command -> [seconds]
+        self.errors = {}        # command -> count
+        self.checkouts = {"completed": 0, "rejected": 0}
+
+    def record(self, command, seconds, error=False):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(seconds)
+            if error:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+    def record_checkout(self, reply):
+        with self.lock:
+            if "Purchase completed" in reply:
+                self.checkouts["completed"] += 1
+            elif "Checkout failed" in reply:
+                self.checkouts["rejected"] += 1
+
+
+# One simulated user: log in, then send commands from the mix until the deadline
+def run_client(host, port, args, product_ids, results, deadline, seed):
+    rng = random.Random(seed)
+    names, weights = parse_mix(args.mix)
+    client = Client()
+    client.HOST, client.PORT = host, port
+    client.ADDRESS = (host, port)
+
+    try:
+        started = time.perf_counter()
+        client.connect()
+        ok = client.login(args.user, args.password)
+        results.record("login", time.perf_counter() - started, error=not ok)
+        if not ok:
+            return
+        client.send_command("FORMAT JSON")   # Same reply format the GUI uses
+    except Exception as e:
+        results.record("login", 0.0, error=True)
+        print(f"[!] Client {seed} could not log in: {e}")
+        return
+
+    sent = 0
+    while time.monotonic() < deadline and (not args.requests or sent < args.requests):
+        name = rng.choices(names, weights)[0]
+        if name == "view":
+            command = client.view_command()   # Conditional, like the GUI
+        elif name == "add":
+            command = f"ADD {rng.choice(product_ids)} {rng.randint(1, args.max_qty)}"
+        elif name == "cart":
+            command = "CART"
+        elif name == "checkout":
+            command = "CHECKOUT"
+        else:
+            command = "HISTORY PAGE limit=20"
+
+        started = time.perf_counter()
+        try:
+            reply = client.send_command(command)
+        except Exception as e:
+            results.record(name, time.perf_counter() - started, error=True)
+            print(f"[!] Client {seed} lost its connection: {e}")
+            return
+        error = reply.startswith(("Invalid", "Error", "Failed", "BUSY"))
+        if name == "view":
+            error = client.accept_view(reply) is None
+        results.record(name, time.perf_counter() - started, error=error)
+        if name == "checkout":
+            results.record_checkout(reply)
+        sent += 1
+        if args.think_time:
+            time.sleep(rng.uniform(0, args.think_time))
+
+    try:
+        client.send_command("EXIT")
+        client.client.close()
+    except Exception:
+        pass
+
+
+# Compare stock before and after the run with what was recorded as sold
+def check_stock(db_path, initial_stock, first_transaction):
+    with sqlite3.connect(db_path) as conn:
+        final_stock = dict(conn.execute("SELECT productID, stock FROM Products").fetchall())
+        sold = dict(conn.execute("SELECT productID, SUM(quantity) FROM CartTransactions WHERE transactionID > ? "
+                                 "GROUP BY productID", (first_transaction,)).fetchall())
+    oversold = [pid for pid, stock in initial_stock.items() if sold.get(pid, 0) > stock or final_stock.get(pid, 0) < 0]
+    inconsistent = [pid for pid, stock in initial_stock.items() if stock - sold.get(pid, 0) != final_stock.get(pid)]
+    return {"units_sold": sum(sold.values()), "oversold_products": oversold, "inconsistent_products": inconsistent}
+
+
+# Start server.py in `mode` against a fresh copy of the database and run one load test
+def run_benchmark(mode, args):
+    with tempfile.TemporaryDirectory(prefix="vm-loadtest-") as workdir:
+        db_path = os.path.join(workdir, "vending_machine.db")
+        shutil.copyfile(args.db, db_path)
+        with sqlite3.connect(db_path) as conn:
+            if args.stock is not None:
+                conn.execute("UPDATE Products SET stock = ?", (args.stock,))
+            initial_stock = dict(conn.execute("SELECT productID, stock FROM Products").fetchall())
+            first_transaction = conn.execute("SELECT COALESCE(MAX(transactionID), 0) FROM CartTransactions").fetchone()[0]
+
+        port = free_port()
+        command = [sys.executable, os.path.join(BASE_DIR, "server.py"), "--mode", mode, "--port", str(port),
+                   "--workers", str(args.workers), "--db", db_path, "--pool-size", str(args.pool_size),
+                   "--rates-file", args.rates_file, "--rate-limit", str(args.rate_limit), "--max-sessions", "0"]
+        if args.journal:
+            command += ["--journal", os.path.join(workdir, "transactions.journal")]
+        log_path = os.path.join(workdir, "server.log")
+        with open(log_path, "w") as log:
+            server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=workdir)
+            try:
+                wait_for_server(port, server)
+                results = Results()
+                deadline = time.monotonic() + args.duration
+                threads = [threading.Thread(target=run_client,
+                                            args=("127.0.0.1", port, args, list(initial_stock), results, deadline, i))
+                           for i in range(args.clients)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+            finally:
+                server.terminate()
+                try:
+                    server.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+
+        report = summarize(mode, args, results, elapsed)
+        report["stock"] = check_stock(db_path, initial_stock, first_transaction)
+        if args.keep_log:
+            shutil.copyfile(log_path, f"loadtest-{mode}.log")
+        return report
+
+
+# Block until the server accepts connections (or fail if it exits first)
+def wait_for_server(port, server, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode} before accepting connections")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start in time")
+
+
+# Throughput and latency percentiles (milliseconds) per command
+def summarize(mode, args, results, elapsed):
+    commands = {}
+    total = 0
+    for name, values in sorted(results.latencies.items()):
+        values.sort()
+        if name != "login":
+            total += len(values)
+        commands[name] = {
+            "count": len(values),
+            "errors": results.errors.get(name, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+        }
+    return {"mode": mode, "workers": args.workers, "journal": args.journal, "clients": args.clients, "elapsed_s": round(elapsed, 2), "requests": total,
+            "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0, "commands": commands,
+            "checkouts": dict(results.checkouts)}
+
+
+def print_report(report):
+    journal = ", write-behind journal" if report["journal"] else ""
+    print(f"\n=== {report['mode']} mode x{report['workers']} workers{journal}: {report['clients']} clients, "
+          f"{report['elapsed_s']}s ===")
+    print(f"Requests: {report['requests']}  Throughput: {report['throughput_rps']} req/s")
+    print(f"{'Command':<10} {'Count':>7} {'Errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 66)
+    for name, stats in report["commands"].items():
+        print(f"{name:<10} {stats['count']:>7} {stats['errors']:>7} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+              f"{stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+    stock = report["stock"]
+    print(f"Checkouts: {report['checkouts']['completed']} completed, {report['checkouts']['rejected']} rejected; "
+          f"{stock['units_sold']} units sold")
+    print(f"Oversold products: {len(stock['oversold_products'])} {stock['oversold_products'] or ''}")
+    print(f"Stock/transaction mismatches: {len(stock['inconsistent_products'])} {stock['inconsistent_products'] or ''}")
+
+
+# Entry point: python loadtest.py --clients 50 --duration 20 --mode thread asyncio
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Smart Vending Machine server")
+    parser.add_argument("--mode", nargs="+", choices=["thread", "asyncio"], default=["thread"],
+                        help="Server mode(s) to benchmark, one run each on a fresh database copy")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes (server.py --workers)")
+    parser.add_argument("--journal", action="store_true", help="Run the server with a write-behind journal (--journal)")
+    parser.add_argument("--clients", type=int, default=20, help="Number of simulated clients")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds each run lasts")
+    parser.add_argument("--requests", type=int, default=0, help="Stop each client after this many requests (0: no limit)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Command weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--max-qty", type=int, default=3, help="Largest quantity a single ADD asks for")
+    parser.add_argument("--think-time", type=float, default=0, help="Max random pause between requests (seconds)")
+    parser.add_argument("--stock", type=int, help="Set every product's stock to this in the copy before the run")
+    parser.add_argument("--user", default="admin", help="Account every simulated client logs in as")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--db", default=os.path.join(BASE_DIR, "vending_machine.db"), help="Database to copy")
+    parser.add_argument("--pool-size", type=int, default=8, help="Server's pooled SQLite connections")
+    parser.add_argument("--rates-file", default=os.path.join(BASE_DIR, "rates.json"),
+                        help="Offline exchange rates for the server under test")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Server's per-session requests/second limit (server.py --rate-limit; 0 = off)")
+    parser.add_argument("--json", help="Also write the reports to this file")
+    parser.add_argument("--keep-log", action="store_true", help="Save each server log as loadtest-<mode>.log")
+    args = parser.parse_args()
+
+    reports = []
+    for mode in args.mode:
+        print(f"[*] Benchmarking {mode} mode with {args.clients} clients for {args.duration}s...")
+        report = run_benchmark(mode, args)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"\n[+] Wrote {args.json}")
+
+    if any(report["stock"]["oversold_products"] or report["stock"]["inconsistent_products"] for report in reports):
+        sys.exit(1)
@@ -0,0 +1,95 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process instrumentation for the server: counters, gauges and latency
+# histograms, cheap enough to leave on in production. The server exposes a
+# snapshot through the STATS command.
+
+# Histogram bucket upper bounds in milliseconds (the last bucket is everything slower)
+BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+# Fixed-bucket latency histogram; percentiles are reported as the bucket's upper bound
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0      # milliseconds
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        rank = pct / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS_MS[index], self.max) if index < len(BUCKETS_MS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max, 3),
+            "buckets": {(f"le_{bound}" if index < len(BUCKETS_MS) else "inf"): count
+                        for index, (bound, count) in enumerate(zip(BUCKETS_MS + (None,), self.counts)) if count},
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Move a gauge up or down (e.g. +1 on connect, -1 on disconnect)
+    def adjust(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    # Time a with-block into the `name` histogram (recorded even if it raises)
+    @contextmanager
+    def timed(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_s": round(time.time() - self.started, 1),
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+                "histograms": {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+            }
+
+
+# Shared by the server, backend and rate cache in this process
+metrics = Metrics()
@@ -0,0 +1,183 @@
+import json
+import lzma
+import struct
+import zlib
+
+# Wire format shared by client.py and server.py.
+#
+# Legacy clients send raw UTF-8 text and read replies until a short recv.
+# Clients that open with PROTOCOL_HELLO switch the connection to framed
+# mode: every message is a fixed header (payload length + flags) followed
+# by exactly that many payload bytes.
+#
+# The hello may also offer compression codecs ("PROTO 2 zlib,lzma"); the server
+# acknowledges with the one it picked ("OK 2 zlib") or none ("OK 2"). From then on
+# either side may send a payload compressed with that codec, marked FLAG_COMPRESSED.
+# Only payloads of at least a threshold size are compressed, and only when that
+# makes them smaller.
+
+PROTOCOL_VERSION = 2
+PROTOCOL_HELLO = f"PROTO {PROTOCOL_VERSION}"
+PROTOCOL_ACK = f"OK {PROTOCOL_VERSION}"
+
+HEADER = struct.Struct("!IB")   # payload length, flags
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Header flag bits
+FLAG_PUSH = 0x01        # Server-initiated event (e.g. a stock update), not a reply to a request
+FLAG_COMPRESSED = 0x02  # Payload is compressed with the codec negotiated in the hello
+
+# Codec name -> (compress function, decompressor factory), in the server's order of preference.
+# zlib is cheap enough for every reply; lzma shrinks more but costs several times the CPU.
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompressobj),
+    "lzma": (lzma.compress, lzma.LZMADecompressor),
+}
+COMPRESS_THRESHOLD = 1024   # Smaller payloads gain too little to be worth compressing
+
+# After SUBSCRIBE, framed clients receive FLAG_PUSH frames holding a JSON table of
+# stock changes: {"event": "stock", "version": n, "columns": [...], "rows": [...]}
+SUBSCRIBE_COMMAND = "SUBSCRIBE"
+UNSUBSCRIBE_COMMAND = "UNSUBSCRIBE"
+
+# A server at its session limit answers a new connection's first message with
+# "BUSY <reason>" and closes it; a session over its request rate gets a "BUSY <reason>"
+# reply instead of the command's result
+BUSY_REPLY = "BUSY"
+
+# Framed logins are answered "True <token>"; a reconnecting client can send
+# "RESUME <token>" instead of its username and password
+RESUME_COMMAND = "RESUME"
+
+# A batch request is "BATCH" followed by one command per line; the reply is a
+# JSON array holding each command's reply in order
+BATCH_COMMAND = "BATCH"
+
+# "VIEW IF-NONE-MATCH [<etag>]" asks for the product listing only if it changed: the reply is
+# "NOT_MODIFIED <etag>" while <etag> is still current, otherwise "ETAG <etag>" and the listing
+# (in the session's format) on the following lines
+VIEW_COMMAND = "VIEW"
+IF_NONE_MATCH = "IF-NONE-MATCH"
+NOT_MODIFIED = "NOT_MODIFIED"
+ETAG = "ETAG"
+
+# Column layouts for structured (FORMAT JSON) replies to VIEW, CART and HISTORY
+PRODUCT_COLUMNS = ("id", "name", "price", "stock")
+CART_COLUMNS = ("id", "name", "total", "qty")
+HISTORY_COLUMNS = ("id", "name", "qty", "total", "date", "user")
+
+# Column layouts for ANALYTICS replies (always JSON)
+TOP_SELLERS_COLUMNS = ("name", "units")
+TREND_COLUMNS = ("date", "units")
+REVENUE_COLUMNS = ("period", "revenue")
+
+# Column layout for pushed stock events (available stock after the change)
+STOCK_EVENT_COLUMNS = ("id", "stock")
+
+
+# Hello offering compression codecs in order of preference (plain PROTOCOL_HELLO if none)
+def encode_hello(codecs=()):
+    return f"{PROTOCOL_HELLO} {','.join(codecs)}" if codecs else PROTOCOL_HELLO
+
+
+# Codecs offered by a hello (an empty list if none), or None if `message` isn't a hello
+def decode_hello(message):
+    words = message.split()
+    if " ".join(words[:2]) != PROTOCOL_HELLO or len(words) > 3:
+        return None
+    return words[2].split(",") if len(words) == 3 else []
+
+
+# Codec the server accepted in its reply to the hello, or None
+def decode_ack(reply):
+    words = reply.split()
+    return words[2] if len(words) == 3 and words[2] in CODECS else None
+
+
+# Build a single frame ready to hand to socket.sendall / writer.write, compressing the
+# payload with `codec` if it is at least `threshold` bytes and compression pays off
+def encode_frame(payload, flags=0, codec=None, threshold=COMPRESS_THRESHOLD):
+    if codec and len(payload) >= threshold:
+        packed = CODECS[codec][0](payload)
+        if len(packed) < len(payload):
+            payload, flags = packed, flags | FLAG_COMPRESSED
+    return HEADER.pack(len(payload), flags) + payload
+
+
+# Undo FLAG_COMPRESSED, refusing output larger than MAX_FRAME_SIZE (a tiny frame can inflate enormously)
+def decompress_payload(payload, codec):
+    if codec not in CODECS:
+        raise ValueError("Compressed frame on a connection without a negotiated codec")
+    decompressor = CODECS[codec][1]()
+    data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    if not decompressor.eof:
+        raise ValueError("Compressed frame is truncated or exceeds the size limit")
+    return data
+
+
+# Read exactly `size` bytes straight into one preallocated buffer
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return buffer
+
+
+# Read one frame from a blocking socket and return (flags, payload), decompressing if flagged
+def recv_frame(sock, codec=None):
+    length, flags = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds limit")
+    payload = bytes(recv_exact(sock, length))
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload, codec)
+    return flags, payload
+
+
+# Read one frame from an asyncio StreamReader and return (flags, payload), decompressing if flagged
+async def read_frame(reader, codec=None):
+    length, flags = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds limit")
+    payload = await reader.readexactly(length)
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload, codec)
+    return flags, payload
+
+
+# Serialize rows as compact JSON: column names once, then one array per row
+def encode_table(columns, rows, **meta):
+    return json.dumps({**meta, "columns": columns, "rows": rows}, separators=(",", ":"))
+
+
+# Parse an encode_table reply into (table, list of per-row dicts)
+def decode_table(text):
+    table = json.loads(text)
+    columns = table["columns"]
+    return table, [dict(zip(columns, row)) for row in table["rows"]]
+
+
+# Reply to a conditional VIEW whose listing changed
+def encode_etag_reply(etag, body):
+    return f"{ETAG} {etag}\n{body}"
+
+
+# Split an encode_etag_reply reply back into (etag, body)
+def decode_etag_reply(reply):
+    header, _, body = reply.partition("\n")
+    return header[len(ETAG) + 1:], body
+
+
+# Pack several commands into one BATCH request
+def encode_batch(commands):
+    return "\n".join([BATCH_COMMAND, *commands])
+
+
+# Split a BATCH request back into its commands
+def decode_batch(request):
+    return [line.strip() for line in request.split("\n")[1:] if line.strip()]
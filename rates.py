@@ -0,0 +1,173 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from bs4 import BeautifulSoup
+
+from metrics import metrics
+
+CURRENCY_CODE = re.compile(r"[a-z]{3}")   # ISO 4217 style, e.g. usd, gbp
+
+# Exchange-rate lookups for VendingMachine. A provider knows how to fetch one
+# rate; RateCache sits in front of it so every session in the process shares
+# one fetch per currency pair and never waits on a scrape once a rate is known.
+
+
+# Base class for rate sources: return how many `target` units one `base` unit buys
+class RateProvider:
+    def fetch(self, base, target):
+        raise NotImplementedError
+
+
+# Scrapes exchangerate.guru (the original live source)
+class GuruRateProvider(RateProvider):
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+
+    def fetch(self, base, target):
+        url = f"https://exchangerate.guru/{base}/{target}"
+        response = requests.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        soup = BeautifulSoup(response.text, 'html.parser')
+        article = soup.find("article", class_="conversion-essense")
+        if article is None:
+            raise LookupError(f"No rate found for {base.upper()}->{target.upper()}")
+        rate_paragraph = article.find("p").text.strip()
+        match = re.search(r"=\s*([\d.]+)", rate_paragraph)
+        if not match:
+            raise LookupError(f"No rate found for {base.upper()}->{target.upper()}")
+        return float(match.group(1))
+
+
+# Reads rates from a local JSON file for offline runs, e.g. {"usd": {"gbp": 0.79, "inr": 83.1}}
+class FileRateProvider(RateProvider):
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, base, target):
+        with open(self.path, encoding="utf-8") as f:
+            table = json.load(f)
+        try:
+            return float(table[base.lower()][target.lower()])
+        except KeyError:
+            raise LookupError(f"No rate for {base.upper()}->{target.upper()} in {self.path}")
+
+
+# Process-wide TTL cache in front of a provider.
+#   fresh entry  -> returned immediately
+#   stale entry  -> returned immediately while one background refresh runs (stale-while-revalidate)
+#   missing      -> fetched once; concurrent callers for the same pair wait for that single fetch
+# A background thread also refreshes known pairs before they go stale.
+class RateCache:
+    def __init__(self, provider, ttl=60 * 60, refresh_interval=15 * 60):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.rates = {}           # (base, target) -> (rate, fetched_at)
+        self.fetch_locks = {}     # (base, target) -> [Lock, callers], one in-flight fetch per pair
+        self.refreshing = set()
+        self.refresher = None
+
+    # Rate from `base` to `target`, fetching only when nothing usable is cached
+    def get_rate(self, target, base="usd"):
+        base, target = base.lower(), target.lower()
+        if not (valid_currency(base) and valid_currency(target)):
+            raise ValueError(f"Invalid currency code: {base.upper()}->{target.upper()}")
+        if base == target:
+            return 1
+        key = (base, target)
+
+        entry = self.rates.get(key)
+        if entry is not None:
+            rate, fetched_at = entry
+            if time.monotonic() - fetched_at >= self.ttl:
+                metrics.increment("rates.stale")
+                self.refresh_in_background(key)
+            else:
+                metrics.increment("rates.hit")
+            return rate
+
+        metrics.increment("rates.miss")
+        with self.fetching(key):
+            entry = self.rates.get(key)   # Another caller may have fetched it while we waited
+            if entry is not None:
+                return entry[0]
+            return self.refresh(key)
+
+    # Fetch a pair from the provider and store it
+    def refresh(self, key):
+        with metrics.timed("rates.fetch"):
+            rate = self.provider.fetch(*key)
+        with self.lock:
+            self.rates[key] = (rate, time.monotonic())
+        self.start_refresher()
+        return rate
+
+    # Hold the pair's fetch lock; it is dropped once no caller needs it, so pairs that
+    # fail to fetch don't leave a lock behind
+    @contextmanager
+    def fetching(self, key):
+        with self.lock:
+            entry = self.fetch_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.fetch_locks[key]
+
+    # Refresh one stale pair on a daemon thread; failures keep serving the stale rate
+    def refresh_in_background(self, key):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                with self.fetching(key):
+                    self.refresh(key)
+            except Exception as e:
+                print(f"[!] Rate refresh for {key[0].upper()}->{key[1].upper()} failed, serving stale rate: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, name="rate-refresh", daemon=True).start()
+
+    # Start the periodic refresher once the first rate is cached
+    def start_refresher(self):
+        if self.refresher is not None or not self.refresh_interval:
+            return
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self.refresh_forever, name="rate-refresher", daemon=True)
+                self.refresher.start()
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            for key in list(self.rates):
+                self.refresh_in_background(key)
+
+
+# True for a three-letter lowercase code; anything else never reaches a provider
+def valid_currency(code):
+    return CURRENCY_CODE.fullmatch(code) is not None
+
+
+# Shared by every VendingMachine in this process; see configure_rates
+rate_cache = RateCache(GuruRateProvider())
+
+
+# Swap the rate source (e.g. FileRateProvider for offline runs) and/or cache TTL
+def configure_rates(provider=None, ttl=60 * 60):
+    global rate_cache
+    rate_cache = RateCache(provider or GuruRateProvider(), ttl=ttl, refresh_interval=ttl / 4)
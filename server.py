@@ -1,156 +1,895 @@
+import argparse
+import asyncio
+import json
+import os
+import select
+import signal
+import sys
 import threading
+import time
 import traceback
-from socket import AF_INET, SOCK_STREAM, socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, socket
+try:
+    from socket import MSG_DONTWAIT
+except ImportError:     # Windows
+    MSG_DONTWAIT = 0
 
-from backend import VendingMachine, Cart, UserAuth  # Custom modules
+from backend import (VendingMachine, Cart, UserAuth, DB_PATH, configure_database, sales_analytics,  # Custom modules
+                     stock_events, configure_shared_state, release_worker_holds, configure_journal, listing_cache)
+from rates import FileRateProvider, configure_rates, valid_currency
+from auth import session_tokens
+from metrics import metrics
+from protocol import (PROTOCOL_ACK, HEADER, CODECS, COMPRESS_THRESHOLD, PRODUCT_COLUMNS, CART_COLUMNS, HISTORY_COLUMNS, BATCH_COMMAND,
+                      TOP_SELLERS_COLUMNS, TREND_COLUMNS, REVENUE_COLUMNS, STOCK_EVENT_COLUMNS, FLAG_PUSH,
+                      SUBSCRIBE_COMMAND, UNSUBSCRIBE_COMMAND, RESUME_COMMAND, IF_NONE_MATCH, NOT_MODIFIED, BUSY_REPLY,
+                      encode_etag_reply, encode_frame, recv_frame, read_frame, encode_table, decode_batch, decode_hello)
+
+# Command names tracked by the metrics; anything else is counted as OTHER
+COMMAND_NAMES = {"VIEW", "FORMAT", "ADD", "REMOVE", "CART", "RECEIPT", "CHECKOUT", "ANALYTICS", "HISTORY",
+                 "HISTORY_PAGE", "CHANGE_STOCK", "CURRENCY", "SUBSCRIBE", "UNSUBSCRIBE", "STATS", "EXIT", BATCH_COMMAND}
+
+
+# Metric name for a request, e.g. "ADD 3 1" -> "ADD", "HISTORY PAGE limit=5" -> "HISTORY_PAGE"
+def command_name(request):
+    words = request.upper().split()
+    if not words:
+        return "OTHER"
+    if words[:2] == ["HISTORY", "PAGE"]:
+        return "HISTORY_PAGE"
+    return words[0] if words[0] in COMMAND_NAMES else "OTHER"
+
+
+SERVER_BUSY = f"{BUSY_REPLY} Too many active sessions, try again later."
+RATE_LIMITED = f"{BUSY_REPLY} Too many requests, slow down."
+MAX_PUSH_BACKLOG = 256 * 1024   # Unsent push bytes an asyncio client may pile up before it is dropped
+OFFLOAD_COMPRESS_MIN = 16 * 1024    # Replies at least this large are compressed off the asyncio event loop
+MAX_PUSH_QUEUE = 64             # Pushes a threaded client may have waiting behind a reply before it is dropped
+
+
+# First codec the client offered that this server supports, or None (also when compression is off)
+def choose_codec(offered, compress_min):
+    if compress_min <= 0:
+        return None
+    return next((name for name in offered if name in CODECS), None)
+
+
+# Frame a payload for a client, compressed if the connection negotiated a codec and it is at
+# least `compress_min` bytes; compressed frames and bytes saved are counted in the metrics
+def frame_payload(data, codec, compress_min, flags=0):
+    frame = encode_frame(data, flags, codec, compress_min)
+    saved = len(data) + HEADER.size - len(frame)
+    if saved > 0:
+        metrics.increment("io.compressed_frames")
+        metrics.increment("io.compressed_bytes_saved", saved)
+    return frame
+
+
+# True if the socket's send buffer has room, i.e. a small write won't block
+def writable(sock):
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(0))
+    return bool(select.select([], [sock], [], 0)[1])
+
+
+# Rate-limit tokens a request costs: one per command, so a BATCH pays for everything it runs
+def request_cost(request):
+    if request.upper().startswith(BATCH_COMMAND):
+        return max(len(decode_batch(request)), 1)
+    return 1
+
+
+# Per-session request rate limit: `rate` requests per second on average, in bursts of up to `burst`
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Spend `cost` tokens (capped at the burst size) if available; False means over the limit
+    def take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+# Per-client state carried between requests
+class Session:
+    def __init__(self, inventory, cart, username=None):
+        self.inventory = inventory
+        self.cart = cart
+        self.username = username
+        self.response_format = "text"   # "text" tables or "json" rows (FORMAT command)
+        self.push = None                # Thread-safe push sender; only framed connections have one
+        self.subscription = None        # stock_events token while SUBSCRIBEd
+        self.limiter = None             # TokenBucket when the server rate-limits requests
+
+# Wraps a client socket so the session loop doesn't care whether the client
+# speaks the legacy raw-text protocol or the framed one
+class Connection:
+    def __init__(self, sock, bufsize, compress_min=COMPRESS_THRESHOLD):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.compress_min = compress_min    # Smallest reply worth compressing; 0 turns compression off
+        self.framed = False
+        self.codec = None                   # Compression codec agreed in the hello, if any
+        self.send_lock = threading.Lock()   # Replies and pushes come from different threads
+        self.outbox = deque()               # Push frames waiting for the socket, see send_push()
+
+    # Seconds a read or write may wait on the client before raising TimeoutError (None: forever)
+    def set_timeout(self, seconds):
+        self.sock.settimeout(seconds or None)
+
+    # Receive one request as text
+    def recv_message(self):
+        if self.framed:
+            _, payload = recv_frame(self.sock, self.codec)
+            return payload.decode("utf-8").strip()
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        return data.decode().strip()
+
+    # Send one reply as text
+    def send_message(self, message):
+        data = message.encode("utf-8")
+        if self.framed:
+            data = frame_payload(data, self.codec, self.compress_min)
+        with self.send_lock:
+            self.sock.sendall(data)
+        self.flush_pushes()
+
+    # Send a server-initiated event frame; safe to call from any thread and never blocks the
+    # caller (the dispatcher). The frame is queued; if a reply is being sent, the session thread
+    # sends it afterwards, otherwise it goes out now. A client that has stopped reading is
+    # disconnected rather than buffered for: too many queued pushes, or a socket that can't
+    # take a whole frame without waiting, cuts the connection.
+    def send_push(self, message):
+        frame = frame_payload(message.encode("utf-8"), self.codec, self.compress_min, FLAG_PUSH)
+        if len(self.outbox) >= MAX_PUSH_QUEUE:
+            self.abort()
+            raise ConnectionError("Client is not reading its pushes")
+        self.outbox.append(frame)
+        self.flush_pushes()
+
+    # Send queued pushes unless another thread is sending; loops in case a push was queued
+    # just as that thread finished
+    def flush_pushes(self):
+        while self.outbox:
+            if not self.send_lock.acquire(blocking=False):
+                return          # The thread holding it flushes when it is done
+            try:
+                while self.outbox:
+                    self.send_nowait(self.outbox.popleft())
+            finally:
+                self.send_lock.release()
+
+    # Write a whole frame without waiting; a partial write would leave the stream mid-frame,
+    # so anything short of the full frame drops the client
+    def send_nowait(self, frame):
+        try:
+            # Check first: on a socket with a timeout, send() waits for room before trying
+            sent = self.sock.send(frame, MSG_DONTWAIT) if writable(self.sock) else 0
+        except (BlockingIOError, InterruptedError, TimeoutError):
+            sent = 0
+        if sent < len(frame):
+            self.outbox.clear()
+            self.abort()
+            raise ConnectionError("Client is not reading its pushes")
+
+    # Cut the connection from another thread; the session thread's next read fails and cleans up
+    def abort(self):
+        metrics.increment("connections.slow_consumers")
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Switch to framed mode if the client opened with the protocol hello,
+    # agreeing on the first compression codec it offers that we support
+    def negotiate(self, first_message):
+        offered = decode_hello(first_message)
+        if offered is None:
+            return first_message
+        self.codec = choose_codec(offered, self.compress_min)
+        self.send_message(f"{PROTOCOL_ACK} {self.codec}" if self.codec else PROTOCOL_ACK)
+        self.framed = True
+        return self.recv_message()
+
+    def close(self):
+        self.sock.close()
+
+# asyncio counterpart of Connection built on a StreamReader/StreamWriter pair
+class AsyncConnection:
+    def __init__(self, reader, writer, bufsize, compress_min=COMPRESS_THRESHOLD, executor=None):
+        self.reader = reader
+        self.writer = writer
+        self.bufsize = bufsize
+        self.compress_min = compress_min
+        self.executor = executor            # Where large replies are compressed
+        self.framed = False
+        self.codec = None
+        self.timeout = None
+        self.loop = asyncio.get_running_loop()
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds or None
+
+    async def recv_message(self):
+        return await asyncio.wait_for(self.read_message(), self.timeout)
+
+    async def read_message(self):
+        if self.framed:
+            _, payload = await read_frame(self.reader, self.codec)
+            return payload.decode("utf-8").strip()
+        data = await self.reader.read(self.bufsize)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        return data.decode().strip()
+
+    async def send_message(self, message):
+        data = message.encode("utf-8")
+        if self.framed and self.codec and len(data) >= OFFLOAD_COMPRESS_MIN:
+            # Compressing a large listing would stall every other session on the loop
+            data = await self.loop.run_in_executor(self.executor, frame_payload, data, self.codec, self.compress_min)
+        elif self.framed:
+            data = frame_payload(data, self.codec, self.compress_min)
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    # Queue a server-initiated event frame from any thread; the event loop writes it
+    def send_push(self, message):
+        frame = frame_payload(message.encode("utf-8"), self.codec, self.compress_min, FLAG_PUSH)
+        self.loop.call_soon_threadsafe(self.write_push, frame)
+
+    # Drop a client whose unread pushes pile up instead of buffering them without limit
+    def write_push(self, frame):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_PUSH_BACKLOG:
+            metrics.increment("connections.slow_consumers")
+            self.writer.transport.abort()
+            return
+        self.writer.write(frame)
+
+    async def negotiate(self, first_message):
+        offered = decode_hello(first_message)
+        if offered is None:
+            return first_message
+        self.codec = choose_codec(offered, self.compress_min)
+        await self.send_message(f"{PROTOCOL_ACK} {self.codec}" if self.codec else PROTOCOL_ACK)
+        self.framed = True
+        return await self.recv_message()
+
+    def close(self):
+        self.writer.close()
 
 class Server:
-    def __init__(self):
-        self.HOST = "127.0.0.1"
-        self.PORT = 5556
+    def __init__(self, mode="thread", host="127.0.0.1", port=5556):
+        self.HOST = host
+        self.PORT = port
         self.ADDRESS = (self.HOST, self.PORT)
         self.BUFSIZE = 1024
+        self.BACKLOG = 128              # Pending connections queued by the OS
+        self.EXECUTOR_WORKERS = 16      # Threads for blocking work in asyncio mode
+        self.MAX_HISTORY_PAGE = 500     # Largest page a HISTORY PAGE request may ask for
+        self.MAX_TOP_SELLERS = 100      # Largest n an ANALYTICS TOP request may ask for (each n is cached)
+        self.COMPRESS_MIN = COMPRESS_THRESHOLD  # Smallest framed reply compressed for clients that negotiated it
+        self.LOGIN_TIMEOUT = 30         # Seconds a new connection has to log in
+        self.IDLE_TIMEOUT = 600         # Seconds a session may wait between requests (0: no limit)
+        self.REJECT_TIMEOUT = 2         # Seconds to wait for a turned-away client's first message
+        self.REJECT_WORKERS = 4         # Threads answering BUSY to turned-away clients (thread mode)
+        self.MAX_PENDING_REJECTIONS = 64    # Turned-away clients waiting for a BUSY; beyond this they are just closed
+        self.MAX_SESSIONS = 512         # Concurrent connections per process (0: no limit)
+        self.RATE_LIMIT = 50            # Requests per second per session, on average (0: no limit)
+        self.RATE_BURST = 100           # Requests a session may send back to back
+        self.active_sessions = 0
+        self.sessions_lock = threading.Lock()
+        self.pending_rejections = 0
+        self.rejecter = None            # Executor for reject_busy, started by run()
+        self.mode = mode
+        self.workers = {}               # Worker process IDs (multi-process mode only)
+        self.stopping = False
+        self.journal = None             # Write-behind journal, drained on shutdown (--journal only)
         self.initialize_server_socket()
 
     # Set up the server socket and begin listening for clients
     def initialize_server_socket(self):
         try:
             self.server_socket = socket(AF_INET, SOCK_STREAM)
+            self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)  # Restart without waiting out TIME_WAIT
             self.server_socket.bind(self.ADDRESS)
-            self.server_socket.listen(5)
-            print(f"[*] Server listening on {self.HOST}:{self.PORT}")
+            self.server_socket.listen(self.BACKLOG)
+            print(f"[*] Server listening on {self.HOST}:{self.PORT} ({self.mode} mode)")
         except Exception as e:
             print(f"[!] Server failed to start: {e}")
             exit()
 
+    # Run a single client request and return (reply, keep_connection_open). A request over the
+    # session's rate limit is refused whole; a BATCH costs one token per command.
+    def process_request(self, request, session):
+        if session.limiter and not session.limiter.take(request_cost(request)):
+            metrics.increment("commands.rate_limited")
+            if request.upper().startswith(BATCH_COMMAND):   # Still a JSON array, one BUSY per command
+                return json.dumps([RATE_LIMITED] * len(decode_batch(request)), separators=(",", ":")), True
+            return RATE_LIMITED, True
+        return self.run_command(request, session)
+
+    # Run one command (already admitted by the rate limiter), timing it per command name
+    def run_command(self, request, session):
+        name = command_name(request)
+        metrics.increment(f"commands.{name}")
+        with metrics.timed(f"command.{name}"):
+            return self.execute_request(request, session)
+
+    def execute_request(self, request, session):
+        inventory = session.inventory
+        cart = session.cart
+        structured = session.response_format == "json"
+
+        if request.upper().startswith(BATCH_COMMAND):
+            return self.process_batch(request, session)
+
+        elif request.lower().startswith("view"):
+            inventory.refresh_inventory()
+            etag, listing = self.product_listing(session)
+            condition = request.split()[1:]
+            if condition and condition[0].upper() == IF_NONE_MATCH:
+                if condition[1:] == [etag]:
+                    metrics.increment("view.not_modified")
+                    return f"{NOT_MODIFIED} {etag}", True
+                return encode_etag_reply(etag, listing), True
+            return listing, True
+
+        elif request.upper().startswith("FORMAT"):
+            try:
+                _, response_format = request.split()
+                response_format = response_format.lower()
+                if response_format not in ("text", "json"):
+                    raise ValueError(response_format)
+                session.response_format = response_format
+                return f"Format set to {response_format.upper()}.", True
+            except ValueError:
+                return "Invalid FORMAT. Use: FORMAT <TEXT|JSON>", True
+
+        elif request.lower().startswith("add"):
+            try:
+                _, pid, qty = request.split()
+                pid = int(pid)
+                qty = int(qty)
+                return cart.add_item(pid, qty, inventory.inventory), True
+            except Exception as e:
+                print(f"[ADD] Failed: {e}")
+                return "Invalid ADD format. Use: ADD <product_id> <quantity>\n", True
+
+        elif request.lower().startswith("remove"):
+            try:
+                _, pid, qty = request.split()
+                pid = int(pid)
+                qty = int(qty)
+                return cart.remove_item(pid, qty, inventory.inventory), True
+            except Exception:
+                return "Invalid REMOVE format. Use: REMOVE <product_id> <quantity>\n", True
+
+        elif request.lower().startswith("cart"):
+            if structured:
+                return encode_table(CART_COLUMNS, cart.cart_rows(inventory.rate),
+                                    currency=inventory.target_currency.upper()), True
+            return cart.view_items(rate=inventory.rate, currency=inventory.target_currency), True
+
+        elif request.lower().startswith("receipt"):
+            if cart.cart:
+                return inventory.generate_receipt(cart), True
+            return "Empty", True
+
+        elif request.lower().startswith("checkout"):
+            if cart.cart:
+                return inventory.checkout(cart, session.username), True
+            return "The cart is empty. Cannot proceed with checkout.", True
+
+        elif request.upper().startswith("ANALYTICS"):
+            return self.process_analytics(request, session), True
+
+        elif request.upper().startswith("HISTORY PAGE"):
+            return self.process_history_page(request, session), True
+
+        elif request.lower().startswith("history"):
+            if structured:
+                return encode_table(HISTORY_COLUMNS, inventory.transaction_rows(),
+                                    currency=inventory.target_currency.upper()), True
+            return inventory.get_transaction_history(), True
+
+        elif request.upper().startswith("CHANGE_STOCK"):
+            try:
+                _, pid, qty = request.split()
+                pid = int(pid)
+                qty = int(qty)
+                inventory.update_stock(pid, qty)
+                return f"Stock updated for Product ID {pid} to {qty}.", True
+            except Exception as e:
+                return f"Error updating stock: {e}", True
+
+        elif request.lower().startswith("currency"):
+            try:
+                _, new_currency = request.split()
+                if not valid_currency(new_currency.lower()):
+                    return "Currency must be a three-letter code, e.g. CURRENCY GBP.", True
+                inventory.rate = inventory.get_currency_exchange(new_currency.lower())
+                inventory.target_currency = new_currency.lower()
+                return f"Currency changed to {new_currency.upper()}.", True
+            except Exception as e:
+                print(f"[!] Currency change error: {e}")
+                return "Failed to change currency.", True
+
+        elif request.upper() == SUBSCRIBE_COMMAND:
+            return self.subscribe(session), True
+
+        elif request.upper() == UNSUBSCRIBE_COMMAND:
+            self.unsubscribe(session)
+            return "Unsubscribed from stock updates.", True
+
+        elif request.upper() == "STATS":
+            return json.dumps({**metrics.snapshot(), "worker": os.getpid()}, separators=(",", ":")), True
+
+        elif request.lower() == "exit":
+            return "Goodbye!", False
+
+        return "Invalid command.", True
+
+    # The session's product listing as (etag, text), from the listing cache shared by every
+    # session with the same format and currency
+    def product_listing(self, session):
+        inventory = session.inventory
+        currency = inventory.target_currency.upper()
+        if session.response_format == "json":
+            def render():
+                return encode_table(PRODUCT_COLUMNS, inventory.product_rows(), currency=currency)
+        else:
+            render = inventory.display_products
+        return listing_cache.get((session.response_format, currency, inventory.rate), render)
+
+    # Serve pre-aggregated sales data as JSON tables:
+    #   ANALYTICS TOP [n] | ANALYTICS TREND <product_id> | ANALYTICS REVENUE [DAY|MONTH|YEAR]
+    def process_analytics(self, request, session):
+        parts = request.split()
+        query = parts[1].upper() if len(parts) > 1 else ""
+        try:
+            if query == "TOP":
+                limit = int(parts[2]) if len(parts) > 2 else 5
+                if not 1 <= limit <= self.MAX_TOP_SELLERS:
+                    raise ValueError(limit)
+                return encode_table(TOP_SELLERS_COLUMNS, sales_analytics.top_sellers(limit))
+
+            elif query == "TREND":
+                pid = int(parts[2])
+                name, points = sales_analytics.product_trend(pid)
+                return encode_table(TREND_COLUMNS, points, product=name or f"ID {pid}")
+
+            elif query == "REVENUE":
+                period = parts[2].lower() if len(parts) > 2 else "day"
+                rate = session.inventory.rate
+                rows = [[label, round(total * rate, 2)] for label, total in sales_analytics.revenue(period)]
+                return encode_table(REVENUE_COLUMNS, rows, currency=session.inventory.target_currency.upper())
+
+        except (IndexError, ValueError, KeyError):
+            pass
+        return (f"Invalid ANALYTICS format. Use: ANALYTICS TOP [n, 1-{self.MAX_TOP_SELLERS}] | "
+                "TREND <product_id> | REVENUE [DAY|MONTH|YEAR]")
+
+    # Serve one page of history as JSON with a cursor for the next page:
+    #   HISTORY PAGE [after=<cursor>] [limit=N] [user=<name>] [product=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+    def process_history_page(self, request, session):
+        try:
+            options = dict(part.split("=", 1) for part in request.split()[2:])
+            limit = min(max(int(options.get("limit", 100)), 1), self.MAX_HISTORY_PAGE)
+            product_id = int(options["product"]) if "product" in options else None
+            rows, next_cursor = session.inventory.transaction_page(
+                after=options.get("after"), limit=limit, username=options.get("user"),
+                product_id=product_id, date_from=options.get("from"), date_to=options.get("to"))
+        except ValueError:
+            return ("Invalid HISTORY PAGE format. Use: HISTORY PAGE [after=<cursor>] [limit=N] "
+                    "[user=<name>] [product=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD]")
+        return encode_table(HISTORY_COLUMNS, rows, currency=session.inventory.target_currency.upper(),
+                            next=next_cursor)
+
+    # Start pushing stock changes to this session as FLAG_PUSH frames
+    def subscribe(self, session):
+        if session.push is None:
+            return "SUBSCRIBE requires the framed protocol."
+        if session.subscription is None:
+            def deliver(changes, version):
+                rows = [[pid, stock] for pid, stock in changes.items()]
+                session.push(encode_table(STOCK_EVENT_COLUMNS, rows, event="stock", version=version))
+            session.subscription = stock_events.subscribe(deliver)
+        return "Subscribed to stock updates."
+
+    def unsubscribe(self, session):
+        if session.subscription is not None:
+            stock_events.unsubscribe(session.subscription)
+            session.subscription = None
+
+    # Run every command in a BATCH request in order and reply with a JSON array of their replies.
+    # Processing stops after EXIT, which also closes the connection.
+    def process_batch(self, request, session):
+        replies = []
+        keep_open = True
+        for command in decode_batch(request):
+            if command.upper().startswith(BATCH_COMMAND):
+                replies.append("Nested BATCH is not allowed.")
+                continue
+            message, keep_open = self.run_command(command, session)   # The batch was charged as a whole
+            replies.append(message)
+            if not keep_open:
+                break
+        return json.dumps(replies, separators=(",", ":")), keep_open
+
+    @staticmethod
+    def is_resume(first_message):
+        return first_message.upper().startswith(RESUME_COMMAND + " ")
+
+    # Username carried by a valid "RESUME <token>" login, or None
+    def resume_session(self, first_message):
+        if not self.is_resume(first_message):
+            return None
+        username = session_tokens.verify(first_message.split(" ", 1)[1].strip())
+        metrics.increment("auth.resumed" if username else "auth.resume_rejected")
+        return username
+
+    # "True <token>" for framed clients (the token lets them RESUME later), plain "True"/"False" otherwise
+    def login_reply(self, user_flag, session, connection):
+        if user_flag and connection.framed:
+            return f"True {session_tokens.issue(session.username)}"
+        return str(user_flag)
+
+    # Claim a session slot; False when MAX_SESSIONS connections are already being served
+    def admit(self):
+        with self.sessions_lock:
+            if self.MAX_SESSIONS and self.active_sessions >= self.MAX_SESSIONS:
+                return False
+            self.active_sessions += 1
+            return True
+
+    def leave(self):
+        with self.sessions_lock:
+            self.active_sessions -= 1
+
+    # Request rate limiter for a new session, or None when rate limiting is off
+    def new_limiter(self):
+        return TokenBucket(self.RATE_LIMIT, self.RATE_BURST) if self.RATE_LIMIT > 0 else None
+
+    # Turn away a connection over MAX_SESSIONS. Its first message is read before answering
+    # BUSY, so closing doesn't reset the connection before the client sees the reply.
+    def reject_busy(self, client_socket, client_address):
+        print(f"[!] Rejecting {client_address}: {self.MAX_SESSIONS} sessions already active")
+        try:
+            client_socket.settimeout(self.REJECT_TIMEOUT)
+            client_socket.recv(self.BUFSIZE)
+            client_socket.sendall(SERVER_BUSY.encode("utf-8"))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+            with self.sessions_lock:
+                self.pending_rejections -= 1
+
+    # Hand a connection over MAX_SESSIONS to the small rejecter pool, so a connection flood
+    # can't create a thread per connection. Once MAX_PENDING_REJECTIONS are queued, further
+    # connections are closed at once without a BUSY reply.
+    def turn_away(self, client_socket, client_address):
+        metrics.increment("connections.rejected")
+        with self.sessions_lock:
+            queued = self.pending_rejections < self.MAX_PENDING_REJECTIONS
+            if queued:
+                self.pending_rejections += 1
+        if queued:
+            self.rejecter.submit(self.reject_busy, client_socket, client_address)
+        else:
+            metrics.increment("connections.dropped")
+            client_socket.close()
+
+    # Thread target: handle_client plus connection gauges and the session slot, whichever way it returns
+    def track_client(self, client_socket, client_address):
+        metrics.increment("connections.total")
+        metrics.adjust("connections.active", 1)
+        try:
+            self.handle_client(client_socket, client_address)
+        finally:
+            metrics.adjust("connections.active", -1)
+            self.leave()
+
     # Handle communication with a connected client
     def handle_client(self, client_socket, client_address):
         print(f"[+] Connected to {client_address}")
-        inventory = VendingMachine()
-        cart = Cart()
+        connection = Connection(client_socket, self.BUFSIZE, self.COMPRESS_MIN)
+        connection.set_timeout(self.LOGIN_TIMEOUT)
+        session = Session(VendingMachine(), Cart())
+        session.limiter = self.new_limiter()
 
-        # Handle login
-        username = client_socket.recv(self.BUFSIZE).decode().strip()
-        password = client_socket.recv(self.BUFSIZE).decode().strip()
-        login = UserAuth(username, password)
-        user_flag = login.authentication()
-        client_socket.send(str(user_flag).encode('utf-8'))
+        try:
+            # Handle login (the first message is either the protocol hello, the username or RESUME <token>)
+            first_message = connection.negotiate(connection.recv_message())
+            session.username = self.resume_session(first_message)
+            if session.username is not None:
+                user_flag = True
+            elif self.is_resume(first_message):
+                user_flag = False
+            else:
+                session.username = first_message
+                password = connection.recv_message()
+                with metrics.timed("auth.login"):     # Verification only, not the wait for the password
+                    user_flag = UserAuth(session.username, password).authentication()
+            connection.send_message(self.login_reply(user_flag, session, connection))
+            if connection.framed:
+                session.push = connection.send_push
 
-        if not user_flag:
-            try:
-                possible_exit = client_socket.recv(self.BUFSIZE).decode().strip()
-                if possible_exit.lower() == "exit":
-                    print(f"[-] Client {client_address} disconnected after failed login.")
-                    client_socket.close()
-                    return
-            except Exception as e:
-                print(f"[!] Error after failed login from {client_address}: {e}")
-                client_socket.close()
+            # A failed login never reaches the command loop; let the client send its EXIT first
+            if not user_flag:
+                try:
+                    connection.recv_message()
+                except Exception as e:
+                    print(f"[!] Error after failed login from {client_address}: {e}")
+                print(f"[-] Client {client_address} disconnected after failed login.")
                 return
 
-        try:
+            connection.set_timeout(self.IDLE_TIMEOUT)
             while True:
-                request = client_socket.recv(self.BUFSIZE).decode().strip()
+                request = connection.recv_message()
+                message, keep_open = self.process_request(request, session)
 
-                if request.lower().startswith("view"):
-                    inventory.refresh_inventory()
-                    message = inventory.display_products(cart)
-                    client_socket.send(message.encode("utf-8"))
-
-                elif request.lower().startswith("add"):
-                    try:
-                        _, pid, qty = request.split()
-                        pid = int(pid)
-                        qty = int(qty)
-                        message = cart.add_item(pid, qty, inventory.inventory)
-                        client_socket.send(message.encode("utf-8"))
-                    except Exception as e:
-                        print(f"[ADD] Failed: {e}")
-                        client_socket.send("Invalid ADD format. Use: ADD <product_id> <quantity>\n".encode("utf-8"))
-
-                elif request.lower().startswith("remove"):
-                    try:
-                        _, pid, qty = request.split()
-                        pid = int(pid)
-                        qty = int(qty)
-                        message = cart.remove_item(pid, qty, inventory.inventory)
-                        client_socket.send(message.encode("utf-8"))
-                    except Exception:
-                        client_socket.send("Invalid REMOVE format. Use: REMOVE <product_id> <quantity>\n".encode("utf-8"))
-
-                elif request.lower().startswith("cart"):
-                    cart_details = cart.view_items(rate=inventory.rate, currency=inventory.target_currency)
-                    client_socket.send(cart_details.encode("utf-8"))
-
-                elif request.lower().startswith("receipt"):
-                    if cart.cart:
-                        receipt = inventory.generate_receipt(cart)
-                        client_socket.send(receipt.encode("utf-8"))
-                    else:
-                        client_socket.send("Empty".encode("utf-8"))
-
-                elif request.lower().startswith("checkout"):
-                    if cart.cart:
-                        checkout = inventory.checkout(cart, username)
-                        client_socket.send(checkout.encode('utf-8'))
-                    else:
-                        client_socket.send("The cart is empty. Cannot proceed with checkout.".encode("utf-8"))
-
-                elif request.lower().startswith("history"):
-                    history = inventory.get_transaction_history()
-                    client_socket.send(history.encode('utf-8'))
-
-                elif request.upper().startswith("CHANGE_STOCK"):
-                    try:
-                        _, pid, qty = request.split()
-                        pid = int(pid)
-                        qty = int(qty)
-                        inventory.update_stock(pid, qty)
-                        client_socket.send(f"Stock updated for Product ID {pid} to {qty}.".encode("utf-8"))
-                    except Exception as e:
-                        client_socket.send(f"Error updating stock: {e}".encode("utf-8"))
-
-                elif request.lower().startswith("currency"):
-                    try:
-                        _, new_currency = request.split()
-                        inventory.target_currency = new_currency.lower()
-                        inventory.rate = inventory.get_currency_exchange()
-                        client_socket.send(f"Currency changed to {new_currency.upper()}.".encode("utf-8"))
-                    except Exception as e:
-                        print(f"[!] Currency change error: {e}")
-                        client_socket.send("Failed to change currency.".encode("utf-8"))
-
-                elif request.lower() == "exit":
+                if not keep_open:
                     try:
-                        client_socket.send("Goodbye!".encode("utf-8"))
+                        connection.send_message(message)
                     except ConnectionResetError:
                         print(f"[!] Client {client_address} disconnected before goodbye message.")
                     break
 
-                else:
-                    client_socket.send("Invalid command.".encode("utf-8"))
+                with metrics.timed("io.send"):
+                    connection.send_message(message)
 
+        except TimeoutError:
+            metrics.increment("connections.timed_out")
+            print(f"[!] Client {client_address} timed out.")
         except ConnectionResetError:
             print(f"[!] Client {client_address} disconnected unexpectedly.")
         except ConnectionAbortedError:
             print(f"[!] Connection aborted by client {client_address}.")
+        except ConnectionError:
+            print(f"[!] Client {client_address} closed the connection.")
         except Exception as e:
+            metrics.increment("errors.unhandled")
             print(f"[!] Error with {client_address}: {e}")
             traceback.print_exc()
         finally:
-            client_socket.close()
+            self.unsubscribe(session)
+            session.cart.release_reservations()  # Held stock goes back to other sessions
+            connection.close()
             print(f"[-] Disconnected from {client_address}")
 
+    # asyncio counterpart of reject_busy
+    async def reject_busy_async(self, reader, writer, client_address):
+        metrics.increment("connections.rejected")
+        print(f"[!] Rejecting {client_address}: {self.MAX_SESSIONS} sessions already active")
+        try:
+            await asyncio.wait_for(reader.read(self.BUFSIZE), self.REJECT_TIMEOUT)
+            writer.write(SERVER_BUSY.encode("utf-8"))
+            await asyncio.wait_for(writer.drain(), self.REJECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    # Same session flow as handle_client, but on the event loop; blocking
+    # SQLite and exchange-rate work runs on the bounded executor
+    async def handle_client_async(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        if not self.admit():
+            await self.reject_busy_async(reader, writer, client_address)
+            return
+        connection = AsyncConnection(reader, writer, self.BUFSIZE, self.COMPRESS_MIN, self.executor)
+        connection.set_timeout(self.LOGIN_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        session = None
+        metrics.increment("connections.total")
+        metrics.adjust("connections.active", 1)
+        print(f"[+] Connected to {client_address}")
+
+        try:
+            session = Session(await loop.run_in_executor(self.executor, VendingMachine), Cart())
+            session.limiter = self.new_limiter()
+
+            # Handle login (the first message is either the protocol hello, the username or RESUME <token>)
+            first_message = await connection.negotiate(await connection.recv_message())
+            session.username = self.resume_session(first_message)
+            if session.username is not None:
+                user_flag = True
+            elif self.is_resume(first_message):
+                user_flag = False
+            else:
+                session.username = first_message
+                password = await connection.recv_message()
+                login = UserAuth(session.username, password)
+                with metrics.timed("auth.login"):     # Verification only, not the wait for the password
+                    user_flag = await loop.run_in_executor(self.executor, login.authentication)
+            await connection.send_message(self.login_reply(user_flag, session, connection))
+            if connection.framed:
+                session.push = connection.send_push
+
+            # A failed login never reaches the command loop; let the client send its EXIT first
+            if not user_flag:
+                await connection.recv_message()
+                print(f"[-] Client {client_address} disconnected after failed login.")
+                return
+
+            connection.set_timeout(self.IDLE_TIMEOUT)
+            while True:
+                request = await connection.recv_message()
+                message, keep_open = await loop.run_in_executor(
+                    self.executor, self.process_request, request, session)
+                with metrics.timed("io.send"):
+                    await connection.send_message(message)
+                if not keep_open:
+                    break
+
+        except (TimeoutError, asyncio.TimeoutError):
+            metrics.increment("connections.timed_out")
+            print(f"[!] Client {client_address} timed out.")
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            print(f"[!] Client {client_address} disconnected unexpectedly.")
+        except ConnectionAbortedError:
+            print(f"[!] Connection aborted by client {client_address}.")
+        except ConnectionError:
+            print(f"[!] Client {client_address} closed the connection.")
+        except Exception as e:
+            metrics.increment("errors.unhandled")
+            print(f"[!] Error with {client_address}: {e}")
+            traceback.print_exc()
+        finally:
+            if session is not None:
+                self.unsubscribe(session)
+                session.cart.release_reservations()  # Held stock goes back to other sessions
+            connection.close()
+            metrics.adjust("connections.active", -1)
+            self.leave()
+            print(f"[-] Disconnected from {client_address}")
+
+    # Accept connections on a single event loop instead of one thread each
+    async def serve_async(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.EXECUTOR_WORKERS)
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket,
+                                            backlog=self.BACKLOG)
+        async with server:
+            await server.serve_forever()
+
     # Accept and handle new client connections using threads
     def run(self):
+        if self.mode == "asyncio":
+            asyncio.run(self.serve_async())
+            return
+
+        self.rejecter = ThreadPoolExecutor(max_workers=self.REJECT_WORKERS, thread_name_prefix="reject")
         while True:
             client, client_address = self.server_socket.accept()
+            if not self.admit():
+                self.turn_away(client, client_address)
+                continue
             print(f"[+] Server Online — Connection from {client_address}")
-            thread = threading.Thread(target=self.handle_client, args=(client, client_address))
+            thread = threading.Thread(target=self.track_client, args=(client, client_address))
             thread.start()
             print(f"[=] Active Connections: {threading.active_count() - 1}")
 
+    # Pre-fork `count` worker processes that all accept on the listening socket inherited
+    # from this one, and restart any that die. Stock and cart holds are coordinated through
+    # SQLite (backend.configure_shared_state), so call that before forking.
+    def serve_workers(self, count):
+        if not hasattr(os, "fork"):
+            print("[!] --workers requires a platform with os.fork")
+            exit()
+
+        signal.signal(signal.SIGTERM, self.stop_workers)
+        signal.signal(signal.SIGINT, self.stop_workers)
+        for _ in range(count):
+            self.spawn_worker()
+
+        while True:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.workers.pop(pid, None)
+            release_worker_holds(pid)   # Its sessions are gone; give their held stock back
+            if not self.stopping:
+                print(f"[!] Worker {pid} exited with status {status}, restarting")
+                self.spawn_worker()
+        print("[*] All workers stopped")
+
+    def spawn_worker(self):
+        sys.stdout.flush()              # Don't let the child inherit (and repeat) buffered output
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = True
+            print(f"[*] Worker {pid} started")
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # The supervisor handles Ctrl-C for everyone
+        try:
+            self.run()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            os._exit(1)
+
+    def stop_workers(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # SIGTERM/SIGINT with a write-behind journal: apply everything journaled so the database
+    # is current, then exit (anything left over is replayed on the next start)
+    def stop_with_journal(self, signum, frame):
+        print("[*] Applying journaled writes before exit...")
+        if not self.journal.drain():
+            print("[!] Some journaled writes were not applied; they will be replayed on the next start")
+        sys.stdout.flush()
+        os._exit(0)
+
 # Entry point for server
 if __name__ == "__main__":
-    server = Server()
-    server.run()
+    parser = argparse.ArgumentParser(description="Smart Vending Machine server")
+    parser.add_argument("--mode", choices=["thread", "asyncio"], default="thread",
+                        help="thread: one thread per client, asyncio: single event loop")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5556, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the listening socket (each runs --mode); 1 = no fork")
+    parser.add_argument("--compress-min", type=int, default=COMPRESS_THRESHOLD,
+                        help="Smallest reply (bytes) compressed for clients that negotiate compression; 0 = never")
+    parser.add_argument("--idle-timeout", type=float, default=600,
+                        help="Close sessions idle for this many seconds (0 = never)")
+    parser.add_argument("--max-sessions", type=int, default=512,
+                        help="Concurrent sessions per process; extra connections get a BUSY reply (0 = no limit)")
+    parser.add_argument("--rate-limit", type=float, default=50,
+                        help="Average requests per second allowed per session (0 = no limit)")
+    parser.add_argument("--rate-burst", type=int, default=100, help="Requests a session may send back to back")
+    parser.add_argument("--journal", help="Write checkouts and stock edits to this write-behind journal file "
+                                          "first (single process only; incompatible with --workers)")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite database file")
+    parser.add_argument("--pool-size", type=int, default=8, help="Number of pooled SQLite connections")
+    parser.add_argument("--rates-file", help="Read exchange rates from a local JSON file instead of the web")
+    parser.add_argument("--rates-ttl", type=float, default=3600, help="Seconds before a cached exchange rate is refreshed")
+    args = parser.parse_args()
+
+    configure_database(args.db, args.pool_size)
+    configure_rates(FileRateProvider(args.rates_file) if args.rates_file else None, ttl=args.rates_ttl)
+    if args.journal and args.workers > 1:
+        print("[!] --journal keeps the authoritative stock in one process and can't be combined with --workers")
+        exit()
+    if args.workers > 1:
+        configure_shared_state()
+        session_tokens.signing_key()    # Load (or create) the secret once, before the workers fork
+    server = Server(mode=args.mode, host=args.host, port=args.port)
+    server.COMPRESS_MIN = args.compress_min
+    server.IDLE_TIMEOUT = args.idle_timeout
+    server.MAX_SESSIONS = args.max_sessions
+    server.RATE_LIMIT = args.rate_limit
+    server.RATE_BURST = args.rate_burst
+    if args.journal:
+        server.journal = configure_journal(args.journal)
+        signal.signal(signal.SIGTERM, server.stop_with_journal)
+        signal.signal(signal.SIGINT, server.stop_with_journal)
+    if args.workers > 1:
+        server.serve_workers(args.workers)
+    else:
+        server.run()
@@ -0,0 +1,94 @@
+import time
+
+from auth import AUTH_SECRET_ENV, CredentialCache, LoginFailures, SessionTokens, hash_password, load_secret, verify_password
+
+FAST = 1000     # PBKDF2 iterations for tests; the real count makes every hash take a while
+
+
+def test_hashes_are_salted_and_verify():
+    first, second = hash_password("hunter2", iterations=FAST), hash_password("hunter2", iterations=FAST)
+    assert first != second
+    assert verify_password("hunter2", first)[0]
+    assert not verify_password("hunter3", first)[0]
+
+
+def test_rehash_is_flagged_for_plaintext_and_weak_hashes():
+    assert verify_password("hunter2", "hunter2") == (True, True)       # Legacy plaintext row
+    assert verify_password("hunter3", "hunter2") == (False, True)
+    assert verify_password("hunter2", hash_password("hunter2", iterations=FAST)) == (True, True)
+    assert verify_password("hunter2", hash_password("hunter2")) == (True, False)
+
+
+def test_malformed_hashes_never_match(capsys):
+    for stored in ("pbkdf2_sha256$", "pbkdf2_sha256$lots$AAAA$AAAA", "pbkdf2_sha256$1000$not base64$AAAA"):
+        assert verify_password("", stored) == (False, False)
+    assert verify_password("hunter2", None) == (False, False)
+    assert "malformed password hash" in capsys.readouterr().out
+
+
+def test_repeated_failures_lock_the_username_out():
+    failures = LoginFailures(max_failures=3, lockout=0.05)
+    for _ in range(2):
+        failures.record_failure("alice")
+    assert not failures.locked("alice")
+    failures.record_failure("alice")
+    assert failures.locked("alice")
+    assert not failures.locked("bob")
+    time.sleep(0.08)
+    assert not failures.locked("alice")
+
+
+def test_a_successful_login_clears_earlier_failures():
+    cache = CredentialCache(failures=LoginFailures(max_failures=2, lockout=60))
+    stored = hash_password("hunter2", iterations=FAST)
+    cache.record_failure("alice")
+    cache.record_success("alice", "hunter2", stored)
+    cache.record_failure("alice")
+    assert not cache.locked("alice")
+
+
+def test_cached_login_matches_only_the_same_password_and_stored_hash():
+    cache = CredentialCache()
+    stored = hash_password("hunter2", iterations=FAST)
+    assert not cache.check("alice", "hunter2", stored)
+    cache.record_success("alice", "hunter2", stored)
+    assert cache.check("alice", "hunter2", stored)
+    assert not cache.check("alice", "hunter3", stored)
+    assert not cache.check("alice", "hunter2", hash_password("hunter2", iterations=FAST))   # Password changed
+    assert not cache.check("alice", "hunter2", None)                                         # User deleted
+    cache.record_failure("alice")
+    assert not cache.check("alice", "hunter2", stored)
+
+
+def test_cached_logins_expire_and_are_bounded():
+    cache = CredentialCache(max_entries=2, ttl=0.05)
+    for user in ("alice", "bob", "carol"):
+        cache.record_success(user, "pw", "stored")
+    assert list(cache.verified) == ["bob", "carol"]
+    time.sleep(0.08)
+    assert not cache.check("carol", "pw", "stored")
+
+
+def test_session_tokens_round_trip_and_reject_tampering():
+    tokens = SessionTokens(secret=b"k" * 32)
+    token = tokens.issue("alice")
+    assert tokens.verify(token) == "alice"
+    assert SessionTokens(secret=b"k" * 32).verify(token) == "alice"   # Another worker with the same secret
+    assert SessionTokens(secret=b"x" * 32).verify(token) is None
+    user, expires, signature = token.split(".")
+    assert tokens.verify(f"{user}.{int(expires) + 3600}.{signature}") is None
+    assert tokens.verify("not a token") is None
+
+
+def test_expired_session_tokens_are_refused():
+    tokens = SessionTokens(ttl=-1, secret=b"k" * 32)
+    assert tokens.verify(tokens.issue("alice")) is None
+
+
+def test_secret_file_is_created_once_and_reused(tmp_path, monkeypatch):
+    monkeypatch.delenv(AUTH_SECRET_ENV, raising=False)
+    path = str(tmp_path / ".auth_secret")
+    secret = load_secret(path)
+    assert secret and load_secret(path) == secret
+    monkeypatch.setenv(AUTH_SECRET_ENV, "from the environment")
+    assert load_secret(path) == b"from the environment"
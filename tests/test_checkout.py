@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+import backend
+from backend import Cart, ConnectionPool, InventoryStore, ReservationBook, VendingMachine
+
+SCHEMA = """
+    CREATE TABLE Products (productID INTEGER PRIMARY KEY AUTOINCREMENT, productName TEXT NOT NULL,
+                           price REAL NOT NULL, stock INTEGER NOT NULL);
+    CREATE TABLE CartTransactions (transactionID INTEGER PRIMARY KEY AUTOINCREMENT, productID INTEGER NOT NULL,
+                                   quantity INTEGER NOT NULL, totalPrice REAL NOT NULL,
+                                   transactionDate TIMESTAMP DEFAULT CURRENT_TIMESTAMP, username TEXT);
+    INSERT INTO Products VALUES (1, 'Bluetooth Speaker', 39.99, 5), (2, 'USB-C Cable', 9.99, 2);
+"""
+
+
+# Vending machine on a throwaway database with its own product cache
+@pytest.fixture
+def machine(tmp_path, monkeypatch):
+    path = str(tmp_path / "vending.db")
+    with sqlite3.connect(path) as conn:
+        conn.executescript(SCHEMA)
+    pool = ConnectionPool(path, size=2)
+    monkeypatch.setattr(backend, "db_pool", pool)
+    monkeypatch.setattr(backend, "inventory_store", InventoryStore())
+    monkeypatch.setattr(backend, "shared_state", None)
+    monkeypatch.setattr(backend, "transaction_journal", None)
+    yield VendingMachine("usd")
+    pool.close_all()
+
+
+# {productID: stock} as committed to the database
+def database_stock():
+    with backend.db_pool.connection("test") as conn:
+        return dict(conn.execute("SELECT productID, stock FROM Products").fetchall())
+
+
+# (productID, quantity) for every recorded sale
+def sales():
+    with backend.db_pool.connection("test") as conn:
+        return conn.execute("SELECT productID, quantity FROM CartTransactions ORDER BY productID").fetchall()
+
+
+# Cart holding 3 speakers and 2 cables, reserved against the machine's stock
+def full_cart(machine):
+    cart = Cart(ReservationBook(reap_interval=3600))
+    cart.add_item(1, 3, machine.inventory)
+    cart.add_item(2, 2, machine.inventory)
+    return cart
+
+
+def test_checkout_takes_every_line_off_the_stock(machine):
+    cart = full_cart(machine)
+    assert machine.checkout(cart, "alice") == "\nPurchase completed and saved!"
+    assert database_stock() == {1: 2, 2: 0}
+    assert machine.inventory[1].stock == 2 and machine.inventory[2].stock == 0
+    assert sales() == [(1, 3), (2, 2)]
+    assert not cart.cart
+
+
+def test_shortfall_on_one_line_leaves_every_line_untouched(machine):
+    cart = full_cart(machine)
+    with backend.db_pool.connection("test") as conn:    # Another worker sells a cable behind this one's cache
+        conn.execute("UPDATE Products SET stock = 1 WHERE productID = 2")
+        conn.commit()
+
+    reply = machine.checkout(cart, "alice")
+    assert reply == "Checkout failed: not enough stock for 'USB-C Cable' (requested 2, available 1)."
+    assert database_stock() == {1: 5, 2: 1}          # The speaker decrement was rolled back with the rest
+    assert sales() == []
+    assert machine.inventory[1].stock == 5
+    assert set(cart.cart) == {1, 2}                   # The cart is left as it was
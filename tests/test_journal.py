@@ -0,0 +1,173 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from journal import TransactionJournal
+
+
+# Journal whose flusher never wakes up during a test, so flush() runs only when called
+def make_journal(path, apply):
+    return TransactionJournal(str(path), apply, flush_interval=3600)
+
+
+# Write journal lines as a crashed server would have left them
+def write_log(path, entries, tail=b""):
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.write(json.dumps(entry).encode("utf-8") + b"\n")
+        f.write(tail)
+
+
+# Stand-in for apply_journal_entries: applies entries and records the checkpoint in one transaction
+class Database:
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE Applied (seq INTEGER PRIMARY KEY, value TEXT);
+            CREATE TABLE Checkpoint (id INTEGER PRIMARY KEY, seq INTEGER);
+            INSERT INTO Checkpoint VALUES (0, 0);
+        """)
+
+    def apply(self, entries):
+        with self.conn:
+            self.conn.executemany("INSERT INTO Applied VALUES (?, ?)", [(e["seq"], e["value"]) for e in entries])
+            self.conn.execute("UPDATE Checkpoint SET seq = ? WHERE id = 0", (entries[-1]["seq"],))
+
+    def checkpoint(self):
+        return self.conn.execute("SELECT seq FROM Checkpoint").fetchone()[0]
+
+    def values(self):
+        return [value for (value,) in self.conn.execute("SELECT value FROM Applied ORDER BY seq")]
+
+
+def test_open_replays_only_entries_after_the_checkpoint(tmp_path):
+    path = tmp_path / "tx.journal"
+    write_log(path, [{"seq": seq, "value": f"v{seq}"} for seq in (1, 2, 3)])
+    applied = []
+    journal = make_journal(path, applied.extend)
+
+    assert journal.open(applied_seq=1) == 2
+    assert [entry["seq"] for entry in applied] == [2, 3]
+    assert journal.applied_seq == journal.durable_seq == 3
+    assert journal.next_seq == 4
+    assert os.path.getsize(path) == 0      # Everything replayed is in the database; the log starts afresh
+
+
+def test_open_ignores_a_torn_last_line(tmp_path, capsys):
+    path = tmp_path / "tx.journal"
+    write_log(path, [{"seq": 1, "value": "v1"}, {"seq": 2, "value": "v2"}], tail=b'{"seq":3,"val')
+    applied = []
+    journal = make_journal(path, applied.extend)
+
+    assert journal.open() == 2
+    assert [entry["seq"] for entry in applied] == [1, 2]
+    assert journal.next_seq == 3           # The torn entry's number is reused; it was never durable
+    assert "incomplete journal record" in capsys.readouterr().out
+
+
+def test_open_without_a_log_file(tmp_path):
+    journal = make_journal(tmp_path / "tx.journal", lambda entries: pytest.fail("nothing to replay"))
+    assert journal.open(applied_seq=7) == 0
+    assert journal.next_seq == 8
+
+
+def test_replay_is_split_into_batches(tmp_path):
+    path = tmp_path / "tx.journal"
+    write_log(path, [{"seq": seq, "value": f"v{seq}"} for seq in range(1, 6)])
+    batches = []
+    journal = TransactionJournal(str(path), batches.append, flush_interval=3600, max_batch=2)
+    journal.open()
+    assert [[entry["seq"] for entry in batch] for batch in batches] == [[1, 2], [3, 4], [5]]
+
+
+def test_only_durable_entries_are_flushed(tmp_path):
+    batches = []
+    journal = make_journal(tmp_path / "tx.journal", batches.append)
+    journal.open()
+    first = journal.append({"value": "a"})
+    journal.wait_durable(first)
+    journal.append({"value": "b"})          # Appended but not yet fsynced
+
+    assert journal.flush() == 1
+    assert [entry["value"] for entry in batches[0]] == ["a"]
+    assert journal.flush() == 0
+    assert journal.applied_seq == first
+
+
+def test_waiters_share_one_fsync(tmp_path):
+    journal = make_journal(tmp_path / "tx.journal", lambda entries: None)
+    journal.open()
+    seqs = [journal.append({"value": str(n)}) for n in range(3)]
+    journal.wait_durable(seqs[0])           # Writes every buffered entry, not just the first
+    assert journal.durable_seq == seqs[-1]
+    assert not journal.buffer
+    with open(journal.path, "rb") as f:
+        assert [json.loads(line)["seq"] for line in f] == seqs
+
+
+def test_failed_write_refuses_further_appends(tmp_path, capsys):
+    journal = make_journal(tmp_path / "tx.journal", lambda entries: None)
+    journal.open()
+
+    def fail(data):
+        raise OSError("disk full")
+    journal.write_and_sync = fail
+
+    seq = journal.append({"value": "a"})
+    with pytest.raises(OSError):
+        journal.wait_durable(seq)
+    with pytest.raises(OSError):
+        journal.append({"value": "b"})
+    assert journal.flush() == 0            # Never durable, so never applied
+    assert "Journal write failed" in capsys.readouterr().out
+
+
+def test_checkpoint_prevents_double_apply_after_a_crash(tmp_path):
+    path = tmp_path / "tx.journal"
+    database = Database()
+    journal = make_journal(path, database.apply)
+    journal.open(database.checkpoint())
+    for value in ("a", "b", "c"):
+        journal.wait_durable(journal.append({"value": value}))
+    journal.flush()                         # a, b and c reach the database...
+    journal.wait_durable(journal.append({"value": "d"}))    # ...d is only in the log
+    os.close(journal.fd)                    # Crash: the log is left as it is
+
+    restarted = make_journal(path, database.apply)
+    assert restarted.open(database.checkpoint()) == 1
+    assert database.values() == ["a", "b", "c", "d"]
+    assert database.checkpoint() == 4
+    assert restarted.append({"value": "e"}) == 5
+
+
+def test_drain_applies_everything_durable(tmp_path):
+    database = Database()
+    journal = make_journal(tmp_path / "tx.journal", database.apply)
+    journal.open()
+    for value in ("a", "b"):
+        journal.wait_durable(journal.append({"value": value}))
+    assert journal.drain()
+    assert database.values() == ["a", "b"]
+
+
+def test_records_written_before_a_failed_fsync_are_not_replayed(tmp_path, monkeypatch):
+    path = tmp_path / "tx.journal"
+    database = Database()
+    journal = make_journal(path, database.apply)
+    journal.open()
+    journal.wait_durable(journal.append({"value": "a"}))
+
+    def fail(fd):
+        raise OSError("I/O error")
+    monkeypatch.setattr(os, "fdatasync" if hasattr(os, "fdatasync") else "fsync", fail)
+    seq = journal.append({"value": "b"})
+    with pytest.raises(OSError):
+        journal.wait_durable(seq)           # "b" reached the file, but the caller was told it failed
+    monkeypatch.undo()
+    os.close(journal.fd)
+
+    restarted = make_journal(path, database.apply)
+    assert restarted.open(database.checkpoint()) == 1
+    assert database.values() == ["a"]
@@ -0,0 +1,57 @@
+import backend
+from backend import ListingCache
+from client import Client
+from protocol import NOT_MODIFIED, decode_etag_reply, encode_etag_reply
+
+
+# Render function that counts its calls and returns the current `text`
+class Renderer:
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.text
+
+
+def test_etag_reply_round_trip():
+    body = "ID  Name\n1   Bluetooth Speaker\n2   USB-C Cable"
+    assert decode_etag_reply(encode_etag_reply("0123abcd", body)) == ("0123abcd", body)
+
+
+def test_listing_is_rendered_once_per_data_version(monkeypatch):
+    monkeypatch.setattr(backend.inventory_store, "version", 1)
+    cache = ListingCache()
+    render = Renderer("listing")
+
+    first = cache.get(("text", "usd", 1.0), render)
+    assert cache.get(("text", "usd", 1.0), render) == first
+    assert render.calls == 1
+
+    monkeypatch.setattr(backend.inventory_store, "version", 2)
+    assert cache.get(("text", "usd", 1.0), render) == first     # Same text after a re-render: same ETag
+    assert render.calls == 2
+
+    render.text = "changed listing"
+    monkeypatch.setattr(backend.reservation_book, "version", backend.reservation_book.version + 1)
+    etag, listing = cache.get(("text", "usd", 1.0), render)
+    assert listing == "changed listing" and etag != first[0]
+
+
+def test_listing_cache_keys_and_bound(monkeypatch):
+    monkeypatch.setattr(backend.inventory_store, "version", 1)
+    cache = ListingCache(max_entries=2)
+    for currency in ("usd", "eur", "gbp"):
+        cache.get(("text", currency, 1.0), Renderer(currency))
+    assert list(cache.entries) == [("text", "eur", 1.0), ("text", "gbp", 1.0)]
+
+
+def test_client_reuses_the_listing_it_already_has():
+    client = Client()
+    assert client.view_command() == "VIEW IF-NONE-MATCH"
+    assert client.accept_view(encode_etag_reply("aaaa", "listing one")) == "listing one"
+    assert client.view_command() == "VIEW IF-NONE-MATCH aaaa"
+    assert client.accept_view(f"{NOT_MODIFIED} aaaa") == "listing one"
+    assert client.accept_view(f"{NOT_MODIFIED} bbbb") is None     # Not cached: the caller asks again
+    assert client.accept_view("plain listing from an older server") == "plain listing from an older server"
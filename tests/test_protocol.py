@@ -0,0 +1,96 @@
+import asyncio
+import os
+import socket
+import zlib
+
+import pytest
+
+import protocol
+from protocol import (CODECS, COMPRESS_THRESHOLD, FLAG_COMPRESSED, FLAG_PUSH, HEADER, decode_ack, decode_hello,
+                      decompress_payload, encode_frame, encode_hello, read_frame, recv_frame)
+from server import choose_codec
+
+TEXT = ("1   Bluetooth Speaker   (USD) 39.99   12\n" * 100).encode("utf-8")   # Compresses well
+
+
+# Send one frame over a socket pair and read it back the way the client does
+def round_trip(frame, codec):
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(frame)
+        return recv_frame(right, codec)
+
+
+# Same through an asyncio StreamReader, the way the asyncio server reads requests
+def read_async(frame, codec):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(frame)
+        reader.feed_eof()
+        return await read_frame(reader, codec)
+    return asyncio.run(read())
+
+
+def test_hello_and_ack():
+    assert encode_hello() == "PROTO 2"
+    assert decode_hello(encode_hello(("zlib", "lzma"))) == ["zlib", "lzma"]
+    assert decode_hello("PROTO 2") == []
+    assert decode_hello("admin") is None
+    assert decode_ack("OK 2 zlib") == "zlib"
+    assert decode_ack("OK 2") is None
+    assert decode_ack("OK 2 brotli") is None
+
+
+def test_server_picks_the_first_supported_codec():
+    assert choose_codec(["brotli", "lzma", "zlib"], COMPRESS_THRESHOLD) == "lzma"
+    assert choose_codec(["brotli"], COMPRESS_THRESHOLD) is None
+    assert choose_codec(["zlib"], 0) is None        # Compression turned off on the server
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_payloads_from_the_threshold_up_are_compressed(codec):
+    small = TEXT[:COMPRESS_THRESHOLD - 1]
+    assert encode_frame(small, codec=codec) == HEADER.pack(len(small), 0) + small
+
+    frame = encode_frame(TEXT, FLAG_PUSH, codec=codec)
+    length, flags = HEADER.unpack_from(frame)
+    assert flags == FLAG_PUSH | FLAG_COMPRESSED
+    assert length == len(frame) - HEADER.size < len(TEXT)
+    assert round_trip(frame, codec) == (flags, TEXT)
+    assert read_async(frame, codec) == (flags, TEXT)
+
+
+def test_incompressible_payloads_are_sent_as_they_are():
+    data = os.urandom(4 * COMPRESS_THRESHOLD)
+    frame = encode_frame(data, codec="zlib")
+    assert HEADER.unpack_from(frame) == (len(data), 0)
+    assert round_trip(frame, "zlib") == (0, data)
+
+
+def test_no_codec_means_no_compression():
+    assert HEADER.unpack_from(encode_frame(TEXT)) == (len(TEXT), 0)
+
+
+def test_inflate_is_capped_at_the_frame_limit(monkeypatch):
+    monkeypatch.setattr(protocol, "MAX_FRAME_SIZE", 64 * 1024)
+    bomb = zlib.compress(b"\0" * (64 * 1024 + 1))
+    with pytest.raises(ValueError):
+        decompress_payload(bomb, "zlib")
+    assert decompress_payload(zlib.compress(b"\0" * 64 * 1024), "zlib") == b"\0" * 64 * 1024
+
+
+def test_truncated_or_unnegotiated_compressed_frames_are_refused():
+    packed = zlib.compress(TEXT)
+    with pytest.raises(ValueError):
+        decompress_payload(packed[:len(packed) // 2], "zlib")
+    frame = HEADER.pack(len(packed), FLAG_COMPRESSED) + packed
+    with pytest.raises(ValueError):
+        round_trip(frame, None)
+    with pytest.raises(ValueError):
+        read_async(frame, None)
+
+
+def test_oversized_frame_header_is_refused(monkeypatch):
+    monkeypatch.setattr(protocol, "MAX_FRAME_SIZE", 1024)
+    with pytest.raises(ValueError):
+        round_trip(HEADER.pack(1025, 0), None)
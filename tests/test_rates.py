@@ -0,0 +1,37 @@
+import pytest
+
+from rates import RateCache, RateProvider
+
+
+# Provider that counts its fetches and knows only the rates it is given
+class Provider(RateProvider):
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    def fetch(self, base, target):
+        self.calls += 1
+        try:
+            return self.table[(base, target)]
+        except KeyError:
+            raise LookupError(f"No rate for {base.upper()}->{target.upper()}")
+
+
+def test_malformed_codes_never_reach_the_provider():
+    provider = Provider({})
+    cache = RateCache(provider, refresh_interval=0)
+    for code in ("", "us", "usdx", "../etc", "u$d"):
+        with pytest.raises(ValueError):
+            cache.get_rate(code)
+    assert provider.calls == 0
+    assert cache.fetch_locks == {}
+
+
+def test_fetch_locks_are_dropped_after_fetching():
+    provider = Provider({("usd", "gbp"): 0.79})
+    cache = RateCache(provider, refresh_interval=0)
+    assert cache.get_rate("GBP") == 0.79
+    with pytest.raises(LookupError):
+        cache.get_rate("zzz")
+    assert cache.fetch_locks == {}
+    assert cache.get_rate("gbp") == 0.79 and provider.calls == 2
@@ -0,0 +1,73 @@
+import time
+
+from backend import Cart, Product, ReservationBook
+
+
+# Reservation book whose holds expire almost at once (the reaper never runs during a test)
+def short_lived_book():
+    return ReservationBook(ttl=0.05, reap_interval=3600)
+
+
+def test_renewing_an_expired_hold_replaces_it():
+    book = short_lived_book()
+    assert book.reserve("cart", 12, 3, stock=5)
+    time.sleep(0.08)
+    assert book.held("cart", 12) == 0
+
+    assert book.reserve("cart", 12, 3, stock=5)     # All 5 units are free again
+    assert book.held("cart", 12) == 3
+    assert book.reserved_totals() == {12: 3}
+
+
+def test_expired_hold_is_dropped_even_when_renewal_fails():
+    book = short_lived_book()
+    assert book.reserve("cart", 12, 3, stock=5)
+    time.sleep(0.08)
+    assert not book.reserve("cart", 12, 6, stock=5)
+    assert book.reserved_totals() == {}
+
+
+def test_non_positive_quantities_are_refused():
+    book = ReservationBook(reap_interval=3600)
+    assert not book.reserve("cart", 2, -5, stock=10)
+    assert not book.reserve("cart", 2, 0, stock=10)
+    assert book.reserve("cart", 2, 3, stock=10)
+    assert book.release("cart", 2, -5) == 0
+    assert book.reserved_totals() == {2: 3}
+
+
+def test_reaping_returns_expired_holds_to_other_carts():
+    book = short_lived_book()
+    assert book.reserve("first", 12, 5, stock=5)
+    assert not book.reserve("second", 12, 1, stock=5)
+    time.sleep(0.08)
+    book.reap()
+    assert book.reserved_totals() == {}
+    assert book.reserve("second", 12, 5, stock=5)
+
+
+def test_partial_release_renews_what_is_still_held():
+    book = ReservationBook(ttl=0.2, reap_interval=3600)
+    assert book.reserve("cart", 12, 4, stock=5)
+    time.sleep(0.12)
+    assert book.release("cart", 12, 1) == 1
+    time.sleep(0.12)                                # Past the original TTL, within the renewed one
+    assert book.held("cart", 12) == 3
+    assert book.release("cart", 12) == 3
+    assert book.reserved_totals() == {}
+
+
+def test_checkout_renewal_reholds_expired_lines_while_stock_lasts():
+    book = short_lived_book()
+    inventory = {1: Product(1, "Bluetooth Speaker", 39.99, 5), 2: Product(2, "USB-C Cable", 9.99, 2)}
+    cart = Cart(book)
+    cart.add_item(1, 3, inventory)
+    cart.add_item(2, 2, inventory)
+    time.sleep(0.08)
+    book.reap()
+    assert book.reserve("other cart", 2, 1, stock=2)   # Someone else took a cable meanwhile
+
+    missing = cart.renew_reservations(inventory)
+    assert [item.id for item in missing] == [2]
+    assert book.held(cart.holder, 1) == 3
+    assert book.held(cart.holder, 2) == 0
@@ -0,0 +1,127 @@
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import server
+from protocol import FLAG_PUSH, recv_frame
+from server import RATE_LIMITED, SERVER_BUSY, Connection, Server, Session, TokenBucket, request_cost
+
+
+# Monotonic clock the test moves by hand
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def vending_server():
+    instance = Server(port=0)
+    yield instance
+    instance.server_socket.close()
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    clock.now += 0.1                        # One token back at 10 per second
+    assert bucket.take() and not bucket.take()
+    clock.now += 60                         # Never refills past the burst
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_cost_above_the_burst_is_capped(clock):
+    bucket = TokenBucket(rate=1, burst=5)
+    assert bucket.take(50)                  # A big batch can still run when the bucket is full
+    assert not bucket.take()
+
+
+def test_batch_costs_one_token_per_command():
+    assert request_cost("VIEW") == 1
+    assert request_cost("BATCH\nADD 1 1\nADD 2 1\n\nCART") == 3
+    assert request_cost("BATCH") == 1
+
+
+def test_batch_is_admitted_whole_or_not_at_all(clock, vending_server):
+    ran = []
+
+    def run_command(request, session):
+        ran.append(request)
+        return "ok", True
+    vending_server.run_command = run_command
+    session = Session(None, None)
+    session.limiter = TokenBucket(rate=1, burst=5)
+    batch = "BATCH\nADD 1 1\nADD 2 1\nCART"
+
+    assert vending_server.process_request(batch, session) == ("ok", True)
+    reply, keep_open = vending_server.process_request(batch, session)    # 2 tokens left, needs 3
+    assert json.loads(reply) == [RATE_LIMITED] * 3 and keep_open
+    assert [vending_server.process_request("CART", session)[0] for _ in range(3)] == ["ok", "ok", RATE_LIMITED]
+    assert ran == [batch, "CART", "CART"]
+
+
+def test_session_limit(vending_server):
+    vending_server.MAX_SESSIONS = 2
+    assert vending_server.admit() and vending_server.admit()
+    assert not vending_server.admit()
+    vending_server.leave()
+    assert vending_server.admit()
+
+
+def test_rejections_share_a_bounded_pool(vending_server):
+    vending_server.MAX_PENDING_REJECTIONS = 1
+    vending_server.rejecter = ThreadPoolExecutor(max_workers=1)
+    first, first_client = socket.socketpair()
+    second, second_client = socket.socketpair()
+    with first_client, second_client:
+        vending_server.turn_away(first, "first")     # Waits in the pool for the client's first message
+        vending_server.turn_away(second, "second")   # Over the cap: closed straight away
+        assert second_client.recv(100) == b""
+        first_client.sendall(b"admin")
+        assert first_client.recv(100) == SERVER_BUSY.encode("utf-8")
+    vending_server.rejecter.shutdown()
+    assert vending_server.pending_rejections == 0
+
+
+# Framed server-side connection on one end of a socket pair; the other end plays the client
+@pytest.fixture
+def connection():
+    left, right = socket.socketpair()
+    left.settimeout(600)                    # As in a session: writes may wait up to the idle timeout
+    connection = Connection(left, 1024)
+    connection.framed = True
+    yield connection, right
+    left.close()
+    right.close()
+
+
+def test_push_waits_for_a_reply_in_progress(connection):
+    connection, client = connection
+    with connection.send_lock:              # The session thread is sending a reply
+        connection.send_push("event")
+        assert len(connection.outbox) == 1
+    connection.send_message("reply")        # ...and sends the queued push after it
+    assert recv_frame(client) == (0, b"reply")
+    assert recv_frame(client) == (FLAG_PUSH, b"event")
+
+
+def test_push_to_a_client_that_stopped_reading_drops_it_without_blocking(connection):
+    connection, client = connection
+    started = time.monotonic()
+    with pytest.raises(ConnectionError):
+        for _ in range(100_000):
+            connection.send_push("x" * 500)
+    assert time.monotonic() - started < 5
+    assert client.recv(1 << 20)             # Whole frames already sent are still delivered
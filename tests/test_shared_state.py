@@ -0,0 +1,28 @@
+from backend import SharedState
+
+
+def test_write_through_applies_a_change_the_cache_has_not_seen():
+    state = SharedState()
+    state.known = {"stock": 4}
+    applied = []
+    state.write_through("stock", 5, lambda: applied.append(5))
+    assert applied == [5]
+    assert state.known["stock"] == 5
+
+
+def test_write_through_skips_a_change_a_reload_already_included():
+    state = SharedState()
+    state.known = {"stock": 6}              # The sync thread installed a reload as of version 6
+    applied = []
+    state.write_through("stock", 5, lambda: applied.append(5))
+    assert applied == []                    # Applying the sale again would count it twice
+    assert state.known["stock"] == 6
+
+
+def test_write_through_behind_other_changes_leaves_them_to_the_sync():
+    state = SharedState()
+    state.known = {"stock": 2}              # Versions 3 and 4 came from other workers
+    applied = []
+    state.write_through("stock", 5, lambda: applied.append(5))
+    assert applied == [5]
+    assert state.known["stock"] == 2        # Still stale, so the next sync reloads